@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import random
+import string
+import timeit
+
+from footnotes.lib import SubstringMatcher
+
+def random_words(rng, n):
+    return ' '.join(
+        rng.choice(string.ascii_uppercase) + ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9)))
+        for _ in range(n)
+    )
+
+def bench_hereinafters(args):
+    """Per-sentence cost of the hereinafter check as the number of hereinafters defined so far grows."""
+
+    rng = random.Random(args.seed)
+    hereinafters = [random_words(rng, rng.randint(1, 3)) for _ in range(max(args.counts))]
+    sentences = [
+        '{} v. {}, {} F.3d {} ({}).'.format(random_words(rng, 2), random_words(rng, 3), rng.randint(1, 999),
+                                           rng.randint(1, 999), random_words(rng, 8))
+        for _ in range(args.sentences)
+    ]
+
+    print('{:>6} {:>14} {:>14}'.format('count', 'list (us)', 'matcher (us)'))
+    for count in args.counts:
+        defined = hereinafters[:count]
+        matcher = SubstringMatcher(defined)
+        matcher.search('')  # Build the automaton outside the timed loop.
+
+        def scan():
+            for sentence in sentences:
+                for h in defined:
+                    if h in sentence:
+                        break
+
+        def search():
+            for sentence in sentences:
+                matcher.search(sentence)
+
+        per_sentence = lambda f: min(timeit.repeat(f, number=1, repeat=args.repeat)) / len(sentences) * 1e6
+        print('{:>6} {:>14.2f} {:>14.2f}'.format(count, per_sentence(scan), per_sentence(search)))
+
+def bench_perma(args):
+    """
+    Perma archiving against a local FakePerma: batches of a fixed size, adaptive batches, and adaptive
+    batches captured asynchronously. Reports when every URL had a link (i.e. the document could be written)
+    and when the captures were done.
+    """
+
+    from footnotes.fakeperma import FakePerma
+    from footnotes.perma import API_CHUNK_SIZE, make_permas_futures, PermaContext
+
+    class Url(str):
+        def normalized(self):
+            return self
+
+    urls = [Url('https://example.com/{}'.format(i)) for i in range(args.urls)]
+
+    async def archive(max_batch_size, asynchronous):
+        fake = FakePerma(args.latency, args.per_url, args.failure_rate, background=asynchronous,
+                         capture_failure_rate=args.capture_failure_rate, seed=args.seed)
+        await fake.start()
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            async with PermaContext(urls, api_key='', folder=0, endpoint=fake.endpoint, timeout=args.timeout,
+                                    max_batch_size=max_batch_size, target_latency=args.target_latency,
+                                    rate=args.rate, asynchronous=asynchronous) as context:
+                await asyncio.gather(*make_permas_futures(context))
+                linked = loop.time() - start
+                await context.wait_for_captures()
+                captured = loop.time() - start
+        finally:
+            await fake.stop()
+
+        return len(context.permas), linked, captured, fake.requests + fake.polls
+
+    loop = asyncio.get_event_loop()
+    print('{:>12} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'mode', 'archived', 'linked (s)', 'done (s)', 'requests', 'URLs/minute'))
+    modes = [
+        ('fixed', API_CHUNK_SIZE, False),
+        ('adaptive', args.max_batch_size, False),
+        ('asynchronous', args.max_batch_size, True),
+    ]
+    for mode, max_batch_size, asynchronous in modes:
+        with contextlib.redirect_stdout(io.StringIO()):
+            archived, linked, captured, requests = loop.run_until_complete(archive(max_batch_size, asynchronous))
+        print('{:>12} {:>10} {:>10.1f} {:>10.1f} {:>10} {:>12.0f}'.format(
+            mode, archived, linked, captured, requests, 60 * archived / captured))
+
+def bench_collect_urls(args):
+    """Per-URL cost of collect_urls on one footnote as the number of links in it grows."""
+
+    import lxml.etree as ET
+    from footnotes.perma import collect_urls
+    from footnotes.text import TextRef
+
+    class Footnote(object):
+        def __init__(self, elements):
+            self.elements = elements
+
+        def text_refs(self):
+            return [TextRef.from_text(element) for element in self.elements]
+
+    def footnote(count):
+        # One run per citation, like Word's hyperlinks; every third link already has its Perma link.
+        rng = random.Random(args.seed)
+        elements = []
+        for i in range(count):
+            element = ET.Element('t')
+            element.text = '{} (quoting {}), https://example.com/{}/{}{} '.format(
+                random_words(rng, 6), random_words(rng, 2), random_words(rng, 1), i,
+                ' [https://perma.cc/ABCD-{:04}]'.format(i) if i % 3 == 0 else '')
+            elements.append(element)
+        return Footnote(elements)
+
+    print('{:>6} {:>14} {:>14}'.format('links', 'total (ms)', 'per URL (us)'))
+    for count in args.counts:
+        if count == 0:
+            continue
+
+        fn = footnote(count)
+        seconds = min(timeit.repeat(lambda: list(collect_urls([fn])), number=1, repeat=args.repeat))
+        print('{:>6} {:>14.2f} {:>14.2f}'.format(count, seconds * 1e3, seconds / count * 1e6))
+
+BENCHMARKS = {
+    'collect_urls': bench_collect_urls,
+    'hereinafters': bench_hereinafters,
+    'perma': bench_perma,
+}
+
+parser = argparse.ArgumentParser()
+parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+parser.add_argument('--counts', type=int, nargs='+', default=[0, 10, 25, 50, 100, 200, 400, 800])
+parser.add_argument('--sentences', type=int, default=2000)
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--urls', type=int, default=300)
+parser.add_argument('--latency', type=float, default=0.5, help='FakePerma seconds per batch.')
+parser.add_argument('--per-url', type=float, default=0.05, help='FakePerma seconds per captured URL.')
+parser.add_argument('--failure-rate', type=float, default=0.05)
+parser.add_argument('--capture-failure-rate', type=float, default=0.02)
+parser.add_argument('--timeout', type=float, default=5)
+parser.add_argument('--target-latency', type=float, default=2)
+parser.add_argument('--max-batch-size', type=int, default=50)
+parser.add_argument('--rate', type=float, default=2, help='Batches started per second.')
+args = parser.parse_args()
+
+BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,4 @@
+from footnotes.reference import build, INDEX_PATH
+
+index = build()
+print('Wrote {} ({} abbreviations, {} reporters).'.format(INDEX_PATH, len(index['abbreviations']), len(index['reporters'])))
@@ -0,0 +1,282 @@
+"""
+Persistent cache of downloaded sources, shared between pull runs.
+
+Entries are keyed by normalized URL and remember the response's content type and validators (ETag,
+Last-Modified), so a later run can revalidate with a conditional GET and reuse the stored body on 304. Bodies
+are stored by content hash: URLs that serve the same file share one copy. Link check verdicts are kept for
+a while too.
+"""
+
+from collections import namedtuple
+import hashlib
+import json
+import os
+from os.path import exists, join
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+from .config import CONFIG
+
+CacheEntry = namedtuple('CacheEntry', 'digest size content_type etag last_modified')
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+def normalize_url(url):
+    """Cache key for `url`: lowercase scheme and host, no default port, no fragment."""
+
+    parts = urlsplit(url.strip())
+    scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+    host, _, port = netloc.rpartition(':')
+    if host and DEFAULT_PORTS.get(scheme) == port:
+        netloc = host
+
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+class DownloadCache(object):
+    """
+    Interface for download caches. Subclasses store bodies and entries (e.g. in a local directory or an S3
+    bucket) by implementing get, open and put; counting hits and misses and building revalidation headers
+    happens here.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.verdict_hits = 0
+
+    def get(self, url):
+        """The CacheEntry for `url`, or None."""
+        raise NotImplementedError
+
+    def open(self, entry):
+        """A binary file object with the body for `entry`. OSError if the body is gone, e.g. evicted since get()."""
+        raise NotImplementedError
+
+    def put(self, url, f, content_type, etag=None, last_modified=None):
+        """Store the rest of binary file object `f` as the body for `url`. Returns the new CacheEntry."""
+        raise NotImplementedError
+
+    def get_verdict(self, url):
+        """Whether the link check for `url` passed, if we checked recently; otherwise None. Optional."""
+        return None
+
+    def put_verdict(self, url, works):
+        pass
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def revalidation_headers(entry):
+        """Conditional request headers for `entry`, or None if it can't be revalidated."""
+
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+
+        return headers or None
+
+    def summary(self):
+        return 'Cache: {} hits, {} misses, {} link checks reused.'.format(self.hits, self.misses, self.verdict_hits)
+
+class LocalDownloadCache(DownloadCache):
+    """
+    A DownloadCache in a local directory: bodies in objects/<sha256>, entries in index.json. When the bodies
+    add up to more than `max_bytes`, the least recently used URLs are evicted, along with bodies no remaining
+    URL refers to. Link check verdicts go in verdicts.json and expire after VERDICT_MAX_AGE seconds.
+
+    Several processes (e.g. shard workers) can use the same directory, each with its own LocalDownloadCache.
+    close() merges into whatever the others wrote since we read the index, so their entries survive. Two
+    closes at the same moment can still lose one side's new entries: those URLs are downloaded again next
+    time, and their bodies stay in objects/ unreferenced.
+    """
+
+    INDEX_NAME = 'index.json'
+    VERDICTS_NAME = 'verdicts.json'
+    VERDICT_MAX_AGE = 24 * 60 * 60
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.objects_directory = join(directory, 'objects')
+        os.makedirs(self.objects_directory, exist_ok=True)
+
+        # put() runs on executor threads.
+        self.lock = threading.Lock()
+        self.entries, self.used = self._read_index()
+        self.verdicts = self._read_verdicts()
+        # URLs we evicted or found without a body, so close() doesn't bring them back from the index on disk.
+        self.dropped = set()
+        self.dirty = False
+
+    def _read_index(self):
+        entries, used = {}, {}
+        try:
+            with open(join(self.directory, LocalDownloadCache.INDEX_NAME)) as f:
+                index = json.load(f)
+            for url, record in index.items():
+                entries[url] = CacheEntry(*record['entry'])
+                used[url] = record['used']
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}, {}
+
+        return entries, used
+
+    def _read_verdicts(self):
+        try:
+            with open(join(self.directory, LocalDownloadCache.VERDICTS_NAME)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _object_path(self, digest):
+        return join(self.objects_directory, digest)
+
+    def get(self, url):
+        key = normalize_url(url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not exists(self._object_path(entry.digest)):
+                del self.entries[key]
+                del self.used[key]
+                self.dropped.add(key)
+                entry = None
+            if entry is not None:
+                self.used[key] = time.time()
+                self.dirty = True
+
+            return entry
+
+    def open(self, entry):
+        # Under the lock so eviction can't remove the body halfway; once it's open, removing it is harmless.
+        with self.lock:
+            return open(self._object_path(entry.digest), 'rb')
+
+    def put(self, url, f, content_type, etag=None, last_modified=None):
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.objects_directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: f.read(LocalDownloadCache.CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+
+            digest = sha256.hexdigest()
+            entry = CacheEntry(digest, size, content_type, etag, last_modified)
+            key = normalize_url(url)
+
+            # Deduplicating against an existing body and adding the entry that refers to it happen under the
+            # same lock as eviction, so eviction on another thread can't remove the body in between.
+            with self.lock:
+                if exists(self._object_path(digest)):
+                    os.remove(temp_path)
+                else:
+                    os.replace(temp_path, self._object_path(digest))
+
+                self.entries[key] = entry
+                self.used[key] = time.time()
+                self.dropped.discard(key)
+                self.dirty = True
+                self._evict()
+        except BaseException:
+            if exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        return entry
+
+    def get_verdict(self, url):
+        verdict = self.verdicts.get(normalize_url(url))
+        if verdict is None:
+            return None
+
+        works, checked_at = verdict
+        if time.time() - checked_at > LocalDownloadCache.VERDICT_MAX_AGE:
+            return None
+
+        self.verdict_hits += 1
+        return works
+
+    def put_verdict(self, url, works):
+        with self.lock:
+            self.verdicts[normalize_url(url)] = [works, time.time()]
+            self.dirty = True
+
+    def _evict(self):
+        """Drop least recently used entries until we're under max_bytes. Call with the lock held."""
+
+        sizes = { entry.digest: entry.size for entry in self.entries.values() }
+        total = sum(sizes.values())
+        if total <= self.max_bytes:
+            return
+
+        for key in sorted(self.used, key=self.used.get):
+            if total <= self.max_bytes:
+                break
+
+            digest = self.entries.pop(key).digest
+            del self.used[key]
+            self.dropped.add(key)
+            if all(entry.digest != digest for entry in self.entries.values()):
+                total -= sizes[digest]
+                try:
+                    os.remove(self._object_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        """Write the index, if anything changed, merged with the one on disk."""
+
+        with self.lock:
+            if not self.dirty:
+                return
+
+            self._merge(*self._read_index(), self._read_verdicts())
+            self._evict()
+
+            index = { url: { 'entry': list(entry), 'used': self.used[url] } for url, entry in self.entries.items() }
+            now = time.time()
+            verdicts = { url: verdict for url, verdict in self.verdicts.items()
+                         if now - verdict[1] <= LocalDownloadCache.VERDICT_MAX_AGE }
+            self._write_json(LocalDownloadCache.INDEX_NAME, index)
+            self._write_json(LocalDownloadCache.VERDICTS_NAME, verdicts)
+            self.dirty = False
+
+    def _merge(self, entries, used, verdicts):
+        """Add what another process wrote since we read the index; where both of us have a URL, the later use wins."""
+
+        for url, entry in entries.items():
+            if url in self.dropped:
+                continue
+            if url not in self.entries or used[url] > self.used[url]:
+                self.entries[url] = entry
+                self.used[url] = used[url]
+
+        for url, verdict in verdicts.items():
+            if url not in self.verdicts or verdict[1] > self.verdicts[url][1]:
+                self.verdicts[url] = verdict
+
+    def _write_json(self, name, data):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, join(self.directory, name))
+
+def cache_from_config():
+    """The download cache described by the optional "cache" section of the config, if any."""
+
+    if 'cache' not in CONFIG:
+        return None
+
+    config = CONFIG['cache']
+    return LocalDownloadCache(config['directory'], config.get('max_mb', 1024) * 1024 * 1024)
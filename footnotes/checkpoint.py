@@ -0,0 +1,190 @@
+"""
+Checkpoints for jobs that run out of time, e.g. a pull in Lambda whose downloads outlast the invocation.
+
+A checkpoint is the job's state (anything JSON can hold) plus the sources zip written so far, kept in an
+ObjectStore: S3 in Lambda, a local directory otherwise. A later run loads it, appends to the zip and picks up
+where the last one stopped.
+"""
+
+import hashlib
+import json
+import os
+from os.path import exists, join
+import shutil
+import tempfile
+import zipfile
+
+from .upload import LocalMultipartUpload, MultipartWriter
+
+class ObjectStore(object):
+    """Interface for where checkpoints are kept: named blobs, like keys in an S3 bucket."""
+
+    def get_bytes(self, key):
+        """The contents of `key`, or None if it doesn't exist."""
+        raise NotImplementedError
+
+    def put_bytes(self, key, data):
+        raise NotImplementedError
+
+    def download(self, key, path):
+        """Copy `key` to local file `path`. Returns False if it doesn't exist."""
+        raise NotImplementedError
+
+    def upload(self, path, key):
+        raise NotImplementedError
+
+    def open_writer(self, key, **upload_args):
+        """A MultipartWriter that streams to `key`. `upload_args` are store-specific, e.g. S3's ContentType."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove `key`, if it exists."""
+        raise NotImplementedError
+
+class FileObjectStore(ObjectStore):
+    """An ObjectStore in a local directory, one file per key. Writes are atomic."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return join(self.directory, key)
+
+    def _replace(self, key, write):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            if exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get_bytes(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_bytes(self, key, data):
+        self._replace(key, lambda f: f.write(data))
+
+    def download(self, key, path):
+        if not exists(self._path(key)):
+            return False
+
+        shutil.copyfile(self._path(key), path)
+        return True
+
+    def upload(self, path, key):
+        def write(out):
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+
+        self._replace(key, write)
+
+    def open_writer(self, key, **upload_args):
+        return MultipartWriter(LocalMultipartUpload(self._path(key)))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+class Checkpoint(object):
+    """
+    `state` of an unfinished job, and `members`, the names in its sources zip when it was saved. The zip goes
+    in the store before the state, so a saved state never refers to a zip we don't have.
+
+    Checkpoints belong to a document, identified by document_key(). Each document's checkpoint has keys of its
+    own in the store, and records the document it's for, so it's never resumed for a different one.
+    """
+
+    # Bump when the layout of saved checkpoints changes.
+    FORMAT_VERSION = 2
+
+    STATE_NAME = 'checkpoint.json'
+    ZIP_NAME = 'sources.zip'
+    DIGEST_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, state, members=()):
+        self.state = state
+        self.members = list(members)
+
+    @staticmethod
+    def document_key(name, f):
+        """
+        Identifies a document by `name` (e.g. its path) and a digest of its contents, read from binary file
+        object `f`. `f` is rewound afterwards.
+        """
+
+        sha256 = hashlib.sha256()
+        f.seek(0)
+        for chunk in iter(lambda: f.read(Checkpoint.DIGEST_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+        f.seek(0)
+
+        return { 'name': name, 'sha256': sha256.hexdigest() }
+
+    @staticmethod
+    def keys(document):
+        """Store keys for the state and the sources zip of `document`'s checkpoint."""
+
+        prefix = hashlib.sha256(json.dumps(document, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return '{}.{}'.format(prefix, Checkpoint.STATE_NAME), '{}.{}'.format(prefix, Checkpoint.ZIP_NAME)
+
+    def save(self, store, zipfile_path, document):
+        with zipfile.ZipFile(zipfile_path) as zipf:
+            self.members = zipf.namelist()
+
+        state_key, zip_key = Checkpoint.keys(document)
+        store.upload(zipfile_path, zip_key)
+        store.put_bytes(state_key, json.dumps({
+            'version': Checkpoint.FORMAT_VERSION,
+            'document': document,
+            'members': self.members,
+            'state': self.state,
+        }).encode('utf-8'))
+
+    @staticmethod
+    def load(store, zipfile_path, document):
+        """
+        The checkpoint in `store` for `document`, or None. Its zip is copied to `zipfile_path`; if that's
+        missing or broken, nothing is left at `zipfile_path` and it's up to the job to redo whatever was in it.
+        """
+
+        state_key, zip_key = Checkpoint.keys(document)
+        data = store.get_bytes(state_key)
+        if data is None:
+            return None
+
+        try:
+            saved = json.loads(data.decode('utf-8'))
+        except ValueError:
+            print('Ignoring unreadable checkpoint.')
+            return None
+
+        if not isinstance(saved, dict) or saved.get('version') != Checkpoint.FORMAT_VERSION:
+            print('Ignoring checkpoint from another version.')
+            return None
+
+        # Checked before the zip is copied, so a stray checkpoint can't overwrite this document's sources.
+        if saved.get('document') != document:
+            print('Ignoring checkpoint for another document.')
+            return None
+
+        if not store.download(zip_key, zipfile_path) or not zipfile.is_zipfile(zipfile_path):
+            print('Checkpoint has no usable sources zip.')
+            if exists(zipfile_path):
+                os.remove(zipfile_path)
+
+        return Checkpoint(saved['state'], saved['members'])
+
+    @staticmethod
+    def clear(store, document):
+        for key in Checkpoint.keys(document):
+            store.delete(key)
@@ -0,0 +1,236 @@
+"""
+HTTP client used for pulling sources and making Perma links: an aiohttp session with per-host connection
+limits, retries, a circuit breaker for each host, and per-host stats.
+"""
+
+import aiohttp
+import asyncio
+import certifi
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import ssl
+import time
+from urllib.parse import urlsplit
+
+_ssl_context = None
+
+def default_ssl_context():
+    """SSL context with certifi's CA bundle, loaded once: loading it costs about 20ms, and it never changes."""
+
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context(cafile=certifi.where())
+
+    return _ssl_context
+
+class CircuitOpenError(aiohttp.ClientError):
+    """Raised instead of making a request to a host that has been failing."""
+
+class CircuitBreaker(object):
+    """
+    Opens after `threshold` consecutive failures, refusing requests for `cooldown` seconds. After that,
+    requests go through again, but a single further failure reopens it.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            self.opened_at = None
+            self.failures = self.threshold - 1
+            return True
+
+        return False
+
+    def record(self, success):
+        if success:
+            self.failures = 0
+            return
+
+        self.failures += 1
+        if self.failures >= self.threshold and self.opened_at is None:
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+
+class HostStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.refused = 0
+        self.responses = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def record_latency(self, latency):
+        self.responses += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def __str__(self):
+        mean_latency = self.total_latency / self.responses if self.responses else 0
+        return '{} requests, {} errors, {} retries, {} refused; latency {:.0f}ms mean, {:.0f}ms max'.format(
+            self.requests, self.errors, self.retries, self.refused, mean_latency * 1000, self.max_latency * 1000)
+
+class HttpClient(object):
+    """
+    Use like an aiohttp session: `async with client.get(url) as response: ...`.
+
+    Connection errors, timeouts and RETRY_STATUSES are retried up to `retries` times, after a Retry-After
+    header if there is one (giving up if it asks for more than `max_retry_after` seconds) and otherwise after
+    a jittered exponential backoff. Requests that aren't idempotent (e.g. POST) are only retried on
+    REJECTED_STATUSES, where the server tells us it didn't act on them. Each host gets a CircuitBreaker:
+    once it is open, requests to that host, retries included, fail immediately with CircuitOpenError.
+
+    A client can outlive a job (e.g. in a warm Lambda container) as long as it's `usable()`; call
+    `reset_stats()` before reusing it.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    REJECTED_STATUSES = {429, 503}
+    IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+    def __init__(self, limit=20, limit_per_host=6, retries=3, backoff=0.5, max_backoff=10, max_retry_after=30,
+                 failure_threshold=5, cooldown=30, dns_cache_ttl=300, **session_kwargs):
+        connector = aiohttp.TCPConnector(ssl_context=default_ssl_context(), limit=limit,
+                                         limit_per_host=limit_per_host, ttl_dns_cache=dns_cache_ttl)
+        self.session = aiohttp.ClientSession(connector=connector, **session_kwargs)
+        self.loop = asyncio.get_event_loop()
+
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.stats = {}
+        self.breakers = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        await self.session.close()
+
+    def usable(self):
+        """Whether the session is still open and bound to the current event loop."""
+
+        return not self.session.closed and not self.loop.is_closed() and self.loop is asyncio.get_event_loop()
+
+    def reset_stats(self):
+        """Start counting afresh for a new job. Circuit breakers carry over."""
+
+        self.stats = {}
+
+    def host_stats(self, host):
+        if host not in self.stats:
+            self.stats[host] = HostStats()
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(self.failure_threshold, self.cooldown)
+
+        return self.stats[host]
+
+    def backoff_delay(self, attempt):
+        ceiling = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def retry_delay(self, response, attempt):
+        """Seconds to wait before retrying after `response`, or None if it asks us to wait too long."""
+
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is None:
+            return self.backoff_delay(attempt)
+
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            try:
+                seconds = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return self.backoff_delay(attempt)
+
+        return max(0, seconds) if seconds <= self.max_retry_after else None
+
+    @asynccontextmanager
+    async def request(self, method, url, **kwargs):
+        host = urlsplit(url).hostname or ''
+        stats = self.host_stats(host)
+        breaker = self.breakers[host]
+        idempotent = method.upper() in HttpClient.IDEMPOTENT_METHODS
+        retry_statuses = HttpClient.RETRY_STATUSES if idempotent else HttpClient.REJECTED_STATUSES
+        loop = asyncio.get_event_loop()
+
+        attempt = 0
+        while True:
+            # Checked before every attempt: other requests to the host may have opened it while we backed off.
+            if not breaker.allow():
+                stats.refused += 1
+                raise CircuitOpenError('{} keeps failing; not requesting {}.'.format(host, url))
+
+            stats.requests += 1
+            start = loop.time()
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                stats.errors += 1
+                if not idempotent or attempt >= self.retries:
+                    breaker.record(False)
+                    raise
+                delay = self.backoff_delay(attempt)
+            else:
+                stats.record_latency(loop.time() - start)
+                if response.status in retry_statuses:
+                    stats.errors += 1
+                    delay = self.retry_delay(response, attempt) if attempt < self.retries else None
+                    if delay is None:
+                        breaker.record(False)
+                        break
+                    response.release()
+                else:
+                    breaker.record(response.status < 500)
+                    break
+
+            stats.retries += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+        try:
+            yield response
+        finally:
+            response.release()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def summary(self, max_hosts=15):
+        """Per-host stats, busiest hosts first."""
+
+        hosts = sorted(self.stats, key=lambda host: self.stats[host].requests, reverse=True)
+        lines = ['{}: {}{}'.format(host, self.stats[host],
+                                   ' (circuit opened {} times)'.format(self.breakers[host].times_opened)
+                                   if self.breakers[host].times_opened else '')
+                 for host in hosts[:max_hosts]]
+        if len(hosts) > max_hosts:
+            lines.append('... and {} more hosts.'.format(len(hosts) - max_hosts))
+
+        return '\n'.join(lines)
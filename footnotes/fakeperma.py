@@ -0,0 +1,121 @@
+"""
+A local stand-in for the Perma API, for tests and benchmarks of perma.py that shouldn't spend real captures.
+Run it with `python -m footnotes.fakeperma` and point PermaContext's `endpoint` at it, or start it in-process.
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+from aiohttp import web
+
+class FakePerma(object):
+    """
+    Serves Perma's batch API: POST /v1/archives/batches, and GET /v1/archives/batches/<id> for the status of
+    a batch's capture jobs.
+
+    The URLs in a batch are captured one after another, the first `latency + per_url` seconds after it was
+    submitted and each of the rest `per_url` seconds later. By default, the POST only answers once they're
+    all done; with `background`, it answers after `latency` with the jobs still pending, and the captures
+    happen in the background. A POST fails with a 500 with probability `failure_rate`, and each capture fails
+    with probability `capture_failure_rate`.
+
+    `requests` counts POSTs, `polls` GETs, `captured` URLs captured; `batch_sizes` lists every batch's size.
+    """
+
+    BATCHES_PATH = '/v1/archives/batches'
+
+    def __init__(self, latency=0.5, per_url=0.1, failure_rate=0, background=False, capture_failure_rate=0,
+                 seed=None):
+        self.latency = latency
+        self.per_url = per_url
+        self.failure_rate = failure_rate
+        self.background = background
+        self.capture_failure_rate = capture_failure_rate
+        self.random = random.Random(seed)
+
+        self.ids = itertools.count(1)
+        self.guids = ('FAKE-{:04X}'.format(i) for i in itertools.count())
+        # Batch id -> list of [url, guid, time captured, whether capture succeeds].
+        self.batches = {}
+        self.requests = 0
+        self.polls = 0
+        self.batch_sizes = []
+        self.runner = None
+        self.port = None
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post(FakePerma.BATCHES_PATH, self.create_batch)
+        app.router.add_get(FakePerma.BATCHES_PATH + '/{id}', self.get_batch)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{}{}'.format(self.port, FakePerma.BATCHES_PATH)
+
+    @property
+    def captured(self):
+        now = time.monotonic()
+        return sum(1 for jobs in self.batches.values() for _, _, done_at, works in jobs if works and done_at <= now)
+
+    def batch_json(self, batch_id):
+        now = time.monotonic()
+        jobs = [{
+            'guid': guid,
+            'submitted_url': url,
+            'status': 'pending' if done_at > now else 'completed' if works else 'failed',
+        } for url, guid, done_at, works in self.batches[batch_id]]
+        return { 'id': batch_id, 'capture_jobs': jobs }
+
+    async def create_batch(self, request):
+        data = await request.json()
+        urls = data['urls']
+        self.requests += 1
+        self.batch_sizes.append(len(urls))
+
+        if self.random.random() < self.failure_rate:
+            await asyncio.sleep(self.latency)
+            raise web.HTTPInternalServerError()
+
+        start = time.monotonic() + self.latency
+        batch_id = next(self.ids)
+        self.batches[batch_id] = [
+            [url, next(self.guids), start + self.per_url * (i + 1), self.random.random() >= self.capture_failure_rate]
+            for i, url in enumerate(urls)
+        ]
+
+        await asyncio.sleep(self.latency if self.background else self.latency + self.per_url * len(urls))
+        return web.json_response(self.batch_json(batch_id), status=201)
+
+    async def get_batch(self, request):
+        self.polls += 1
+        batch_id = int(request.match_info['id'])
+        if batch_id not in self.batches:
+            raise web.HTTPNotFound()
+
+        return web.json_response(self.batch_json(batch_id))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a fake Perma API.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds before any batch is answered.')
+    parser.add_argument('--per-url', type=float, default=0.1, help='Seconds to capture each URL.')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Fraction of batches that fail.')
+    parser.add_argument('--background', action='store_true', help='Answer batches before capturing them.')
+    parser.add_argument('--capture-failure-rate', type=float, default=0, help='Fraction of captures that fail.')
+    args = parser.parse_args()
+
+    fake = FakePerma(args.latency, args.per_url, args.failure_rate, args.background, args.capture_failure_rate)
+    web.run_app(fake.app(), host='127.0.0.1', port=args.port)
@@ -0,0 +1,165 @@
+"""
+Fan-out pulls: a document's downloads are split into shards, each shard is run by its own worker (a local
+process, or another Lambda invocation) into its own zip, and the workers' zips and results are merged back
+into the pull. Shards travel as checkpoint states, so a worker is just a resumed pull with no document.
+"""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from os.path import join
+import shutil
+import tempfile
+import zipfile
+
+from footnotes.cache import DEFAULT_MAX_BYTES, LocalDownloadCache
+from footnotes.checkpoint import Checkpoint
+from footnotes.footnotes import copy_compressed
+from footnotes.pull import await_downloads, checkpoint_state, DOWNLOAD_TIME, PullContext, restore_pull
+from footnotes.schedule import Scheduler
+
+def partition(fetches, count):
+    """Deal `fetches` into at most `count` shards in priority order, so each shard gets a share of every tier."""
+
+    ordered = sorted(fetches, key=lambda fetch: fetch.priority)
+    return [shard for shard in (ordered[i::count] for i in range(count)) if shard]
+
+def shard_state(pull_infos, fetches):
+    """
+    Checkpoint state for a shard: its `fetches` and just the PullInfos they touch, with `indices` mapping
+    those back into `pull_infos`.
+    """
+
+    index = { id(pull_info): i for i, pull_info in enumerate(pull_infos) }
+    touched = chain.from_iterable([fetch.pull_info] + fetch.duplicates for fetch in fetches)
+    indices = sorted(set(index[id(pull_info)] for pull_info in touched))
+
+    state = checkpoint_state([pull_infos[i] for i in indices], fetches, runs=0)
+    state['indices'] = indices
+    return state
+
+async def run_shard(state, zipfile_path, zipfile_prefix, time_budget, byte_budget=None, cache=None,
+                    client=None):
+    """The worker's side: run the fetches in shard `state` into a new zip at `zipfile_path`. Returns the result state."""
+
+    async with PullContext(None, zipfile_path, zipfile_prefix, cache=cache, client=client) as context:
+        fetches, pull_infos, runs = restore_pull(context, Checkpoint(state))
+        await await_downloads(context, fetches, pull_infos, time_left=Scheduler.deadline(time_budget),
+                              byte_budget=byte_budget)
+
+    result = checkpoint_state(pull_infos, fetches, runs)
+    result['indices'] = state['indices']
+    return result
+
+def run_shard_sync(state, zipfile_path, zipfile_prefix, time_budget, byte_budget=None, cache_directory=None,
+                   cache_max_bytes=DEFAULT_MAX_BYTES):
+    """run_shard() in a worker process, with its own LocalDownloadCache in `cache_directory` if there is one."""
+
+    cache = None
+    if cache_directory is not None:
+        cache = LocalDownloadCache(cache_directory, cache_max_bytes)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run_shard(state, zipfile_path, zipfile_prefix, time_budget, byte_budget,
+                                                 cache))
+    finally:
+        loop.close()
+
+def merge_shard(zipf, pull_infos, fetches, result, shard_zipfile_path):
+    """Copy a finished shard's zip members into `zipf` and its results into `pull_infos` and `fetches`."""
+
+    with zipfile.ZipFile(shard_zipfile_path) as shard_zipf:
+        for info in shard_zipf.infolist():
+            copy_compressed(shard_zipf, zipf, info)
+
+    for i, fields in zip(result['indices'], result['pull_infos']):
+        pull_infos[i].pulled = fields['pulled']
+    for fetch, record in zip(fetches, result['fetches']):
+        fetch.done = record['done']
+
+class ShardPool(object):
+    """
+    Runs a pull's fetches in up to `shards` workers, in place of await_downloads(). Subclasses decide where
+    a shard runs by implementing `run_shard(index, state, zipfile_path, zipfile_prefix, time_budget,
+    byte_budget)`, a coroutine that returns the result state from run_shard() and leaves the shard's zip at
+    `zipfile_path`. A shard that fails leaves its fetches unfinished, for a checkpoint to pick up.
+    """
+
+    # Seconds kept back from the workers' time budget for merging their zips.
+    MERGE_TIME = 15
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    async def run_shard(self, index, state, zipfile_path, zipfile_prefix, time_budget, byte_budget):
+        raise NotImplementedError
+
+    async def run(self, context, fetches, pull_infos, time_left=None, byte_budget=None, progress=None):
+        if time_left is None:
+            time_left = Scheduler.deadline(DOWNLOAD_TIME)
+
+        shards = partition(fetches, self.shards)
+        if not shards:
+            return
+
+        time_budget = time_left() - ShardPool.MERGE_TIME
+        shard_byte_budget = None
+        if byte_budget is not None:
+            shard_byte_budget = max(0, byte_budget - context.compressed_size()) // len(shards)
+
+        print('Trying to download {} sources in {} shards.'.format(len(fetches), len(shards)))
+        loop = asyncio.get_event_loop()
+        merging = asyncio.Lock()
+        directory = tempfile.mkdtemp()
+        finished = 0
+
+        async def run_one(index, shard):
+            nonlocal finished
+            shard_zipfile_path = join(directory, 'shard{}.zip'.format(index))
+            try:
+                result = await self.run_shard(index, shard_state(pull_infos, shard), shard_zipfile_path,
+                                              context.zipfile_prefix, time_budget, shard_byte_budget)
+                async with merging:
+                    await loop.run_in_executor(None, merge_shard, context.zipf, pull_infos, shard, result,
+                                               shard_zipfile_path)
+            except Exception as e:
+                print('Shard {} failed: {}'.format(index, e))
+                return
+
+            # Only what the shard settled: it may have run out of time or bytes for the rest.
+            finished += sum(1 for fetch in shard if fetch.finished())
+            if progress is not None:
+                progress(finished, len(fetches))
+
+        try:
+            await asyncio.gather(*(run_one(index, shard) for index, shard in enumerate(shards)))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        for fetch in fetches:
+            fetch.settle()
+
+        num_success = len([pi for pi in pull_infos if 'Y' in pi.pulled or 'works' in pi.pulled])
+        print('Successfully pulled {} out of {} total sources.'.format(num_success, len(pull_infos)))
+
+class LocalShardPool(ShardPool):
+    """
+    Runs each shard in a local worker process. Workers can't share the pull's cache object, so with
+    `cache_directory` each opens its own LocalDownloadCache there.
+    """
+
+    def __init__(self, shards, cache_directory=None, cache_max_bytes=DEFAULT_MAX_BYTES):
+        super().__init__(shards)
+        self.cache_directory = cache_directory
+        self.cache_max_bytes = cache_max_bytes
+        self.executor = None
+
+    async def run(self, *args, **kwargs):
+        with ProcessPoolExecutor(max_workers=self.shards) as self.executor:
+            return await super().run(*args, **kwargs)
+
+    async def run_shard(self, index, state, zipfile_path, zipfile_prefix, time_budget, byte_budget):
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, run_shard_sync, state, zipfile_path, zipfile_prefix, time_budget, byte_budget,
+            self.cache_directory, self.cache_max_bytes)
@@ -1,8 +1,13 @@
 from collections import defaultdict
+import copy
+import io
 import itertools
 import lxml.etree as ET
+import struct
+import sys
 import zipfile
 
+from .lib import cached_property
 from .text import Range, TextRef, Location
 
 NS = {
@@ -22,7 +27,9 @@ class Run(object):
         assert element.tag == ns('w', 'r')
         self.element = element
 
-        self.props = self.element.find('w:rPr', NS)
+    @cached_property
+    def props(self):
+        return self.element.find('w:rPr', NS)
 
     def italics(self):
         """Is this text in italics?"""
@@ -51,7 +58,10 @@ class Paragraph(object):
     def __init__(self, element):
         assert element.tag == ns('w', 'p')
         self.element = element
-        self.runs = [Run(e) for e in self.element.findall('.//w:r', NS)]
+
+    @cached_property
+    def runs(self):
+        return [Run(e) for e in self.element.iter(ns('w', 'r'))]
 
     def text(self):
         """Unformatted text for paragraph."""
@@ -66,7 +76,10 @@ class Footnote(object):
         assert element.tag == ns('w', 'footnote')
         self.element = element
         self.number = number
-        self.paragraphs = [Paragraph(e) for e in self.element.findall('.//w:p', NS)]
+
+    @cached_property
+    def paragraphs(self):
+        return [Paragraph(e) for e in self.element.iter(ns('w', 'p'))]
 
     def internal_id(self):
         """Internal id. Guaranteed to be unique, but not necessarily what you see in the document."""
@@ -81,17 +94,84 @@ class Footnote(object):
     def text_refs(self):
         return list(itertools.chain.from_iterable(p.text_refs() for p in self.paragraphs))
 
+class FootnoteData(object):
+    """
+    A picklable copy of the parts of a Footnote that parsing looks at, for parsing in another process: its
+    number, its text, and for each text ref the text and the formatting of the run it's in.
+    """
+
+    def __init__(self, number, text, refs):
+        self.number = number
+        self._text = text
+        self.refs = refs
+
+    @staticmethod
+    def from_footnote(footnote):
+        refs = []
+        for text_ref in footnote.text_refs():
+            run = next(text_ref.element.iterancestors(ns('w', 'r')), None)
+            if run is None:
+                formatting = None
+            else:
+                formatting = bool(run.findall('.//w:i', NS)), bool(run.findall('.//w:smallCaps', NS))
+            refs.append((str(text_ref), formatting))
+
+        return FootnoteData(footnote.number, footnote.text(), refs)
+
+    def text(self):
+        return self._text
+
+    def text_refs(self):
+        """Text refs into freshly built <w:t> elements, inside <w:r> elements with the original formatting."""
+
+        text_refs = []
+        for text, formatting in self.refs:
+            text_elem = ET.Element(ns('w', 't'))
+            text_elem.text = text
+            if formatting is not None:
+                italics, smallcaps = formatting
+                run_elem = ET.Element(ns('w', 'r'))
+                props = ET.SubElement(run_elem, ns('w', 'rPr'))
+                if italics: ET.SubElement(props, ns('w', 'i'))
+                if smallcaps: ET.SubElement(props, ns('w', 'smallCaps'))
+                run_elem.append(text_elem)
+
+            text_refs.append(TextRef(text_elem, Location.TEXT, Range.from_str(text)))
+
+        return text_refs
+
+FOOTNOTE_TAG = ns('w', 'footnote')
+FOOTNOTE_REF_TAG = ns('w', 'footnoteRef')
+
+def number_footnotes(events):
+    """
+    Number footnotes from a stream of (event, element) pairs for <w:footnote> and <w:footnoteRef> elements, as
+    produced by iterparse or iterwalk with events=('start', 'end'). Yields (element, number) as each footnote
+    ends. A footnote's number is the position of its first footnoteRef in the document; footnotes without one
+    (separators) get 0.
+    """
+
+    ref_count = 0
+    number = None
+    for event, elem in events:
+        if elem.tag == FOOTNOTE_REF_TAG:
+            if event == 'end':
+                ref_count += 1
+                if number == 0:
+                    number = ref_count
+        elif event == 'start':
+            number = 0
+        else:
+            yield elem, number
+            number = None
+
 class FootnoteList(object):
     def __init__(self, tree):
         self.tree = tree
         self.root = tree.getroot()
 
-        footnote_elements = self.root.findall('.//w:footnote', NS)
-        refs = self.root.findall('.//w:footnoteRef', NS)
-        id_map = { ref: idx for idx, ref in enumerate(refs, start=1) }
-        id_map[None] = 0
-
-        self.footnotes = [Footnote(elem, id_map.get(elem.find('.//w:footnoteRef', NS))) for elem in footnote_elements]
+        events = ET.iterwalk(self.root, events=('start', 'end'), tag=(FOOTNOTE_TAG, FOOTNOTE_REF_TAG))
+        self.footnotes = [Footnote(elem, number) for elem, number in number_footnotes(events)]
         print("Found {} footnotes.".format(len(self.footnotes)))
 
     def __iter__(self):
@@ -103,6 +183,28 @@ class FootnoteList(object):
 
         return FootnoteList(ET.parse(f))
 
+    @staticmethod
+    def iterparse(f, read_only=False):
+        """
+        Yield Footnotes from filename or file object `f` as they are parsed, without building the whole tree
+        first. With `read_only`, each footnote's element is cleared and dropped once the next footnote is
+        requested, so only one is in memory at a time: copy out anything you need (e.g. with
+        FootnoteData.from_footnote) before moving on.
+        """
+
+        count = 0
+        events = ET.iterparse(f, events=('start', 'end'), tag=(FOOTNOTE_TAG, FOOTNOTE_REF_TAG))
+        for elem, number in number_footnotes(events):
+            yield Footnote(elem, number)
+            count += 1
+
+            if read_only:
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+        print("Found {} footnotes.".format(count))
+
     def remove_hyperlinks(self):
         hyperlinks = self.root.findall('.//w:hyperlink', NS)
         for hyper in hyperlinks:
@@ -119,29 +221,120 @@ class FootnoteList(object):
             style.getparent().remove(style)
 
 class Docx(object):
-    def __init__(self, file_or_name):
+    def __init__(self, file_or_name, stream=False):
+        """
+        With `stream`, footnotes.xml isn't parsed up front: there is no footnote_list, and footnotes are read
+        with iter_footnotes instead.
+        """
+
         self.file_or_name = file_or_name
+        self.stream = stream
         self.zipf = None
         self.footnotes_xml = None
         self.footnote_list = None
 
     def __enter__(self):
         self.zipf = zipfile.ZipFile(self.file_or_name)
-        self.footnotes_xml = self.zipf.open('word/footnotes.xml')
-        self.footnote_list = FootnoteList.from_file(self.footnotes_xml)
+        if not self.stream:
+            self.footnotes_xml = self.zipf.open('word/footnotes.xml')
+            self.footnote_list = FootnoteList.from_file(self.footnotes_xml)
 
         return self
 
     def __exit__(self, typ, value, traceback):
-        self.footnotes_xml.close()
+        if self.footnotes_xml is not None:
+            self.footnotes_xml.close()
+            self.footnotes_xml = None
         self.zipf.close()
         self.footnote_list = None
 
-    def write(self, new_filename):
-        with zipfile.ZipFile(new_filename, 'w') as new_zipf:
+    def iter_footnotes(self, read_only=False):
+        """Stream footnotes from footnotes.xml; see FootnoteList.iterparse. The Docx must stay open meanwhile."""
+
+        with self.zipf.open('word/footnotes.xml') as footnotes_xml:
+            yield from FootnoteList.iterparse(footnotes_xml, read_only)
+
+    def write(self, new_filename, compresslevel=6):
+        """
+        Write the document, with our footnotes.xml, to `new_filename`. Other members are copied without being
+        decompressed; footnotes.xml is deflated at `compresslevel` as it's serialized.
+        """
+
+        with zipfile.ZipFile(new_filename, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as new_zipf:
             for info in self.zipf.infolist():
                 if info.filename == 'word/footnotes.xml':
-                    with new_zipf.open(info, 'w') as out:
+                    regenerated = zipfile.ZipInfo(info.filename, info.date_time)
+                    regenerated.external_attr = info.external_attr
+                    regenerated.compress_type = zipfile.ZIP_DEFLATED
+                    set_compresslevel(regenerated, compresslevel)
+                    with new_zipf.open(regenerated, 'w') as out:
                         self.footnote_list.tree.write(out, encoding='utf-8')
-                else:
+                elif info.flag_bits & ZIP_FLAG_ENCRYPTED:
                     new_zipf.writestr(info, self.zipf.read(info))
+                else:
+                    copy_compressed(self.zipf, new_zipf, info)
+
+ZIP_FLAG_ENCRYPTED = 0x01
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# zipfile has no public way to append a member's compressed bytes as they are, so copy_compressed does ZipFile's
+# bookkeeping for it (_lock, _writecheck, filelist, NameToInfo, start_dir, _didModify). That's checked against
+# these Python versions by tests/test_docx.py; 3.7 is the Lambda runtime. Anywhere else, members are
+# decompressed and recompressed through writestr instead.
+RAW_COPY_VERSIONS = ((3, 7), (3, 13))
+
+def can_copy_compressed():
+    return RAW_COPY_VERSIONS[0] <= sys.version_info[:2] <= RAW_COPY_VERSIONS[1]
+
+def set_compresslevel(info, compresslevel):
+    """Set the level ZipFile.open(info, 'w') deflates at; it's only public as of 3.13."""
+
+    if sys.version_info >= (3, 13):
+        info.compress_level = compresslevel
+    else:
+        info._compresslevel = compresslevel
+
+def copy_compressed(source, dest, info):
+    """
+    Copy member `info` from ZipFile `source` to ZipFile `dest` as-is: its compressed bytes go across verbatim
+    behind a new local header, with no inflate/deflate round trip.
+    """
+
+    if not can_copy_compressed():
+        dest.writestr(copy.copy(info), source.read(info))
+        return
+
+    if dest._writing:
+        raise ValueError("Can't write to the ZIP file while there is an open writing handle.")
+
+    with source._lock:
+        source.fp.seek(info.header_offset)
+        header = source.fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile('Bad local header for {}.'.format(info.filename))
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        source.fp.seek(name_length + extra_length, io.SEEK_CUR)
+
+        member = copy.copy(info)
+        # We know the sizes and CRC up front, so they go in the local header rather than a data descriptor.
+        member.flag_bits &= ~ZIP_FLAG_DATA_DESCRIPTOR
+        dest._writecheck(member)
+
+        with dest._lock:
+            member.header_offset = dest.fp.tell()
+            dest.fp.write(member.FileHeader())
+
+            remaining = info.compress_size
+            while remaining > 0:
+                chunk = source.fp.read(min(remaining, COPY_CHUNK_SIZE))
+                if not chunk:
+                    raise zipfile.BadZipFile('Truncated data for {}.'.format(info.filename))
+                dest.fp.write(chunk)
+                remaining -= len(chunk)
+
+            # What ZipFile.write does after writing a member, so the central directory includes it.
+            dest.filelist.append(member)
+            dest.NameToInfo[member.filename] = member
+            dest.start_dir = dest.fp.tell()
+            dest._didModify = True
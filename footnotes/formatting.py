@@ -59,7 +59,8 @@ def extend_front_if_formatted(parseable):
     format_list = FormatList.from_parseable(parseable)
     if format_list[0].roman(): return parseable
 
-    copy = parseable[:]
-    first = copy.text_refs[0]
+    # Build a fresh object: the slice's cached text and offsets don't know about the widened range.
+    refs = parseable[:].text_refs
+    first = refs[0]
     first.range = Range(0, first.range.j)
-    return copy
+    return type(parseable)(refs)
@@ -1,3 +1,5 @@
+from collections import deque
+
 def cached_property(func):
     def getter(self):
         if not hasattr(self, '_cache'):
@@ -7,3 +9,87 @@ def cached_property(func):
         return self._cache[func]
 
     return property(fget=getter)
+
+class SubstringMatcher(object):
+    """
+    A growing set of strings that can answer "does any of them occur in this text?" in time proportional to the
+    length of the text, however many strings there are (an Aho-Corasick automaton). Strings can be added at
+    any time; failure links are rebuilt on the next search.
+
+    With only a few strings, checking `s in text` for each is faster than walking the automaton in Python, so
+    we do that below SCAN_LIMIT strings.
+    """
+
+    SCAN_LIMIT = 96
+
+    def __init__(self, strings=()):
+        self.strings = []
+        self._goto = [{}]
+        self._terminal = [False]
+        self._fail = None
+        for s in strings:
+            self.add(s)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __iter__(self):
+        return iter(self.strings)
+
+    def add(self, s):
+        self.strings.append(s)
+
+        node = 0
+        for char in s:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto.append({})
+                self._terminal.append(False)
+                self._goto[node][char] = next_node
+            node = next_node
+
+        self._terminal[node] = True
+        self._fail = None
+
+    def _build(self):
+        """Breadth-first pass computing failure links; terminal flags are propagated along them."""
+
+        goto, terminal = self._goto, self._terminal
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fallback = goto[state].get(char, 0)
+                fail[child] = fallback if fallback != child else 0
+                terminal[child] = terminal[child] or terminal[fail[child]]
+                queue.append(child)
+
+        self._fail = fail
+
+    def search(self, text):
+        """Does any of our strings occur in `text`?"""
+
+        if len(self.strings) < SubstringMatcher.SCAN_LIMIT:
+            return any(s in text for s in self.strings)
+
+        if self._fail is None:
+            self._build()
+
+        goto, fail, terminal = self._goto, self._fail, self._terminal
+        if terminal[0]:
+            return True
+
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if terminal[node]:
+                return True
+
+        return False
@@ -1,24 +1,15 @@
+from array import array
 import bisect
+from collections import namedtuple
 from enum import Enum
 import itertools
-from os.path import dirname, join
 import re
 
 from .formatting import extend_front_if_formatted
+from .lib import SubstringMatcher
+from . import reference
 from .text import Range, TextRef
 
-with open(join(dirname(__file__), 'abbreviations.txt'), encoding='utf-8') as f:
-    def generate_abbreviations():
-        for line in f:
-            if line.startswith('#'): continue
-            line = line.strip().replace(',', '')
-            for word in line.split(' '):
-                if word and word.endswith('.'):
-                    yield word
-
-    abbreviations = set(generate_abbreviations())
-    print("Found {} abbreviations.".format(len(abbreviations)))
-
 NORMALIZATIONS = {
     '“': '"',
     '”': '"',
@@ -29,11 +20,79 @@ NORMALIZATIONS = {
     '\u200C': '',
     '\u200B': '',
 }
+NORMALIZATION_TABLE = str.maketrans(NORMALIZATIONS)
+DELETIONS_RE = re.compile('[{}]'.format(''.join(k for k, v in NORMALIZATIONS.items() if not v)))
+
 def normalize(text):
-    for sub_out, sub_in in NORMALIZATIONS.items():
-        text = text.replace(sub_out, sub_in)
+    # Everything we normalize is non-ASCII, and isascii() doesn't need to scan the string.
+    if text.isascii():
+        return text
+    return text.translate(NORMALIZATION_TABLE)
+
+class NormalizationMap(object):
+    """
+    Maps offsets in normalized text back to offsets in the original text.
+
+    Normalization only ever replaces a character with one character or deletes it, so the map is just the
+    original position of each normalized character (plus the original length). Most text has nothing to
+    delete, in which case `positions` is None and the map is the identity.
+    """
+
+    def __init__(self, positions=None):
+        self.positions = positions
+
+    @staticmethod
+    def from_str(text):
+        if text.isascii() or not DELETIONS_RE.search(text):
+            return NormalizationMap()
+
+        positions = array('l')
+        start = 0
+        for match in DELETIONS_RE.finditer(text):
+            positions.extend(range(start, match.start()))
+            start = match.end()
+        positions.extend(range(start, len(text) + 1))
+
+        return NormalizationMap(positions)
+
+    def original(self, offset):
+        """Original offset of the normalized character at `offset`."""
+
+        return offset if self.positions is None else self.positions[offset]
+
+    def original_end(self, offset):
+        """Original offset just past the normalized character before `offset`."""
+
+        if self.positions is None: return offset
+        return self.positions[offset - 1] + 1 if offset > 0 else self.positions[0]
+
+    def original_range(self, r):
+        if r.i == r.j:
+            i = self.original(r.i)
+            return Range(i, i)
+
+        return Range(self.original(r.i), self.original_end(r.j))
 
-    return text
+    def normalized(self, offset):
+        """Normalized offset of the first character at or after original `offset`."""
+
+        return offset if self.positions is None else bisect.bisect_left(self.positions, offset)
+
+    def __getitem__(self, r):
+        """Map for the normalized text in `r`, rebased to start at zero."""
+
+        if self.positions is None:
+            return self
+
+        base = self.original_range(r)
+        positions = array('l', (p - base.i for p in self.positions[r.i:r.j]))
+        positions.append(base.j - base.i)
+        return NormalizationMap(positions)
+
+def normalize_with_map(text):
+    """Normalize `text` and return the normalized text along with its NormalizationMap."""
+
+    return normalize(text), NormalizationMap.from_str(text)
 
 def relative_offset(offsets, index, offset):
     return offset - (offsets[index - 1] if index > 0 else 0)
@@ -45,11 +104,15 @@ class Parseable(object):
 
     SIGNAL_UPPER = r'(See|See also|E.g.|Accord|Cf.|Contra|But see|But cf.|See generally|Compare)(, e.g.,)?'
     SIGNAL = r'({upper}|{lower})'.format(upper=SIGNAL_UPPER, lower=SIGNAL_UPPER.lower())
+    SIGNAL_UPPER_RE = re.compile(SIGNAL_UPPER)
+
+    PERIOD_RE = re.compile(r'\. +(?! )')
+    PAREN_CAP_RE = re.compile(r'\)\.? [A-Z]')
 
     SOURCE_WORD = '[A-Z0-9][A-Za-z0-9\'\\.]*'
     CITATION_RE = re.compile(r'([\.,]["”]? |^ ?|{signal} )(?P<cite>(?P<volume>[0-9]+) (?P<source>(& |{word} )*{word}) (§§? ?)?[0-9,]*[0-9])'.format(word=SOURCE_WORD, signal=SIGNAL))
 
-    def __init__(self, text_refs):
+    def __init__(self, text_refs, offsets=None, text=None):
         if len(text_refs) > 1:
             tr0 = text_refs[0]
             tr1 = text_refs[-1]
@@ -61,6 +124,13 @@ class Parseable(object):
 
         self.text_refs = text_refs
 
+        # Caches. Slices of a Parseable inherit these from their parent instead of rebuilding them.
+        self._offset_index = offsets
+        self._text = text
+        self._normalized = None
+        self._normalization_map = None
+        self._citation = None
+
     @staticmethod
     def from_element(element):
         def gather_refs(parent):
@@ -75,22 +145,28 @@ class Parseable(object):
         return Parseable(list(gather_refs(element)))
 
     def __str__(self):
-        return ''.join(str(tr) for tr in self.text_refs)
+        if self._text is None:
+            self._text = ''.join(str(tr) for tr in self.text_refs)
+        return self._text
 
     def __repr__(self):
         return 'TextObject({!r})'.format(self.text_refs)
 
     def __len__(self):
-        return sum(len(tr) for tr in self.text_refs)
+        offsets = self._offsets()
+        return offsets[-1] if offsets else 0
 
     def _offsets(self):
         """Offset of each constituent text ref. The first one is omitted"""
 
-        lengths = (len(tr.range) for tr in self.text_refs)
-        offsets = itertools.accumulate(lengths)
+        if self._offset_index is None:
+            lengths = (len(tr.range) for tr in self.text_refs)
+            offsets = itertools.accumulate(lengths)
+
+            # This should leave one offset behind (the total length)
+            self._offset_index = list(offsets)
 
-        # This should leave one offset behind (the total length)
-        return list(offsets)
+        return self._offset_index
 
     def _find(self, offset, side=Side.LEFT):
         """Get (TextRef index, relative offset) for text to left or right of a given offset (insertion point)."""
@@ -128,7 +204,12 @@ class Parseable(object):
                 refs[-1] = refs[-1][:stop_rel_offset]
                 refs[0] = refs[0][start_rel_offset:]
 
-                return Parseable(refs)
+                # Rebase our own offset index rather than recomputing it from the refs.
+                offsets = [o - start for o in self._offsets()[start_index:stop_index]]
+                offsets.append(stop - start)
+                text = self._text[start:stop] if self._text is not None else None
+
+                return Parseable(refs, offsets=offsets, text=text)
         else:
             raise TypeError('TextObject indices must be slices.')
 
@@ -148,78 +229,114 @@ class Parseable(object):
     def insert_after(self, s):
         return self.insert(len(self), s, side=Parseable.Side.LEFT)
 
-    def citation_sentences(self, abbreviations=abbreviations):
+    def _normalize(self):
+        if self._normalized is None or self._normalization_map is None:
+            self._normalized, self._normalization_map = normalize_with_map(str(self))
+
+    def normalization_map(self):
+        self._normalize()
+        return self._normalization_map
+
+    def original_range(self, normalized_range):
+        """Translate a range in normalized text to a range in this object."""
+
+        return self.normalization_map().original_range(normalized_range)
+
+    def normalized_slice(self, normalized_range):
+        """Slice by a range in normalized text. The result shares our normalization."""
+
+        result = self[self.original_range(normalized_range).slice()]
+        result._normalized = self.normalized()[normalized_range.slice()]
+        result._normalization_map = self.normalization_map()[normalized_range]
+        return result
+
+    def citation_sentences(self, abbreviations=None):
         """Attempt to parse the text into a list of citations."""
 
-        text = normalize(str(self))
-        # print(text)
+        text = self.normalized()
+        return [self.normalized_slice(r) for r in Parseable.sentence_ranges(text, abbreviations)]
+
+    @staticmethod
+    def sentence_ranges(text, abbreviations=None):
+        """
+        Split normalized `text` into citation sentence ranges in a single pass.
+
+        Candidate sentences end at a period or at an end paren followed by a capital letter. Each candidate is
+        merged into the sentence before it unless that would split an abbreviation, parenthetical, bracket or
+        quote; paren/bracket/quote depth is tracked incrementally as candidates are merged.
+        """
 
-        def tokens(text):
-            periods = re.finditer(r'\. +(?! )', text)
+        if abbreviations is None:
+            abbreviations = reference.abbreviations()
+
+        def candidates():
             start = 0
             while start < len(text) and text[start] == ' ':
                 start += 1
 
-            for match in periods:
-                yield Range(start, match.start(0) + 1)
+            def paren_cap(i, j):
+                last_index = i
+                for match in Parseable.PAREN_CAP_RE.finditer(text, i, j):
+                    yield Range(last_index, match.end() - 2)
+                    last_index = match.end() - 1
+                yield Range(last_index, j)
+
+            for match in Parseable.PERIOD_RE.finditer(text):
+                yield from paren_cap(start, match.start(0) + 1)
                 start = match.end(0)
 
             if start < len(text):
-                yield Range(start, len(text))
-
-        first_pass = tokens(text)
-
-        # Split at any end paren followed by a capital letter.
-        def paren_cap(tokens):
-            result = []
-            for t in tokens:
-                last_index = t.i
-                for match in re.finditer(r'\)\.? [A-Z]', str(self[t.slice()])):
-                    yield Range(last_index, t.i + match.end() - 2)
-                    last_index = t.i + match.end() - 1
-                yield Range(last_index, t.j)
-
-        second_pass = paren_cap(first_pass)
-
-        compacted = []
-        for candidate in second_pass:
-            if not compacted:
-                compacted.append(candidate)
-            else:
-                last = text[compacted[-1].slice()]
+                yield from paren_cap(start, len(text))
+
+        current = None
+        paren_depth, bracket_depth, quote_count = 0, 0, 0
+        for candidate in candidates():
+            if current is not None:
                 addition = text[candidate.slice()]
-                # print('Last: [{}], Add: [{}]'.format(last, addition))
-                _, _, last_word = last.rpartition(' ')
+                last_space = text.rfind(' ', current.i, current.j)
+                last_word = text[max(last_space + 1, current.i):current.j]
                 next_word, _, following = addition.partition(' ')
-                paren_depth = last.count('(') - last.count(')')
-                bracket_depth = last.count('[') - last.count(']')
-                quote_depth = last.count('"') % 2
-                if re.match(Parseable.SIGNAL_UPPER, addition):
-                    compacted.append(candidate)
+                if Parseable.SIGNAL_UPPER_RE.match(addition):
+                    pass
                 elif (last_word in abbreviations
                         or addition in abbreviations
                         or (next_word in abbreviations and following in abbreviations)
                         or (addition and not addition[0].isupper())
                         or paren_depth > 0
                         or bracket_depth > 0
-                        or quote_depth > 0):
-                    compacted[-1].combine(candidate)
-                else:
-                    compacted.append(candidate)
+                        or quote_count % 2 > 0):
+                    merged = text[current.j:candidate.j]
+                    paren_depth += merged.count('(') - merged.count(')')
+                    bracket_depth += merged.count('[') - merged.count(']')
+                    quote_count += merged.count('"')
+                    current.combine(candidate)
+                    continue
 
-        split = itertools.chain.from_iterable(t.split(text, '; ') for t in compacted)
+                yield from current.split(text, '; ')
 
-        return [self[t.slice()] for t in split]
+            current = candidate
+            addition = text[candidate.slice()]
+            paren_depth = addition.count('(') - addition.count(')')
+            bracket_depth = addition.count('[') - addition.count(']')
+            quote_count = addition.count('"')
+
+        if current is not None:
+            yield from current.split(text, '; ')
 
     def links(self):
         text = str(self)
         results = Parseable.URL_RE.finditer(text)
+
+        # Parentheses open before the current link, counted as we go so the whole pass stays linear.
+        open_parens = 0
+        counted = 0
         for m in results:
             url = Range.from_match(m, 'url')
-            pre = text[0:m.start('url')]
+            open_parens += text.count('(', counted, url.i) - text.count(')', counted, url.i)
+            counted = url.i
 
             # Sometimes people put links in parentheses. Work around that.
-            paren_depth = pre.count('(') - pre.count(')')
+            paren_depth = open_parens
             while paren_depth > 0 and text[url.j - 1] == ')':
                 url.j -= 1
                 paren_depth -= 1
@@ -234,25 +351,34 @@ class Parseable(object):
         return [str(r) for _, r in self.links()]
 
     def normalized(self):
-        return normalize(str(self))
+        if self._normalized is None:
+            self._normalized = normalize(str(self))
+        return self._normalized
 
     def citation(self):
-        text = normalize(str(self))
+        if self._citation is None:
+            self._citation = self._find_citation()
+        return self._citation or None
+
+    def _find_citation(self):
+        text = self.normalized()
         match = Parseable.CITATION_RE.search(text)
         if match is None:
-            return None
+            return False
 
         pre = text[0:match.start(0)]
         paren_depth = pre.count('(') - pre.count(')')
         if paren_depth > 0:
             # Don't find citations in parentheses.
-            return None
+            return False
 
+        normalization_map = self.normalization_map()
         volume = int(match.group('volume').strip())
         original_source = match.group('source').strip()
         source = original_source.replace(' ', '')
-        subdivisions = str(self)[match.end('source'):].strip()
-        return Citation(self, Range.from_match(match, 'cite'), volume, original_source, source, subdivisions)
+        subdivisions = str(self)[normalization_map.original_end(match.end('source')):].strip()
+        citation_range = normalization_map.original_range(Range.from_match(match, 'cite'))
+        return Citation(self, citation_range, volume, original_source, source, subdivisions)
 
 class Subdivisions(object):
     """Parse Bluebook subdivision ranges."""
@@ -369,17 +495,21 @@ class Citation(object):
         return 'Citation({!r})'.format(self.citation)
 
     def find_title(self, extend_front=True):
-        pre_citation = normalize(str(self.full)[:self.citation_range.i])
+        pre_citation_end = self.full.normalization_map().normalized(self.citation_range.i)
+        pre_citation = self.full.normalized()[:pre_citation_end]
         match = Citation.TITLE_RE.search(pre_citation)
         if not match: return None
 
-        title_range = Range.from_match(match, 'title')
-        title = self.full[title_range.slice()]
+        title = self.full.normalized_slice(Range.from_match(match, 'title'))
 
         if extend_front:
             return extend_front_if_formatted(title)
         return title
 
+# What CitationContext.traits found out about a citation sentence. `verdict` is set if the sentence is new (or
+# not) regardless of context; otherwise `late_verdict` applies unless a known hereinafter rules it out.
+CitationTraits = namedtuple('CitationTraits', 'text verdict check_hereinafters hereinafter late_verdict')
+
 class CitationContext(object):
     SIGNAL = Parseable.SIGNAL
     XREF_RE = re.compile(r'^({signal} )?([Ii]nfra|[Ss]upra)'.format(signal=SIGNAL))
@@ -397,39 +527,55 @@ class CitationContext(object):
         word=SOURCE_WORD, signal=SIGNAL
     ))
 
+    DIGIT_RE = re.compile(r'[0-9]')
+
     def __init__(self):
-        self.hereinafters = []
+        self.hereinafters = SubstringMatcher()
 
     def is_new_citation(self, citation, reporters=set()):
-        text = normalize(str(citation).strip())
+        return self.is_new(CitationContext.traits(citation, reporters))
+
+    @staticmethod
+    def traits(citation, reporters=set()):
+        """
+        Everything is_new_citation needs to know about `citation` that doesn't depend on earlier citations.
+        Computing these is the expensive part, and can happen anywhere (e.g. in another process); `is_new`
+        then applies them in document order.
+        """
+
+        text = citation.normalized().strip()
+
+        def verdict(v):
+            return CitationTraits(text, v, False, None, None)
 
         if citation.citation():
-            return True
+            return verdict(True)
 
         if 'on file with' in text:
-            return True
+            return verdict(True)
 
-        if '§' not in text:
+        check_hereinafters = '§' not in text
+        if check_hereinafters:
             # Check for duplicate sources, but not if this is a section-based source like U.S.C.
             if (CitationContext.XREF_RE.match(text)
                     or CitationContext.ID_RE.match(text)
                     or CitationContext.SUPRA_RE.search(text)):
-                return False
-
-            for h in self.hereinafters:
-                if h in text:
-                    return False
+                return verdict(False)
 
         hereinafter_match = CitationContext.HEREINAFTER_RE.search(text)
-        if hereinafter_match:
-            self.hereinafters.append(hereinafter_match.group('hereinafter'))
+        hereinafter = hereinafter_match.group('hereinafter') if hereinafter_match else None
 
+        return CitationTraits(text, None, check_hereinafters, hereinafter,
+                                      CitationContext._late_verdict(citation, text, reporters))
+
+    @staticmethod
+    def _late_verdict(citation, text, reporters):
         short_case_match = CitationContext.SHORT_CASE_RE.search(text)
         if short_case_match and short_case_match.group('source').replace(' ', '') in reporters:
             return False
 
         # Anything with no numbers is definitely not a citation.
-        if not re.search(r'[0-9]', text):
+        if not CitationContext.DIGIT_RE.search(text):
             return False
 
         # If there's an opening signal, it's definitely a citation.
@@ -448,3 +594,21 @@ class CitationContext(object):
             return True
 
         return False
+
+    @staticmethod
+    def may_be_new(traits):
+        """Could a citation with these traits be new, depending on what came before it?"""
+
+        return traits.verdict if traits.verdict is not None else traits.late_verdict
+
+    def is_new(self, traits):
+        if traits.verdict is not None:
+            return traits.verdict
+
+        if traits.check_hereinafters and self.hereinafters.search(traits.text):
+            return False
+
+        if traits.hereinafter is not None:
+            self.hereinafters.add(traits.hereinafter)
+
+        return traits.late_verdict
@@ -1,16 +1,26 @@
 import aiohttp
 import asyncio
-import certifi
+from collections import Counter, deque
 import re
-import ssl
 
+from .client import CircuitOpenError, HttpClient
 from .config import CONFIG
 from .footnotes import Docx
 from .parsing import Parseable
+from .permastore import perma_store_from_config
+from .schedule import TokenBucket
 from .text import Insertion
 
 API_ENDPOINT = 'https://api.perma.cc/v1/archives/batches'
+
+# Batches start at API_CHUNK_SIZE URLs and adapt between 1 and API_MAX_BATCH_SIZE, aiming to come back within
+# API_TARGET_LATENCY seconds (the client gives up after 20). At most API_RATE batches start per second.
 API_CHUNK_SIZE = 8
+API_MAX_BATCH_SIZE = 50
+API_TARGET_LATENCY = 8
+API_RATE = 1
+# Seconds that asynchronous captures get to finish when archiving locally.
+CAPTURE_TIMEOUT = 10 * 60
 
 class SyncSession(aiohttp.ClientSession):
     def __enter__(self):
@@ -30,41 +40,315 @@ def chunks(l, n):
         yield l[i:i + n]
 
 async def make_permas_batch(context, urls):
+    """
+    Submit `urls` as one batch. Returns the batch's id and a dict of URL -> guid for the URLs Perma took on,
+    or None if the batch failed as a whole. Timeouts and connection errors are raised.
+    """
+
     data = { 'urls': urls, 'target_folder': context.folder }
     params = { 'api_key': context.api_key }
 
     print('Starting batch of {}...'.format(len(urls)))
-    try:
-        async with context.session.post(API_ENDPOINT, params=params, json=data) as response:
-            # print('Status: {}; content type: {}.'.format(response.status, response.content_type))
-            if response.status == 201 and response.content_type == 'application/json':
-                batch = await response.json()
-                print('Batch finished.')
-                for job in batch['capture_jobs']:
-                    if job['guid'] is None:
-                        print(job['message'])
-                    else:
-                        context.permas[job['submitted_url']] = 'https://perma.cc/{}'.format(job['guid'])
-    except asyncio.TimeoutError:
-        if len(urls) >= 4:
-            print('Splitting...')
-            mid = len(urls) // 2
-            await asyncio.gather(
-                make_permas_batch(context, urls[:mid]),
-                make_permas_batch(context, urls[mid:]),
-            )
+    async with context.client.post(context.endpoint, params=params, json=data) as response:
+        # print('Status: {}; content type: {}.'.format(response.status, response.content_type))
+        if response.status != 201 or response.content_type != 'application/json':
+            print('Batch failed with status {}.'.format(response.status))
+            return None
+
+        batch = await response.json()
+
+    print('Batch finished.')
+    guids = {}
+    for job in batch['capture_jobs']:
+        if job['guid'] is None:
+            print(job['message'])
+        elif job.get('status') == 'failed':
+            print('Capture of {} failed.'.format(job['submitted_url']))
+        else:
+            guids[job['submitted_url']] = job['guid']
+
+    return batch.get('id'), guids
+
+class PermaBatcher(object):
+    """
+    Sends `urls` to the batch API from `workers` concurrent workers. The batch size adapts to how long
+    batches take: it grows by half while full batches come back within the target latency, shrinks by a
+    quarter when one is slower, and halves when one fails. Batches start no faster than the context's rate
+    allows (a TokenBucket).
+
+    A failed batch's URLs go back to the front of the queue, so they're retried in the smaller batches that
+    follow; a URL is given up on after MAX_ATTEMPTS tries. `futures` has a future for each URL that's done
+    once we've captured it or given up on it.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, context, urls, workers=5):
+        self.context = context
+        self.queue = deque(urls)
+        self.attempts = Counter()
+        self.workers = workers
+        self.batch_size = context.batch_size
+
+        loop = asyncio.get_event_loop()
+        self.futures = { url: loop.create_future() for url in urls }
+        self.in_flight = 0
+        self.changed = asyncio.Event()
+        self.starting = asyncio.Lock()
+
+        self.batches = 0
+        self.failures = 0
+        self.given_up = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def settle(self, url):
+        if not self.futures[url].done():
+            self.futures[url].set_result(url)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self.started_at = loop.time()
+        try:
+            await asyncio.gather(*(self.work() for _ in range(self.workers)))
+        finally:
+            self.finished_at = loop.time()
+            for url in self.futures:
+                self.settle(url)
+
+    async def work(self):
+        while self.queue or self.in_flight:
+            if not self.queue:
+                # Whatever's in flight may fail and come back to the queue.
+                self.changed.clear()
+                await self.changed.wait()
+                continue
+
+            # One worker at a time waits for a token, and only once it knows there's a batch to spend it on:
+            # idle workers would otherwise take tokens the CapturePoller's polls need.
+            async with self.starting:
+                if not self.queue:
+                    continue
+
+                await self.context.bucket.acquire()
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                self.in_flight += 1
+
+            try:
+                await self.send(batch)
+            finally:
+                self.in_flight -= 1
+                self.changed.set()
+
+    async def send(self, batch):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            result = await make_permas_batch(self.context, batch)
+        except CircuitOpenError as e:
+            # Perma has been failing; the batch was never sent, so it doesn't count as an attempt.
+            print(e)
+            self.queue.extendleft(reversed(batch))
+            await asyncio.sleep(self.context.client.cooldown)
+            return
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print('Batch of {} failed: {}'.format(len(batch), str(e) or type(e).__name__))
+            result = None
+
+        self.batches += 1
+        self.adapt(len(batch), result is not None, loop.time() - start)
+        if result is None:
+            self.failures += 1
+            self.retry(batch)
+            return
+
+        batch_id, guids = result
+        self.context.add_permas(guids)
+        if self.context.poller is not None:
+            self.context.poller.watch(batch_id, guids)
+        elif self.context.store is not None:
+            self.context.store.put_many(guids)
+        for url in batch:
+            self.settle(url)
+
+    def adapt(self, size, ok, latency):
+        # Shrinking goes by the size of the batch that struggled, so batches that were sent together don't
+        # all shrink it again.
+        if not ok:
+            self.batch_size = min(self.batch_size, max(1, size // 2))
+        elif latency > self.context.target_latency:
+            self.batch_size = min(self.batch_size, max(1, size - max(1, size // 4)))
+        elif size >= self.batch_size:
+            self.batch_size = min(self.context.max_batch_size, self.batch_size + max(1, self.batch_size // 2))
+
+    def retry(self, batch):
+        for url in reversed(batch):
+            self.attempts[url] += 1
+            if self.attempts[url] < PermaBatcher.MAX_ATTEMPTS:
+                self.queue.appendleft(url)
+            else:
+                print('Giving up on {}.'.format(url))
+                self.given_up += 1
+                self.settle(url)
+
+    def summary(self):
+        urls = len(self.futures) - self.given_up
+        elapsed = (self.finished_at or asyncio.get_event_loop().time()) - self.started_at
+        return 'Perma: {} URLs in {} batches ({} failed, {} URLs given up) in {:.1f}s, {:.0f} URLs/minute.'.format(
+            urls, self.batches, self.failures, self.given_up, elapsed, 60 * urls / elapsed if elapsed else 0)
+
+class CapturePoller(object):
+    """
+    Follows captures Perma is still working on, for asynchronous capture. Every `interval` seconds it asks
+    for the status of each batch with unfinished capture jobs, at most `concurrency` requests at a time and
+    within the context's rate. Completed captures go into the store. Failed ones are taken out of
+    `context.permas`, since their links wouldn't work, and listed in `failed`; so are the unfinished captures
+    of a batch whose status can't be had MAX_POLL_FAILURES times in a row.
+    """
+
+    INTERVAL = 2
+    CONCURRENCY = 2
+    MAX_POLL_FAILURES = 5
+    # Perma is still working on these; any status but these and 'completed' (e.g. 'failed', 'invalid') is final.
+    UNFINISHED_STATUSES = ['pending', 'in_progress']
+
+    def __init__(self, context, interval=INTERVAL, concurrency=CONCURRENCY):
+        self.context = context
+        self.interval = interval
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        # Batch id -> { URL: guid } for capture jobs that haven't finished.
+        self.pending = {}
+        self.poll_failures = Counter()
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+        self.completed = 0
+        self.failed = []
+
+    def watch(self, batch_id, guids):
+        if guids:
+            self.pending.setdefault(batch_id, {}).update(guids)
+            self.idle.clear()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await asyncio.gather(*(self.poll(batch_id) for batch_id in list(self.pending)))
+            if not self.pending:
+                self.idle.set()
+
+    async def poll(self, batch_id):
+        context = self.context
+        async with self.semaphore:
+            await context.bucket.acquire()
+            try:
+                async with context.client.get('{}/{}'.format(context.endpoint, batch_id),
+                                              params={ 'api_key': context.api_key }) as response:
+                    if response.status != 200:
+                        print('Checking batch {} failed with status {}.'.format(batch_id, response.status))
+                        self.poll_failed(batch_id)
+                        return
+                    batch = await response.json()
+            except CircuitOpenError as e:
+                # Perma has been failing; the poll was never sent, so it doesn't count against the batch.
+                print(e)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print('Checking batch {} failed: {}'.format(batch_id, str(e) or type(e).__name__))
+                self.poll_failed(batch_id)
+                return
+
+        jobs = self.pending.get(batch_id)
+        if jobs is None:
+            # Given up on while we waited.
+            return
+
+        del self.poll_failures[batch_id]
+        completed = {}
+        for job in batch['capture_jobs']:
+            url = job['submitted_url']
+            if url not in jobs:
+                continue
+
+            status = job.get('status')
+            if status == 'completed':
+                completed[url] = jobs.pop(url)
+            elif status not in CapturePoller.UNFINISHED_STATUSES:
+                print('Capture of {} failed with status {}.'.format(url, status))
+                del jobs[url]
+                self.fail(url)
+
+        self.completed += len(completed)
+        if completed and context.store is not None:
+            context.store.put_many(completed)
+        if not jobs:
+            del self.pending[batch_id]
+
+    def fail(self, url):
+        self.context.permas.pop(url, None)
+        self.failed.append(url)
+
+    def poll_failed(self, batch_id):
+        if batch_id not in self.pending:
+            return
+
+        self.poll_failures[batch_id] += 1
+        if self.poll_failures[batch_id] >= CapturePoller.MAX_POLL_FAILURES:
+            print('Giving up on batch {}.'.format(batch_id))
+            self.give_up(batch_id)
+
+    def give_up(self, batch_id=None):
+        """Count the unfinished captures of batch `batch_id`, or of every batch, as failed."""
+
+        for batch_id in [batch_id] if batch_id is not None else list(self.pending):
+            del self.poll_failures[batch_id]
+            for url in self.pending.pop(batch_id, {}):
+                self.fail(url)
+
+        if not self.pending:
+            self.idle.set()
+
+    def summary(self):
+        unfinished = sum(len(jobs) for jobs in self.pending.values())
+        return 'Captures: {} completed, {} failed, {} unfinished.'.format(self.completed, len(self.failed), unfinished)
 
 def make_permas_futures(context):
+    """
+    Start archiving the context's URLs. Returns a future for each distinct URL, done once it has a link in
+    `context.permas` or we've given up on it. With asynchronous capture, that's as soon as Perma gives us
+    its guid; wait_for_captures() waits for the captures themselves.
+    """
+
     url_strs_unfiltered = [url.normalized() for url in context.all_urls]
 
     # Perma is broken for washingtonpost.com for some reason!
     url_strs = [url for url in url_strs_unfiltered if '//perma.cc' not in url and 'washingtonpost.com' not in url]
+    # The same link is often cited in several footnotes.
+    url_strs = list(dict.fromkeys(url_strs))
+
+    # Links we made on an earlier run don't need archiving again.
+    if context.store is not None:
+        stored = context.store.get_many(url_strs)
+        context.add_permas(stored)
+        url_strs = [url for url in url_strs if url not in stored]
+        print('Reusing {} stored Perma links.'.format(len(stored)))
+
     print('Making permas for {} URLs.'.format(len(url_strs)))
+    if not url_strs:
+        return []
 
-    return [make_permas_batch(context, chunk) for chunk in chunks(url_strs, API_CHUNK_SIZE)]
+    context.batcher = PermaBatcher(context, url_strs, workers=context.limit)
+    context.batcher_task = asyncio.ensure_future(context.batcher.run())
+    if context.asynchronous:
+        context.poller = CapturePoller(context)
+        context.poller_task = asyncio.ensure_future(context.poller.run())
+    return list(context.batcher.futures.values())
 
 class PermaContext(object):
-    def __init__(self, all_urls, api_key=None, folder=None, limit=5, timeout=20):
+    def __init__(self, all_urls, api_key=None, folder=None, limit=5, timeout=20, client=None, store=None,
+                 endpoint=None, batch_size=API_CHUNK_SIZE, max_batch_size=API_MAX_BATCH_SIZE,
+                 target_latency=API_TARGET_LATENCY, rate=API_RATE, asynchronous=None):
         if folder is None:
             print('No folder supplied!')
             folder = CONFIG['perma']['folder_id']
@@ -76,36 +360,96 @@ class PermaContext(object):
         self.all_urls = all_urls
         self.api_key = api_key
         self.folder = folder
+        self.endpoint = endpoint or API_ENDPOINT
+        self.limit = limit
+
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        # Shared by batches and polls.
+        self.bucket = TokenBucket(rate, burst=limit)
+        self.batcher = None
+        self.batcher_task = None
 
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        connector = aiohttp.TCPConnector(ssl_context=ssl_context, limit=limit)
-        timeout_obj = aiohttp.ClientTimeout(total=timeout)
-        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout_obj)
+        # Asynchronous capture: take the guids from each batch as soon as Perma answers, and follow the
+        # captures with a CapturePoller, instead of expecting them to be done by then.
+        if asynchronous is None:
+            asynchronous = CONFIG['perma'].get('asynchronous', False)
+        self.asynchronous = asynchronous
+        self.poller = None
+        self.poller_task = None
+
+        # A client passed in (e.g. kept warm between Lambda invocations) is left open for its owner.
+        self.client = client if client is not None else PermaContext.make_client(limit, timeout)
+        self.owns_client = client is None
+        # A PermaStore; like the client, it's left open for whoever passed it in.
+        self.store = store
         self.permas = {}
 
+    def add_permas(self, guids):
+        for url, guid in guids.items():
+            self.permas[url] = 'https://perma.cc/{}'.format(guid)
+
+    async def wait_for_captures(self, timeout=None):
+        """
+        Wait, for at most `timeout` seconds, until every URL has been submitted and, with asynchronous capture,
+        every capture has finished. Returns whether they all did.
+        """
+
+        async def finished():
+            if self.batcher_task is not None:
+                await asyncio.shield(self.batcher_task)
+            if self.poller is not None:
+                await self.poller.idle.wait()
+
+        try:
+            await asyncio.wait_for(finished(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    @staticmethod
+    def make_client(limit=5, timeout=20):
+        return HttpClient(limit=limit, limit_per_host=limit, timeout=aiohttp.ClientTimeout(total=timeout))
+
     async def __aenter__(self):
-        await self.session.__aenter__()
         return self
 
     async def __aexit__(self, *args):
-        return await self.session.__aexit__(*args)
+        # Stop archiving whatever we didn't wait for, e.g. when a Lambda runs out of time.
+        if self.batcher_task is not None:
+            self.batcher_task.cancel()
+            await asyncio.wait([self.batcher_task])
+            print(self.batcher.summary())
+        if self.poller_task is not None:
+            self.poller_task.cancel()
+            await asyncio.wait([self.poller_task])
+            print(self.poller.summary())
+
+        if self.owns_client:
+            await self.client.close()
+        print('Hosts:\n{}'.format(self.client.summary()))
 
-async def make_permas_co(urls, api_key, folder):
-    async with PermaContext(urls, api_key=api_key, folder=folder) as context:
+async def make_permas_co(urls, api_key, folder, store=None, capture_timeout=CAPTURE_TIMEOUT, **context_args):
+    async with PermaContext(urls, api_key=api_key, folder=folder, store=store, **context_args) as context:
         await asyncio.gather(*make_permas_futures(context))
+        # Running locally, there's no hurry: leave out links whose captures fail, or are still going by then.
+        if not await context.wait_for_captures(capture_timeout) and context.poller is not None:
+            context.poller.give_up()
         return context.permas
 
-def make_permas(urls, api_key=None, folder=None):
-    return run(make_permas_co(urls, api_key, folder))
+def make_permas(urls, api_key=None, folder=None, store=None, capture_timeout=CAPTURE_TIMEOUT):
+    return run(make_permas_co(urls, api_key, folder, store, capture_timeout))
 
 def collect_urls(footnotes):
+    """The links in `footnotes` that aren't already followed by a Perma link, in one pass over each footnote."""
+
     for fn in footnotes:
         parsed = Parseable(fn.text_refs())
-        links = parsed.links()
-        for span, url in links:
-            rest = parsed[span.j:]
-            rest_str = str(rest)
-            if not PERMA_RE.match(rest_str):
+        text = str(parsed)
+        for span, url in parsed.links():
+            # Match in place rather than slicing off the rest of the footnote for every link.
+            if not PERMA_RE.match(text, span.j):
                 yield url
 
 def generate_insertions(urls, permas):
@@ -115,11 +459,11 @@ def generate_insertions(urls, permas):
             yield url.insert_after(' [{}]'.format(permas[url_str]))
 
 PERMA_RE = re.compile(r'[^A-Za-z0-9]*(https?://)?perma.cc')
-def apply_docx(docx):
+def apply_docx(docx, store=None):
     footnotes = docx.footnote_list
     urls = list(collect_urls(footnotes))
 
-    permas = make_permas(urls)
+    permas = make_permas(urls, store=store)
     # print(permas)
     insertions = generate_insertions(urls, permas)
 
@@ -129,7 +473,15 @@ def apply_docx(docx):
     print('Removing hyperlinks.')
     footnotes.remove_hyperlinks()
 
+    if store is not None:
+        print(store.summary())
+
 def apply_file(file_or_obj, out_filename):
-    with Docx(file_or_obj) as docx:
-        apply_docx(docx)
-        docx.write(out_filename)
+    store = perma_store_from_config()
+    try:
+        with Docx(file_or_obj) as docx:
+            apply_docx(docx, store)
+            docx.write(out_filename)
+    finally:
+        if store is not None:
+            store.close()
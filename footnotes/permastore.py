@@ -0,0 +1,156 @@
+"""
+Persistent store of the Perma links we've made, so re-running perma on a revised draft only archives links
+that are new since last time.
+
+Links are keyed by normalized URL and remember when they were captured. With a `max_age`, older links are
+ignored, so their URLs get captured afresh.
+"""
+
+import os
+from os.path import exists
+import sqlite3
+import time
+
+from .cache import normalize_url
+from .config import CONFIG
+
+class PermaStore(object):
+    """
+    Interface for Perma link stores. Subclasses keep links somewhere (e.g. a local SQLite database) by
+    implementing lookup and save; normalizing URLs, applying the max age and counting links reused and newly
+    captured happens here.
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self.hits = 0
+        self.captures = 0
+
+    def lookup(self, keys):
+        """Dict of normalized URL -> (guid, captured_at) for whichever of `keys` we have."""
+        raise NotImplementedError
+
+    def save(self, records):
+        """Store `records`, a list of (normalized URL, guid, captured_at)."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def summary(self):
+        return 'Perma links: {} reused, {} newly captured.'.format(self.hits, self.captures)
+
+    def get_many(self, urls):
+        """Dict of URL -> guid for each of `urls` with a link that isn't too old."""
+
+        keys = { url: normalize_url(url) for url in urls }
+        records = self.lookup(sorted(set(keys.values())))
+        now = time.time()
+
+        result = {}
+        for url, key in keys.items():
+            if key not in records:
+                continue
+
+            guid, captured_at = records[key]
+            if self.max_age is None or now - captured_at <= self.max_age:
+                result[url] = guid
+
+        self.hits += len(result)
+        return result
+
+    def put_many(self, guids):
+        """Store `guids`, a dict of URL -> guid, as captured now."""
+
+        now = time.time()
+        self.captures += len(guids)
+        self.save([(normalize_url(url), guid, now) for url, guid in guids.items()])
+
+class SqlitePermaStore(PermaStore):
+    """
+    A PermaStore in a SQLite database at `path`. SQLite takes care of locking, so several processes (e.g.
+    two apply_perma runs) can share one database.
+    """
+
+    # Most variables SQLite allows in one statement, on older builds.
+    MAX_VARIABLES = 999
+
+    def __init__(self, path, max_age=None):
+        super().__init__(max_age)
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=30)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS permas '
+                '(url TEXT PRIMARY KEY, guid TEXT NOT NULL, captured_at REAL NOT NULL)')
+
+    def lookup(self, keys):
+        records = {}
+        for i in range(0, len(keys), SqlitePermaStore.MAX_VARIABLES):
+            chunk = keys[i:i + SqlitePermaStore.MAX_VARIABLES]
+            rows = self.connection.execute(
+                'SELECT url, guid, captured_at FROM permas WHERE url IN ({})'.format(', '.join('?' * len(chunk))),
+                chunk)
+            for url, guid, captured_at in rows:
+                records[url] = guid, captured_at
+
+        return records
+
+    def save(self, records):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO permas VALUES (?, ?, ?)', records)
+
+    def close(self):
+        # Closing the last connection folds the WAL back into the database file.
+        self.connection.close()
+
+class SyncedPermaStore(SqlitePermaStore):
+    """
+    A SqlitePermaStore whose database is kept under `key` in an ObjectStore (e.g. S3, for Lambda) and worked
+    on in a copy at local `path`. On close, the links we made are merged into the latest stored copy rather
+    than replacing it, so jobs running side by side keep each other's links; one that's lost to a race is
+    just captured again next time.
+    """
+
+    def __init__(self, object_store, key, path, max_age=None):
+        self.object_store = object_store
+        self.key = key
+        if exists(path):
+            os.remove(path)
+        object_store.download(key, path)
+
+        super().__init__(path, max_age)
+        self.saved = []
+
+    def save(self, records):
+        super().save(records)
+        self.saved.extend(records)
+
+    def close(self):
+        super().close()
+        try:
+            if not self.saved:
+                return
+
+            latest_path = self.path + '.latest'
+            if self.object_store.download(self.key, latest_path):
+                latest = SqlitePermaStore(latest_path)
+                latest.save(self.saved)
+                latest.close()
+                self.object_store.upload(latest_path, self.key)
+                os.remove(latest_path)
+            else:
+                self.object_store.upload(self.path, self.key)
+        finally:
+            os.remove(self.path)
+
+def perma_store_from_config():
+    """The Perma link store described by the optional "perma_store" section of the config, if any."""
+
+    if 'perma_store' not in CONFIG:
+        return None
+
+    config = CONFIG['perma_store']
+    max_age_days = config.get('max_age_days')
+    return SqlitePermaStore(config['path'], max_age_days * 24 * 60 * 60 if max_age_days else None)
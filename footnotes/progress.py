@@ -0,0 +1,167 @@
+"""
+Progress messages for the web app, sent to the job's SQS queue without holding up the work they report on.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+
+class ProgressReporter(object):
+    """
+    Use as `async with ProgressReporter(queue, fields) as reporter:`, then call `reporter.update(done, total)`
+    as often as you like. Updates only record the latest numbers; a background task sends them from its own
+    thread, so a slow SQS round trip never blocks the event loop.
+
+    Progress is coalesced: an update is sent once `interval` seconds have passed since the last one, or
+    sooner if it moved by at least `min_step` of the total or finished the job, and never if nothing changed.
+    Other messages go out through `post(body)`, after any progress recorded before them. When several
+    messages are waiting they're sent together with send_message_batch. Every message includes `fields`
+    (e.g. job_id and file_uuid).
+    """
+
+    # SQS takes at most this many messages per batch.
+    BATCH_SIZE = 10
+
+    def __init__(self, queue, fields, interval=1.0, min_step=0.05):
+        self.queue = queue
+        self.fields = fields
+        self.interval = interval
+        self.min_step = min_step
+
+        self.outbox = []
+        self.pending = None
+        self.sent = None
+        self.last_sent_at = None
+        self.closed = False
+
+        self.wake = None
+        self.sender = None
+        self.executor = None
+
+    async def __aenter__(self):
+        self.wake = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.sender = asyncio.ensure_future(self.send_messages())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Send whatever is still waiting, then stop."""
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self.wake.set()
+        await self.sender
+        self.executor.shutdown()
+
+    def update(self, progress, total):
+        self.pending = progress, total
+        if self.wake is not None:
+            self.wake.set()
+
+    def post(self, body):
+        # Otherwise the coalesced update could go out after e.g. 'complete'.
+        if self.pending is not None and self.pending != self.sent:
+            self.outbox.append(self._progress_message(time.monotonic()))
+        self.outbox.append(dict(self.fields, **body))
+        if self.wake is not None:
+            self.wake.set()
+
+    def _progress_due(self, now):
+        if self.pending is None or self.pending == self.sent:
+            return False
+
+        if self.closed or self.sent is None:
+            return True
+
+        progress, total = self.pending
+        if progress >= total or now - self.last_sent_at >= self.interval:
+            return True
+
+        return abs(progress - self.sent[0]) >= self.min_step * total
+
+    def _next_batch(self, now):
+        batch = self.outbox[:ProgressReporter.BATCH_SIZE]
+        del self.outbox[:ProgressReporter.BATCH_SIZE]
+
+        if len(batch) < ProgressReporter.BATCH_SIZE and self._progress_due(now):
+            batch.append(self._progress_message(now))
+
+        return batch
+
+    def _progress_message(self, now):
+        progress, total = self.pending
+        self.sent = self.pending
+        self.last_sent_at = now
+        return dict(self.fields, message='progress', progress=progress, total=total)
+
+    def _wait_time(self, now):
+        """Seconds until the pending update is due on its own, or None if there's nothing to wait for."""
+
+        if self.pending is None or self.pending == self.sent or self.sent is None:
+            return None
+
+        return max(0, self.last_sent_at + self.interval - now)
+
+    async def send_messages(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = self._next_batch(time.monotonic())
+            if batch:
+                try:
+                    await loop.run_in_executor(self.executor, self._send, batch)
+                except Exception as e:
+                    print('Failed to send progress: {}'.format(e))
+                continue
+
+            if self.closed:
+                return
+
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(self.wake.wait(), self._wait_time(time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+
+    def _send(self, batch):
+        if len(batch) == 1:
+            self.queue.send_message(MessageBody=json.dumps(batch[0]))
+            return
+
+        response = self.queue.send_message_batch(Entries=[
+            { 'Id': str(i), 'MessageBody': json.dumps(body) } for i, body in enumerate(batch)
+        ])
+        for failure in response.get('Failed', []):
+            print('Failed to send message {}: {}'.format(failure['Id'], failure.get('Message')))
+
+class FakeQueue(object):
+    """
+    Stands in for an SQS Queue when testing: each send takes `latency` seconds, and `messages` records
+    (monotonic time, message) for everything sent.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.messages = []
+        self.calls = 0
+
+    def _record(self, body):
+        self.messages.append((time.monotonic(), json.loads(body)))
+
+    def send_message(self, MessageBody):
+        self.calls += 1
+        time.sleep(self.latency)
+        self._record(MessageBody)
+        return { 'MessageId': str(len(self.messages)) }
+
+    def send_message_batch(self, Entries):
+        self.calls += 1
+        time.sleep(self.latency)
+        for entry in Entries:
+            self._record(entry['MessageBody'])
+        return { 'Successful': [{ 'Id': entry['Id'] } for entry in Entries], 'Failed': [] }
@@ -1,20 +1,23 @@
-import aiohttp
 import asyncio
-import certifi
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from itertools import chain
-import json
 import mimetypes
-from os.path import basename, dirname, join
+from os.path import abspath, basename, dirname, join
 import re
-import ssl
-import sys
-from urllib.parse import urlencode
+import shutil
+import tempfile
+from urllib.parse import urlencode, urlsplit
 import zipfile
 
+from footnotes.cache import DownloadCache, normalize_url
+from footnotes.checkpoint import Checkpoint
 from footnotes.config import CONFIG
-from footnotes.footnotes import Docx
-from footnotes.parsing import abbreviations, CitationContext, normalize, Parseable, Subdivisions
-from footnotes.spreadsheet import Spreadsheet
+from footnotes.footnotes import Docx, FootnoteData
+from footnotes.parsing import CitationContext, normalize, Parseable, Subdivisions
+from footnotes import reference
+from footnotes.schedule import Scheduler
 
 def dprint(*args, **kwargs):
     if 'mode' in CONFIG and CONFIG['mode'] == 'development':
@@ -23,23 +26,6 @@ def dprint(*args, **kwargs):
         except UnicodeEncodeError:
             pass  # print(*(filter(lambda c: c in string.printable, s) for s in args), **kwargs)
 
-with open(join(sys.path[0], 'reporters-db', 'reporters_db', 'data', 'reporters.json')) as f:
-    reporters_json = json.load(f)
-    reporters_infos = chain.from_iterable(reporters_json.values())
-    reporters_variants = chain.from_iterable(info['variations'].items() for info in reporters_infos)
-    reporters_spaces = set(chain.from_iterable(reporters_variants))
-    reporters = set(r.replace(' ', '') for r in reporters_spaces)
-
-    # This is a weird special case.
-    reporters.remove('Tex.L.Rev.')
-    reporters.remove('TexasL.Rev.')
-
-    reporters.add('WL')
-    reporters.add('U.S.Dist.LEXIS')
-    reporters.add('U.S.App.LEXIS')
-
-    reporters_noperiods=set(r.replace('.', '') for r in reporters)
-
 class PullInfo(object):
     def __init__(self, first_fn, second_fn, citation, citation_type='',
                  source='', pulled='', puller='', human_link='',
@@ -73,185 +59,516 @@ def short_title(title):
 # These links work if they don't return 404.
 # Unfortunately, some news orgs don't return 404 when accessing invalid link.
 WHITELIST = ['nytimes.com/', 'npr.org/', 'vox.com/', 'whitehouse.gov/', 'cnn.com/']
-async def download_file_check(context, url, pull_info):
-    try:
-        async with context.session.head(url, allow_redirects=True) as response:
-            dprint('Checking link [{}]: {}'.format(url, response.content_type))
-            if response.status in [200, 201]:
-                if (response.content_type == 'application/pdf'
-                        or any(site in url for site in WHITELIST)):
-                    pull_info.pulled = 'Link works'
-    except Exception: pass
 
-async def download_file_zip(context, url, name, pull_info):
-    buf = bytearray()
-    try:
-        async with context.session.get(url) as response:
-            dprint('{} downloading [{}] -> [{}]...'.format(response.status, url, name))
-            if response.status not in [200, 201]:
-                return
+# HEAD responses that don't tell us whether a link is a PDF, so we look at the first bytes instead.
+HEAD_UNSUPPORTED_STATUSES = [403, 405, 501]
+# Responses that mean the link is broken. Other failures (429, 5xx, a 403 from a bot wall) may only mean the
+# server is having a bad minute, so they don't settle anything.
+BROKEN_STATUSES = [404, 410]
+AMBIGUOUS_CONTENT_TYPES = ['application/octet-stream', 'binary/octet-stream', 'application/download',
+                           'application/x-download', 'application/force-download']
+PROBE_SIZE = 2048
+HTML_SIGNATURES = [b'<!doctype html', b'<html', b'<head', b'<body']
+
+def sniff(data):
+    """'pdf' or 'html' from the first bytes of a response body, or None."""
+
+    # PDF readers accept the header anywhere in the first 1024 bytes.
+    if b'%PDF-' in data[:1024]:
+        return 'pdf'
+
+    start = data.lstrip(b'\xef\xbb\xbf \t\r\n')[:32].lower()
+    if any(start.startswith(signature) for signature in HTML_SIGNATURES):
+        return 'html'
+
+    return None
+
+def failed_status_verdict(status):
+    """Verdict for a link that answered with failing `status`: False if it's broken, None if we can't tell."""
+
+    return False if status in BROKEN_STATUSES else None
+
+async def probe_link(context, url, whitelisted):
+    """Does `url` work? Fetches only the first PROBE_SIZE bytes, even if the server ignores the Range."""
+
+    headers = { 'Range': 'bytes=0-{}'.format(PROBE_SIZE - 1) }
+    async with context.client.get(url, headers=headers) as response:
+        dprint('Probing link [{}]: {}'.format(url, response.status))
+        if response.status not in [200, 206]:
+            return failed_status_verdict(response.status)
+        if whitelisted:
+            return True
+
+        data = b''
+        while len(data) < PROBE_SIZE:
+            chunk = await response.content.read(PROBE_SIZE - len(data))
+            if not chunk:
+                break
+            data += chunk
+
+        return sniff(data) == 'pdf'
+
+async def check_link(context, url):
+    """
+    Does `url` work: is it a PDF, or on a whitelisted site and not broken? None if the server didn't give a
+    definite answer.
+    """
+
+    whitelisted = any(site in url for site in WHITELIST)
+    async with context.client.head(url, allow_redirects=True) as response:
+        dprint('Checking link [{}]: {}'.format(url, response.content_type))
+        if response.status in [200, 201]:
+            if response.content_type == 'application/pdf' or whitelisted:
+                return True
+            if response.content_type not in AMBIGUOUS_CONTENT_TYPES:
+                return False
+        elif response.status not in HEAD_UNSUPPORTED_STATUSES:
+            return failed_status_verdict(response.status)
+
+    return await probe_link(context, url, whitelisted)
 
-            async for data, _ in response.content.iter_chunks():
-                buf += data
+async def download_file_check(context, url, pull_info):
+    cache = context.cache
+    works = cache.get_verdict(url) if cache is not None else None
+    if works is None:
+        try:
+            works = await check_link(context, url)
+        except Exception as e:
+            dprint('Failed to check link [{}]: {}'.format(url, str(e) or type(e).__name__))
+            return
+        # Only remember definite answers; a link that failed for a moment gets checked again next time.
+        if cache is not None and works is not None:
+            cache.put_verdict(url, works)
 
-            if 'octet-stream' not in response.content_type:
-                extension = mimetypes.guess_extension(response.content_type)
-                if not name.endswith(extension):
-                    name += extension
+    if works:
+        pull_info.pulled = 'Link works'
 
-        with context.zipf.open(context.zipfile_prefix + '/' + name, 'w') as f:
-            f.write(buf)
+# Downloads bigger than this are spooled to disk until the zip writer gets to them.
+SPOOL_MEMORY_SIZE = 1024 * 1024
 
+async def download_file_zip(context, url, name, pull_info):
+    cache = context.cache
+    entry = cache.get(url) if cache is not None else None
+
+    spool = None
+    try:
+        while True:
+            headers = DownloadCache.revalidation_headers(entry) if entry is not None else None
+            async with context.client.get(url, headers=headers) as response:
+                dprint('{} downloading [{}] -> [{}]...'.format(response.status, url, name))
+                if entry is not None and response.status == 304:
+                    try:
+                        spool = cache.open(entry)
+                    except OSError as e:
+                        # Evicted since get(), so we have nothing to revalidate; download it outright.
+                        dprint('Cached body for [{}] is gone: {}'.format(url, e))
+                        entry = None
+                        continue
+                    cache.hits += 1
+                    content_type = entry.content_type
+                elif response.status in [200, 201]:
+                    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE)
+                    async for data, _ in response.content.iter_chunks():
+                        spool.write(data)
+                    content_type = response.content_type
+                    validators = response.headers.get('ETag'), response.headers.get('Last-Modified')
+                else:
+                    return
+            break
+
+        if response.status != 304 and cache is not None:
+            cache.misses += 1
+            spool.seek(0)
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, partial(cache.put, url, spool, content_type, *validators))
+            except Exception as e:
+                dprint('Failed to cache [{}]: {}'.format(url, e))
+
+        if 'octet-stream' not in content_type:
+            extension = mimetypes.guess_extension(content_type)
+            if not name.endswith(extension):
+                name += extension
+    except Exception:
+        if spool is not None:
+            spool.close()
+        return
+
+    def written():
         pull_info.pulled = 'Y'
+
+    try:
+        # The zip writer closes the spool from here on.
+        await context.write_zip(name, spool, written)
     except Exception: pass
 
-def pull(context):
+LEGISLATIVE_RE = re.compile(r'S\. ?((Exec\. |Treaty )?Doc|Rept?)\.|H\. ?R\. ((Misc\. )?Doc|Rept?)\.')
+CONSTITUTION_RE = re.compile(r'U\. ?S\. Const(\.|itution)')
+
+def classify(number, idx, sentence):
+    """Build the PullInfo for citation sentence `idx` of footnote `number`."""
+
+    pull_info = PullInfo(first_fn='{}.{}'.format(number, idx + 1), second_fn=None, citation=str(sentence).strip())
+    pull_info.citation_type = 'Other'
+    sentence_text = sentence.normalized().strip()
+
+    links = sentence.link_strs()
+    if links:
+        pull_info.citation_type = 'Link'
+        pull_info.human_link = links[0]
+        if links[0].endswith('.pdf'):
+            pull_info.download_link = pull_info.human_link
+
+    if LEGISLATIVE_RE.search(sentence_text):
+        pull_info.citation_type = 'Legislative History'
+        pull_info.human_link = 'https://congressional.proquest.com/congressional/search/searchbynumber/bynumber?#Bibliographic_Citations'
+
+    if CONSTITUTION_RE.search(sentence_text):
+        pull_info.citation_type = 'Constitution'
+        pull_info.human_link = 'https://www.archives.gov/founding-docs/constitution-transcript'
+        pull_info.download_link = pull_info.human_link
+        pull_info.download_name = 'USConstitution'
+
+    match = sentence.citation()
+    if match:
+        citation_text = match.citation.normalized()
+        short_citation = re.sub(r'[^A-Za-z0-9]', '', citation_text)
+
+        if match.source in reference.reporters():
+            pull_info.citation_type = 'Case'
+        elif match.source in ['Cong.Rec.', 'CongressionalRecord', 'Cong.Globe']:
+            pull_info.citation_type = 'Congress'
+        elif match.source == 'Stat.':
+            pull_info.citation_type = 'Statute'
+        elif match.source in ['Fed.Reg.', 'F.R.']:
+            pull_info.citation_type = 'Administrative'
+        elif re.search(r'Law|Review|Journal|(L|J|Rev|REV)\.', match.source):
+            pull_info.citation_type = 'Journal'
+
+        if match.source in ['USC', 'U.S.C.'] and match.subdivisions.ranges:
+            pull_info.citation_type = 'Code'
+            title = match.volume
+            range_start = match.subdivisions.ranges[0][0]
+            start_match = re.match(Subdivisions.SECTION, range_start)
+            if start_match:
+                section = start_match.group(0)
+                pull_info.human_link = 'https://www.govinfo.gov/link/uscode/{}/{}?{}'.format(title, section, urlencode({
+                    'link-type': 'pdf',
+                    'type': 'usc',
+                    # 'year': CONFIG['govinfo']['uscode_year'],
+                }))
+                pull_info.download_link = pull_info.human_link
+
+        if pull_info.citation_type in ['Congress', 'Journal', 'Statute'] or match.source == 'U.S.':
+            pull_info.human_link = 'https://heinonline.org/HOL/OneBoxCitation?{}'.format(urlencode({ 'cit_string': citation_text }))
+
+        if pull_info.citation_type == 'Journal':
+            title = normalize(str(match.find_title()))
+            pull_info.download_link = CONFIG['pdfapi']['url'] + '/api/articles/{}/{}/{}'.format(match.original_source, match.volume, title)
+            pull_info.download_name = '{}.{}'.format(short_citation, short_title(title))
+
+        if pull_info.citation_type == 'Statute' and match.volume >= 65:
+            page_str = match.subdivisions.ranges[0][0]
+            if page_str and page_str.isdigit():
+                pull_info.download_link = 'https://www.govinfo.gov/link/statute/{}/{}?link-type=pdf'.format(
+                    match.volume, int(page_str)
+                )
+
+        if match.source == 'U.S.':
+            if match.volume < 502:
+                pull_info.download_link = 'https://cdn.loc.gov/service/ll/usrep/usrep{volume:03d}/usrep{volume:03d}{page:03d}/usrep{volume:03d}{page:03d}.pdf'.format(
+                    volume=match.volume, page=int(match.subdivisions.ranges[0][0])
+                )
+            else:
+                pull_info.download_link = CONFIG['pdfapi']['url'] + '/api/cases/{}/{}/{}'.format(
+                    match.source, match.volume, match.subdivisions.ranges[0][0]
+                )
+
+        if pull_info.citation_type == 'Administrative':
+            re_match = re.match(r'(?P<volume>[0-9]+) (F\. ?R\.|Fed\. ?Reg\.) §? ?(?P<page>[0-9,]+)', citation_text)
+            if re_match:
+                volume = int(re_match.group('volume'))
+                page = int(re_match.group('page').replace(',', ''))
+                pull_info.human_link = 'https://www.govinfo.gov/link/fr/{}/{}?{}'.format(volume, page, urlencode({
+                    'link-type': 'pdf',
+                }))
+                pull_info.download_link = pull_info.human_link
+
+        if pull_info.citation_type == 'Case' and not pull_info.human_link:
+            pull_info.human_link = 'https://1.next.westlaw.com/Search/Results.html?{}'.format(urlencode({
+                'query': citation_text,
+                'jurisdiction': 'ALLCASES',
+            }))
+
+        pull_info.source = str(match.citation).strip()
+        if not pull_info.download_name:
+            pull_info.download_name = short_citation
+
+    return pull_info
+
+class Fetch(object):
+    """
+    A download (into the sources zip as `name`) or link check of `url` for `pull_info`, for the Scheduler:
+    `start()` makes the coroutine. `duplicates` are later PullInfos with the same URL; they get this fetch's
+    result from `settle()` instead of fetching it again. `done` is set once the fetch has run to the end,
+    whether or not it worked; fetches that didn't (e.g. timed out) are what a checkpoint resumes.
+    """
+
+    DOWNLOAD, CHECK = 'download', 'check'
+
+    # Priority tiers: direct PDFs from government sites, then other downloads, then speculative link checks.
+    GOVERNMENT_PRIORITY, DOWNLOAD_PRIORITY, CHECK_PRIORITY = range(3)
+
+    DOWNLOAD_TIMEOUT = 90
+    CHECK_TIMEOUT = 20
+
+    def __init__(self, context, kind, url, pull_info, name=None):
+        self.context = context
+        self.kind = kind
+        self.url = url
+        self.pull_info = pull_info
+        self.name = name
+        self.duplicates = []
+        self.done = False
+
+        if kind == Fetch.DOWNLOAD:
+            host = urlsplit(url).hostname or ''
+            self.priority = Fetch.GOVERNMENT_PRIORITY if host.endswith('.gov') else Fetch.DOWNLOAD_PRIORITY
+            self.timeout = Fetch.DOWNLOAD_TIMEOUT
+        else:
+            self.priority = Fetch.CHECK_PRIORITY
+            self.timeout = Fetch.CHECK_TIMEOUT
+
+    def start(self):
+        return self.run()
+
+    async def run(self):
+        if self.kind == Fetch.DOWNLOAD:
+            await download_file_zip(self.context, self.url, self.name, self.pull_info)
+        else:
+            await download_file_check(self.context, self.url, self.pull_info)
+        self.done = True
+
+    def finished(self):
+        # A download can make it into the zip after we stopped waiting for it.
+        return self.done or (self.kind == Fetch.DOWNLOAD and self.pull_info.pulled == 'Y')
+
+    def settle(self):
+        for duplicate in self.duplicates:
+            if self.pull_info.pulled == 'Y':
+                # Only the first citation's copy goes in the zip.
+                duplicate.pulled = 'Y (see {})'.format(self.pull_info.first_fn)
+            else:
+                duplicate.pulled = self.pull_info.pulled
+
+def queue_downloads(context, pull_info, downloads, fetches=None):
+    """
+    Append Fetches to `downloads` that pull or check the source for `pull_info`. `fetches` (a dict shared
+    across calls) coalesces identical URLs: a URL that's already queued isn't fetched again, and the PullInfo
+    gets the earlier fetch's result instead.
+    """
+
+    def queue(kind, url, name=None):
+        key = kind, normalize_url(url)
+        if fetches is not None and key in fetches:
+            fetches[key].duplicates.append(pull_info)
+            return
+
+        fetch = Fetch(context, kind, url, pull_info, name)
+        downloads.append(fetch)
+        if fetches is not None:
+            fetches[key] = fetch
+
+    if context.zipf is not None and pull_info.download_link:
+        if pull_info.download_name:
+            name = '{}.{}'.format(pull_info.first_fn, pull_info.download_name)
+        elif pull_info.download_link.endswith('.pdf'):
+            _, _, last = pull_info.download_link.rpartition('/')
+            name = '{}.{}'.format(pull_info.first_fn, last)
+        else:
+            name = '{}'.format(pull_info.first_fn)
+
+        queue(Fetch.DOWNLOAD, pull_info.download_link, name)
+
+    if (context.client is not None
+            and pull_info.human_link
+            and not pull_info.download_link
+            and 'congressional.proquest.com' not in pull_info.human_link
+            and 'westlaw.com' not in pull_info.human_link
+            and 'heinonline.org' not in pull_info.human_link):
+        # Try to download and mark as "pulled" if it's a PDF.
+        queue(Fetch.CHECK, pull_info.human_link)
+
+ParsedSentence = namedtuple('ParsedSentence', 'text traits pull_info')
+
+def parse_footnotes(footnotes):
+    """
+    The stateless half of pull(): split footnotes into citation sentences and classify them. Returns a
+    (number, [ParsedSentence]) pair for each footnote. `pull_info` is None for sentences that can't be new
+    citations no matter what precedes them.
+    """
+
+    sentence_abbreviations = reference.sentence_abbreviations()
+    reporters = reference.reporters()
+
+    def split(fn):
+        return fn.number, Parseable(fn.text_refs()).citation_sentences(sentence_abbreviations)
+
+    def parse_sentence(number, idx, sentence):
+        traits = CitationContext.traits(sentence, reporters=reporters)
+        pull_info = classify(number, idx, sentence) if CitationContext.may_be_new(traits) else None
+        return ParsedSentence(str(sentence).strip(), traits, pull_info)
+
+    def parse_sentences(number, sentences):
+        return number, [parse_sentence(number, idx, s) for idx, s in enumerate(sentences)]
+
+    # Done with each footnote before looking at the next, so a streaming reader can let it go.
+    return [parse_sentences(*split(fn)) for fn in footnotes if fn.text().strip()]
+
+def parse_footnotes_parallel(footnotes, workers):
+    """parse_footnotes, spread over `workers` processes. Results come back in document order."""
+
+    footnote_data = [FootnoteData.from_footnote(fn) for fn in footnotes]
+    chunk_size = max(1, -(-len(footnote_data) // (workers * 4)))
+    chunks = [footnote_data[i:i + chunk_size] for i in range(0, len(footnote_data), chunk_size)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(parse_footnotes, chunks)
+        return list(chain.from_iterable(results))
+
+def pull(context, workers=None):
     pull_infos = []
     downloads = []
+    fetches = {}
     citation_context = CitationContext()
-    for fn in context.footnotes:
-        if not fn.text().strip(): continue
-
-        parsed = Parseable(fn.text_refs())
-        citation_sentences = parsed.citation_sentences(abbreviations | reporters_spaces)
-        for idx, sentence in enumerate(citation_sentences):
-            dprint('Sentence:', str(sentence).strip())
-            if not citation_context.is_new_citation(sentence, reporters=reporters):
+
+    footnotes = context.footnotes()
+    if workers is not None and workers > 1:
+        parsed_footnotes = parse_footnotes_parallel(footnotes, workers)
+    else:
+        parsed_footnotes = parse_footnotes(footnotes)
+
+    # Sequential pass: whether a citation is new depends on the ones before it (id., supra, hereinafter).
+    for number, sentences in parsed_footnotes:
+        for sentence in sentences:
+            dprint('Sentence:', sentence.text)
+            if not citation_context.is_new(sentence.traits):
                 # print('    skipping')
                 continue
 
-            sentence_text = normalize(str(sentence)).strip()
-
-            pull_info = PullInfo(first_fn='{}.{}'.format(fn.number, idx + 1), second_fn=None, citation=str(sentence).strip())
-            pull_infos.append(pull_info)
-            pull_info.citation_type = 'Other'
+            pull_infos.append(sentence.pull_info)
+            queue_downloads(context, sentence.pull_info, downloads, fetches)
 
-            links = sentence.link_strs()
-            if links:
-                pull_info.citation_type = 'Link'
-                pull_info.human_link = links[0]
-                if links[0].endswith('.pdf'):
-                    pull_info.download_link = pull_info.human_link
+    saved = sum(len(fetch.duplicates) for fetch in fetches.values())
+    if saved:
+        print('Coalesced {} duplicate downloads and link checks.'.format(saved))
 
-            if re.search(r'S\. ?((Exec\. |Treaty )?Doc|Rept?)\.|H\. ?R\. ((Misc\. )?Doc|Rept?)\.', sentence_text):
-                pull_info.citation_type = 'Legislative History'
-                pull_info.human_link = 'https://congressional.proquest.com/congressional/search/searchbynumber/bynumber?#Bibliographic_Citations'
-
-            if re.search(r'U\. ?S\. Const(\.|itution)', sentence_text):
-                pull_info.citation_type = 'Constitution'
-                pull_info.human_link = 'https://www.archives.gov/founding-docs/constitution-transcript'
-                pull_info.download_link = pull_info.human_link
-                pull_info.download_name = 'USConstitution'
-
-            match = sentence.citation()
-            if match:
-                citation_text = normalize(str(match.citation))
-                short_citation = re.sub(r'[^A-Za-z0-9]', '', citation_text)
-
-                if match.source in reporters:
-                    pull_info.citation_type = 'Case'
-                elif match.source in ['Cong.Rec.', 'CongressionalRecord', 'Cong.Globe']:
-                    pull_info.citation_type = 'Congress'
-                elif match.source == 'Stat.':
-                    pull_info.citation_type = 'Statute'
-                elif match.source in ['Fed.Reg.', 'F.R.']:
-                    pull_info.citation_type = 'Administrative'
-                elif re.search(r'Law|Review|Journal|(L|J|Rev|REV)\.', match.source):
-                    pull_info.citation_type = 'Journal'
-
-                if match.source in ['USC', 'U.S.C.'] and match.subdivisions.ranges:
-                    pull_info.citation_type = 'Code'
-                    title = match.volume
-                    range_start = match.subdivisions.ranges[0][0]
-                    start_match = re.match(Subdivisions.SECTION, range_start)
-                    if start_match:
-                        section = start_match.group(0)
-                        pull_info.human_link = 'https://www.govinfo.gov/link/uscode/{}/{}?{}'.format(title, section, urlencode({
-                            'link-type': 'pdf',
-                            'type': 'usc',
-                            # 'year': CONFIG['govinfo']['uscode_year'],
-                        }))
-                        pull_info.download_link = pull_info.human_link
-
-                if pull_info.citation_type in ['Congress', 'Journal', 'Statute'] or match.source == 'U.S.':
-                    pull_info.human_link = 'https://heinonline.org/HOL/OneBoxCitation?{}'.format(urlencode({ 'cit_string': citation_text }))
-
-                if pull_info.citation_type == 'Journal':
-                    title = normalize(str(match.find_title()))
-                    pull_info.download_link = CONFIG['pdfapi']['url'] + '/api/articles/{}/{}/{}'.format(match.original_source, match.volume, title)
-                    pull_info.download_name = '{}.{}'.format(short_citation, short_title(title))
-
-                if pull_info.citation_type == 'Statute' and match.volume >= 65:
-                    page_str = match.subdivisions.ranges[0][0]
-                    if page_str and page_str.isdigit():
-                        pull_info.download_link = 'https://www.govinfo.gov/link/statute/{}/{}?link-type=pdf'.format(
-                            match.volume, int(page_str)
-                        )
-
-                if match.source == 'U.S.':
-                    if match.volume < 502:
-                        pull_info.download_link = 'https://cdn.loc.gov/service/ll/usrep/usrep{volume:03d}/usrep{volume:03d}{page:03d}/usrep{volume:03d}{page:03d}.pdf'.format(
-                            volume=match.volume, page=int(match.subdivisions.ranges[0][0])
-                        )
-                    else:
-                        pull_info.download_link = CONFIG['pdfapi']['url'] + '/api/cases/{}/{}/{}'.format(
-                            match.source, match.volume, match.subdivisions.ranges[0][0]
-                        )
-
-                if pull_info.citation_type == 'Administrative':
-                    re_match = re.match(r'(?P<volume>[0-9]+) (F\. ?R\.|Fed\. ?Reg\.) §? ?(?P<page>[0-9,]+)', citation_text)
-                    if re_match:
-                        volume = int(re_match.group('volume'))
-                        page = int(re_match.group('page').replace(',', ''))
-                        pull_info.human_link = 'https://www.govinfo.gov/link/fr/{}/{}?{}'.format(volume, page, urlencode({
-                            'link-type': 'pdf',
-                        }))
-                        pull_info.download_link = pull_info.human_link
-
-                if pull_info.citation_type == 'Case' and not pull_info.human_link:
-                    pull_info.human_link = 'https://1.next.westlaw.com/Search/Results.html?{}'.format(urlencode({
-                        'query': citation_text,
-                        'jurisdiction': 'ALLCASES',
-                    }))
-
-                pull_info.source = str(match.citation).strip()
-                if not pull_info.download_name:
-                    pull_info.download_name = short_citation
-
-            if context.zipf is not None and pull_info.download_link:
-                if pull_info.download_name:
-                    name = '{}.{}'.format(pull_info.first_fn, pull_info.download_name)
-                elif pull_info.download_link.endswith('.pdf'):
-                    _, _, last = pull_info.download_link.rpartition('/')
-                    name = '{}.{}'.format(pull_info.first_fn, last)
-                else:
-                    name = '{}'.format(pull_info.first_fn)
+    return downloads, pull_infos
 
-                downloads.append(download_file_zip(context, pull_info.download_link, name, pull_info))
+# Time budget for downloads when running locally.
+DOWNLOAD_TIME = 120
 
-            if (context.session is not None
-                    and pull_info.human_link
-                    and not pull_info.download_link
-                    and 'congressional.proquest.com' not in pull_info.human_link
-                    and 'westlaw.com' not in pull_info.human_link
-                    and 'heinonline.org' not in pull_info.human_link):
-                # Try to download and mark as "pulled" if it's a PDF.
-                downloads.append(download_file_check(context, pull_info.human_link, pull_info))
+async def await_downloads(context, downloads, pull_infos, time_left=None, byte_budget=None, progress=None):
+    """
+    Run the Fetches from pull() with a Scheduler, within `time_left` (by default DOWNLOAD_TIME from now) and
+    `byte_budget` bytes of compressed sources. `progress(done, total)` is called as fetches finish.
+    """
 
-    return downloads, pull_infos
+    if time_left is None:
+        time_left = Scheduler.deadline(DOWNLOAD_TIME)
 
-async def await_downloads(downloads, pull_infos):
     print('Trying to download {} sources.'.format(len(downloads)))
     print('Waiting for downloads to complete...')
-    try:
-        await asyncio.wait_for(asyncio.gather(*downloads), 120)
-    except (asyncio.TimeoutError, TimeoutError):
-        print('Timed out.')
+    scheduler = Scheduler(downloads, time_left, byte_budget=byte_budget, bytes_used=context.compressed_size,
+                          progress=progress)
+    await scheduler.run()
+    await context.flush_zip()
+    for fetch in downloads:
+        fetch.settle()
+    print('Downloads: {}'.format(scheduler.summary()))
 
     num_success = len([pi for pi in pull_infos if 'Y' in pi.pulled or 'works' in pi.pulled])
     print('Successfully pulled {} out of {} total sources.'.format(num_success, len(pull_infos)))
+    if context.cache is not None:
+        print(context.cache.summary())
+
+# After this many runs, a pull reports what it has instead of saving another checkpoint.
+MAX_PULL_RUNS = 4
+
+def checkpoint_state(pull_infos, fetches, runs):
+    index = { id(pull_info): i for i, pull_info in enumerate(pull_infos) }
+    return {
+        'runs': runs,
+        'pull_infos': [vars(pull_info) for pull_info in pull_infos],
+        'fetches': [{
+            'kind': fetch.kind,
+            'url': fetch.url,
+            'name': fetch.name,
+            'pull_info': index[id(fetch.pull_info)],
+            'duplicates': [index[id(duplicate)] for duplicate in fetch.duplicates],
+            'done': fetch.finished(),
+        } for fetch in fetches],
+    }
+
+def restore_pull(context, checkpoint):
+    """The (fetches, pull_infos, runs) saved in `checkpoint`, for resuming into `context`'s zip."""
+
+    state = checkpoint.state
+    pull_infos = [PullInfo(**fields) for fields in state['pull_infos']]
+
+    # If the zip didn't survive, its downloads have to be redone.
+    lost = not set(context.zipf.namelist()).issuperset(checkpoint.members)
+    if lost:
+        print('Sources zip from the checkpoint is missing files; downloading them again.')
+
+    fetches = []
+    for record in state['fetches']:
+        fetch = Fetch(context, record['kind'], record['url'], pull_infos[record['pull_info']], record['name'])
+        fetch.duplicates = [pull_infos[i] for i in record['duplicates']]
+        fetch.done = record['done']
+        if lost and fetch.kind == Fetch.DOWNLOAD and fetch.pull_info.pulled == 'Y':
+            fetch.done = False
+            fetch.pull_info.pulled = ''
+        fetches.append(fetch)
+
+    return fetches, pull_infos, state['runs']
+
+async def run_pull(context, checkpoint=None, workers=None, time_left=None, byte_budget=None,
+                   progress=None, shards=None):
+    """
+    pull() and await_downloads(), or pick up where `checkpoint` left off. Returns (pull_infos, checkpoint),
+    where the checkpoint is one to save and resume from if time ran out with fetches left, and otherwise None.
+    With a ShardPool as `shards`, the downloads are fanned out over its workers instead.
+    """
+
+    if checkpoint is None:
+        fetches, pull_infos = pull(context, workers=workers)
+        runs = 1
+    else:
+        fetches, pull_infos, runs = restore_pull(context, checkpoint)
+        runs += 1
+        print('Resuming pull from checkpoint (run {}).'.format(runs))
+
+    remaining = [fetch for fetch in fetches if not fetch.finished()]
+    if shards is not None:
+        await shards.run(context, remaining, pull_infos, time_left=time_left, byte_budget=byte_budget,
+                         progress=progress)
+    else:
+        await await_downloads(context, remaining, pull_infos, time_left=time_left, byte_budget=byte_budget,
+                              progress=progress)
+
+    remaining = [fetch for fetch in remaining if not fetch.finished()]
+    out_of_bytes = byte_budget is not None and context.compressed_size() >= byte_budget
+    if not remaining or out_of_bytes or runs >= MAX_PULL_RUNS:
+        return pull_infos, None
+
+    print('{} downloads and link checks left for the next run.'.format(len(remaining)))
+    return pull_infos, Checkpoint(checkpoint_state(pull_infos, fetches, runs))
 
 def write_spreadsheet(pull_infos, spreadsheet_path):
+    # Imported here so that only callers who write spreadsheets pay for xlsxwriter.
+    from footnotes.spreadsheet import Spreadsheet
+
     def format(workbook, worksheet):
         green = workbook.add_format()
         green.set_bg_color('#d9ead3')
@@ -291,36 +608,123 @@ def add_pullers(pull_infos, pullers):
         pull_info.puller = pullers[int(i * len(pullers) / len(unpulled))]
 
 class PullContext(object):
-    def __init__(self, filename, zipfile_path=None, zipfile_prefix=None):
+    # Spooled files waiting for the zip writer. Downloads wait for room once this many are queued.
+    ZIP_QUEUE_SIZE = 8
+
+    def __init__(self, filename, zipfile_path=None, zipfile_prefix=None, cache=None, append=False, client=None):
         self.filename = filename
+        self.cache = cache
         self.zipfile_path = zipfile_path
+        self.append = append
         self.zipfile_prefix = zipfile_prefix
         if self.zipfile_prefix is None and self.zipfile_path is not None:
             zipfile_base = basename(zipfile_path)
             self.zipfile_prefix = zipfile_base[:-4] if len(zipfile_base) > 4 else 'zip'
-        self.zipf, self.session = None, None
+        # A client passed in (e.g. kept warm between Lambda invocations) is left open for its owner.
+        self.zipf, self.client = None, client
+        self.owns_client = client is None
+        self.zip_queue, self.zip_writer = None, None
+        # Shard workers only download, so they have no document.
+        self.docx = Docx(filename, stream=True) if filename is not None else None
+
+    @staticmethod
+    def make_client():
+        # Imported here: aiohttp is most of the cost of importing this module, and not every pull downloads.
+        from footnotes.client import HttpClient
+        return HttpClient(limit=20, headers={ 'User-Agent': 'Autopull' })
+
+    def footnotes(self):
+        """Stream footnotes from the document, dropping each once the next is read."""
 
-        with Docx(filename) as docx:
-            self.footnotes = docx.footnote_list
+        return self.docx.iter_footnotes(read_only=True)
 
     async def __aenter__(self):
+        if self.docx is not None:
+            self.docx.__enter__()
         if self.zipfile_path:
-            self.zipf = zipfile.ZipFile(self.zipfile_path, 'w').__enter__()
-            ssl_context = ssl.create_default_context(cafile=certifi.where())
-            connector = aiohttp.TCPConnector(ssl_context=ssl_context, limit=20)
-            self.session = aiohttp.ClientSession(connector=connector, headers={ 'User-Agent': 'Autopull' })
+            self.zipf = zipfile.ZipFile(self.zipfile_path, 'a' if self.append else 'w').__enter__()
+            if self.client is None:
+                self.client = PullContext.make_client()
+            self.zip_queue = asyncio.Queue(maxsize=PullContext.ZIP_QUEUE_SIZE)
+            self.zip_writer = asyncio.ensure_future(self.write_zip_members())
 
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.docx is not None:
+            self.docx.__exit__(exc_type, exc_value, traceback)
         if self.zipfile_path:
+            await self.zip_queue.put(None)
+            await self.zip_writer
             self.zipf.close()
-            await self.session.close()
+            if self.owns_client:
+                await self.client.close()
+            print('Hosts:\n{}'.format(self.client.summary()))
+        if self.cache is not None:
+            self.cache.close()
+
+    async def write_zip(self, name, f, written=None):
+        """
+        Add file object `f` to the sources zip as `name`, through the zip writer, and wait until it's written.
+        Closes `f`. `written()` is called once it's in the zip, even if we stopped waiting in the meantime.
+        """
+
+        done = asyncio.get_event_loop().create_future()
+        try:
+            await self.zip_queue.put((name, f, done, written))
+        except BaseException:
+            f.close()
+            raise
+
+        await done
+
+    async def write_zip_members(self):
+        """
+        The only thing that writes to the sources zip while downloads are running. Members are written one at
+        a time on an executor thread so that the event loop keeps serving other downloads.
+        """
+
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await self.zip_queue.get()
+            if item is None:
+                self.zip_queue.task_done()
+                return
+
+            name, f, done, written = item
+            try:
+                # Skip downloads that were cancelled (e.g. timed out) while queued.
+                if done.cancelled():
+                    continue
+                await loop.run_in_executor(None, self._write_zip_member, name, f)
+            except Exception as e:
+                if not done.cancelled():
+                    done.set_exception(e)
+            else:
+                if written is not None:
+                    written()
+                if not done.cancelled():
+                    done.set_result(None)
+            finally:
+                f.close()
+                self.zip_queue.task_done()
+
+    async def flush_zip(self):
+        """Wait for the zip writer to finish everything queued so far."""
+
+        if self.zip_queue is not None:
+            await self.zip_queue.join()
+
+    def _write_zip_member(self, name, f):
+        f.seek(0)
+        with self.zipf.open(self.zipfile_prefix + '/' + name, 'w') as out:
+            shutil.copyfileobj(f, out)
 
     def compressed_size(self):
         return sum(zipinfo.compress_size for zipinfo in self.zipf.infolist()) if self.zipf else 0
 
-async def pull_local_co(filename, pull_sources=True):
+async def pull_local_co(filename, pull_sources=True, workers=None, cache=None,
+                        checkpoint_store=None, time_budget=None, shards=None):
     in_name = basename(filename)
     if not in_name.endswith('.docx'):
         in_name += '.docx'
@@ -330,12 +734,29 @@ async def pull_local_co(filename, pull_sources=True):
     zipfile_name = 'BookpullSources.{}.zip'.format(in_name[:-5])
     zipfile_path = join(dirname(filename), zipfile_name)
 
-    async with PullContext(filename, zipfile_path if pull_sources else None) as context:
-        downloads, pull_infos = pull(context)
-        await await_downloads(downloads, pull_infos)
+    checkpoint = None
+    if pull_sources and checkpoint_store is not None:
+        with open(filename, 'rb') as f:
+            document = Checkpoint.document_key(abspath(filename), f)
+        checkpoint = Checkpoint.load(checkpoint_store, zipfile_path, document)
+
+    time_left = Scheduler.deadline(time_budget) if time_budget is not None else None
+    async with PullContext(filename, zipfile_path if pull_sources else None, cache=cache,
+                           append=checkpoint is not None) as context:
+        pull_infos, checkpoint = await run_pull(context, checkpoint, workers=workers,
+                                                time_left=time_left, shards=shards)
         print('Sources pulled at {}.'.format(zipfile_name))
         write_spreadsheet(pull_infos, spreadsheet_path)
 
-def pull_local(filename, pull_sources=True):
+    if pull_sources and checkpoint_store is not None:
+        if checkpoint is not None:
+            checkpoint.save(checkpoint_store, zipfile_path, document)
+            print('Saved checkpoint; run again to resume the remaining downloads.')
+        else:
+            Checkpoint.clear(checkpoint_store, document)
+
+def pull_local(filename, pull_sources=True, workers=None, cache=None, checkpoint_store=None,
+               time_budget=None, shards=None):
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(pull_local_co(filename, pull_sources))
+    loop.run_until_complete(pull_local_co(filename, pull_sources, workers, cache, checkpoint_store,
+                                          time_budget, shards))
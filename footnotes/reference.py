@@ -0,0 +1,165 @@
+"""
+Reference data used to recognize citations: legal abbreviations (abbreviations.txt) and reporter names
+(reporters-db's reporters.json).
+
+Parsing those sources costs a noticeable part of every cold start, so `python build_reference.py` compiles
+them into a pickle next to this file. Nothing is loaded until first use; at that point we use the compiled
+index if it was built from the sources we can see, and otherwise fall back to reading the sources directly.
+"""
+
+import hashlib
+from itertools import chain
+import json
+import os
+from os.path import abspath, dirname, exists, join
+import pickle
+import sys
+
+# Bump when the layout of the compiled index changes.
+FORMAT_VERSION = 2
+
+INDEX_PATH = join(dirname(__file__), 'reference.pickle')
+ABBREVIATIONS_PATH = join(dirname(__file__), 'abbreviations.txt')
+REPORTERS_RELATIVE_PATH = join('reporters-db', 'reporters_db', 'data', 'reporters.json')
+
+def reporters_path():
+    # Relative to the source tree, or to the executable in a frozen build.
+    candidates = [dirname(dirname(abspath(__file__))), dirname(abspath(sys.argv[0] or '.')), sys.path[0]]
+    for root in candidates:
+        path = join(root, REPORTERS_RELATIVE_PATH)
+        if exists(path):
+            return path
+
+    return None
+
+def _digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _source_paths():
+    return {
+        'abbreviations': ABBREVIATIONS_PATH if exists(ABBREVIATIONS_PATH) else None,
+        'reporters': reporters_path(),
+    }
+
+def _source_stamps():
+    """Size, mtime and digest of each source we can find, to tell later whether the index is stale."""
+
+    stamps = {}
+    for name, path in _source_paths().items():
+        if path is not None:
+            stat = os.stat(path)
+            stamps[name] = { 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': _digest(path) }
+    return stamps
+
+def _is_current(stamp, path):
+    """Whether the source at `path` is still the one `stamp` describes. Only hashes it if it looks modified."""
+
+    if stamp is None:
+        return False
+
+    stat = os.stat(path)
+    if stat.st_size == stamp['size'] and stat.st_mtime_ns == stamp['mtime']:
+        return True
+
+    # E.g. a fresh checkout: new mtime, same contents.
+    return stat.st_size == stamp['size'] and _digest(path) == stamp['sha1']
+
+def _read_abbreviations():
+    with open(ABBREVIATIONS_PATH, encoding='utf-8') as f:
+        def generate_abbreviations():
+            for line in f:
+                if line.startswith('#'): continue
+                line = line.strip().replace(',', '')
+                for word in line.split(' '):
+                    if word and word.endswith('.'):
+                        yield word
+
+        return frozenset(generate_abbreviations())
+
+def _read_reporters():
+    with open(reporters_path()) as f:
+        reporters_json = json.load(f)
+
+    reporters_infos = chain.from_iterable(reporters_json.values())
+    reporters_variants = chain.from_iterable(info['variations'].items() for info in reporters_infos)
+    reporters_spaces = set(chain.from_iterable(reporters_variants))
+    reporters = set(r.replace(' ', '') for r in reporters_spaces)
+
+    # This is a weird special case.
+    reporters.remove('Tex.L.Rev.')
+    reporters.remove('TexasL.Rev.')
+
+    reporters.add('WL')
+    reporters.add('U.S.Dist.LEXIS')
+    reporters.add('U.S.App.LEXIS')
+
+    return frozenset(reporters_spaces), frozenset(reporters)
+
+def compile_sources():
+    abbreviations = _read_abbreviations()
+    reporters_spaces, reporters = _read_reporters()
+
+    return {
+        'version': FORMAT_VERSION,
+        'sources': _source_stamps(),
+        'abbreviations': abbreviations,
+        'reporters': reporters,
+        'reporters_spaces': reporters_spaces,
+        'sentence_abbreviations': abbreviations | reporters_spaces,
+    }
+
+def build(path=INDEX_PATH):
+    index = compile_sources()
+    with open(path, 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return index
+
+def _load_compiled(path=INDEX_PATH):
+    """The compiled index at `path`, or None if it is missing, unreadable or out of date."""
+
+    try:
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+
+    if not isinstance(index, dict) or index.get('version') != FORMAT_VERSION:
+        return None
+
+    # Sources we can't find (e.g. a deployment that only ships the index) don't make it stale.
+    for name, source_path in _source_paths().items():
+        if source_path is not None and not _is_current(index['sources'].get(name), source_path):
+            return None
+
+    return index
+
+_index = None
+
+def index():
+    global _index
+    if _index is None:
+        _index = _load_compiled()
+        if _index is None:
+            print("Reference index missing or stale; reading sources.")
+            _index = compile_sources()
+
+        print("Found {} abbreviations.".format(len(_index['abbreviations'])))
+
+    return _index
+
+def abbreviations():
+    return index()['abbreviations']
+
+def reporters():
+    """Reporter abbreviations with spaces removed, e.g. 'F.Supp.2d'."""
+    return index()['reporters']
+
+def reporters_spaces():
+    """Reporter abbreviations as written, e.g. 'F. Supp. 2d'."""
+    return index()['reporters_spaces']
+
+def sentence_abbreviations():
+    """Everything that can end in a period without ending a sentence."""
+    return index()['sentence_abbreviations']
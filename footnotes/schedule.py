@@ -0,0 +1,100 @@
+import asyncio
+from collections import deque
+import time
+
+class Scheduler(object):
+    """
+    Runs jobs, at most `concurrency` at a time, lowest `priority` first (ties in the order given), within a
+    time budget and a byte budget. A job is any object with a `priority`, a `timeout` in seconds and a
+    `start()` that returns a coroutine; nothing is started until it is scheduled.
+
+    `time_left()` returns the seconds remaining. No job starts with less than MIN_START_TIME left, each gets
+    at most its timeout or whatever time is left, and jobs still running when time runs out or `bytes_used()`
+    passes `byte_budget` are cancelled. Jobs never started are counted as skipped.
+    """
+
+    MIN_START_TIME = 1
+    PROGRESS_INTERVAL = 0.2
+
+    def __init__(self, jobs, time_left, byte_budget=None, bytes_used=None, concurrency=20, progress=None):
+        self.jobs = sorted(jobs, key=lambda job: job.priority)
+        self.time_left = time_left
+        self.byte_budget = byte_budget
+        self.bytes_used = bytes_used
+        self.concurrency = concurrency
+        self.progress = progress
+
+        self.finished = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.skipped = 0
+
+    @staticmethod
+    def deadline(seconds):
+        """A time_left function for a deadline `seconds` from now."""
+
+        end = time.monotonic() + seconds
+        return lambda: end - time.monotonic()
+
+    def over_budget(self):
+        return (self.time_left() <= 0
+                or (self.byte_budget is not None and self.bytes_used() >= self.byte_budget))
+
+    def can_start(self):
+        return self.time_left() > Scheduler.MIN_START_TIME and not self.over_budget()
+
+    async def run_job(self, job):
+        try:
+            await asyncio.wait_for(job.start(), min(job.timeout, self.time_left()))
+            self.finished += 1
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+
+    async def run(self):
+        queue = deque(self.jobs)
+        running = set()
+        total = len(queue)
+
+        while queue or running:
+            while queue and len(running) < self.concurrency and self.can_start():
+                running.add(asyncio.ensure_future(self.run_job(queue.popleft())))
+
+            if not running or self.over_budget():
+                break
+
+            _, running = await asyncio.wait(running, timeout=Scheduler.PROGRESS_INTERVAL,
+                                            return_when=asyncio.FIRST_COMPLETED)
+            if self.progress is not None:
+                self.progress(total - len(queue) - len(running), total)
+
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.wait(running)
+
+        self.cancelled = len(running)
+        self.skipped = len(queue)
+
+    def summary(self):
+        return '{} finished, {} timed out, {} cancelled, {} never started.'.format(
+            self.finished, self.timed_out, self.cancelled, self.skipped)
+
+class TokenBucket(object):
+    """Rate limit: `acquire()` lets through `rate` callers per second on average, in bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
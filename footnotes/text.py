@@ -1,7 +1,10 @@
 from collections import defaultdict
+import copy
 from enum import Enum
 import re
 
+import lxml.etree as ET
+
 class Range(object):
     def __init__(self, i, j):
         self.i = i
@@ -47,24 +50,24 @@ class Range(object):
 
 Location = Enum('Location', 'TEXT TAIL')
 
-def _str_insert(original, offset, fragment):
-    return ''.join((original[:offset], fragment, original[offset:]))
-
-class Insertion(object):
-    """An object representing inserting `s` into text of `element` at `offset`."""
+class Edit(object):
+    """
+    A change to the text/tail (`location`) of `element`: the text in `range` becomes `s`. Edits are meant to
+    be made in batches with apply_all(), with every range in terms of the text before any of them.
+    """
 
-    def __init__(self, element, location, offset, s):
+    def __init__(self, element, location, range, s):
         self.element = element
         self.location = location
-        self.offset = offset
+        self.range = range
         self.s = s
 
     def __str__(self):
         return repr(self)
 
     def __repr__(self):
-        return 'Insertion({!r}, {!r}, {!r}, {!r})'.format(
-            self.element, self.location, self.offset, self.s
+        return '{}({!r}, {!r}, {!r}, {!r})'.format(
+            type(self).__name__, self.element, self.location, self.range, self.s
         )
 
     def _fulltext(self):
@@ -76,23 +79,181 @@ class Insertion(object):
         else:
             self.element.tail = s
 
-    def apply(self, additional_offset=0):
-        self._set_fulltext(_str_insert(self._fulltext(), self.offset + additional_offset, self.s))
+    def _output(self, text):
+        """What our range turns into, given the original text."""
+
+        return self.s
+
+    def _restructure(self, start, end):
+        """Change the XML around our output, now at [`start`, `end`) of the new text. Most edits don't."""
+
+        pass
+
+    def apply(self):
+        Edit.apply_all([self])
 
     @staticmethod
-    def apply_all(insertions):
-        # First, group by element and location. Multiple insertions to the same element disrupt offset math.
+    def apply_all(edits):
+        """
+        Make `edits`. Each text/tail is rebuilt once, from the untouched stretches and the edits' output in
+        order. Edits to the same text mustn't overlap, though several insertions can share an offset (they
+        go in in the order given) and ranges can share an end point; ValueError otherwise, with nothing in
+        that text changed.
+        """
+
         grouped = defaultdict(lambda: [])
-        for i in insertions:
-            key = i.element, i.location
-            grouped[key].append(i)
+        for edit in edits:
+            grouped[edit.element, edit.location].append(edit)
+
+        for group in grouped.values():
+            Edit._apply_group(group)
+
+    @staticmethod
+    def _apply_group(group):
+        # Sorting is stable, and puts insertions before a range that starts at the same offset.
+        group.sort(key=lambda edit: (edit.range.i, edit.range.j))
+        text = group[0]._fulltext()
+
+        fragments = []
+        placed = []
+        position = 0
+        length = 0
+        for edit in group:
+            if not 0 <= edit.range.i <= edit.range.j <= len(text):
+                raise ValueError('{!r} is out of range for text of length {}.'.format(edit, len(text)))
+            if edit.range.i < position:
+                raise ValueError('{!r} overlaps an earlier edit.'.format(edit))
+
+            output = edit._output(text)
+            fragments.append(text[position:edit.range.i])
+            length += edit.range.i - position
+            fragments.append(output)
+            placed.append((edit, length, length + len(output)))
+            length += len(output)
+            position = edit.range.j
+
+        fragments.append(text[position:])
+        group[0]._set_fulltext(''.join(fragments))
+
+        # Right to left, so restructuring never moves text that edits further left refer to.
+        for edit, start, end in reversed(placed):
+            edit._restructure(start, end)
+
+class Insertion(Edit):
+    """An object representing inserting `s` into text of `element` at `offset`."""
 
-        for key, group in grouped.items():
-            group.sort(key=lambda i: i.offset)
-            accumulated_offset = 0
-            for i in group:
-                i.apply(accumulated_offset)
-                accumulated_offset += len(i.s)
+    def __init__(self, element, location, offset, s):
+        super().__init__(element, location, Range(offset, offset), s)
+
+    @property
+    def offset(self):
+        return self.range.i
+
+    def __repr__(self):
+        return 'Insertion({!r}, {!r}, {!r}, {!r})'.format(
+            self.element, self.location, self.offset, self.s
+        )
+
+class Replacement(Edit):
+    """Replace the text in `range` with `s`."""
+
+class Deletion(Edit):
+    """Remove the text in `range`."""
+
+    def __init__(self, element, location, range):
+        super().__init__(element, location, range, '')
+
+class RunWrap(Edit):
+    """
+    Give the text in `range` a run of its own, e.g. to format it differently. `element` has to be a <w:t>
+    in a <w:r>; the run is split in up to three, each with a copy of its properties, and `properties` (tags,
+    like w:i) are added to those of the middle one. The text itself doesn't change.
+    """
+
+    XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+    # <w:rPr>'s children have to come in this order (CT_RPr in ECMA-376 Part 1, 17.3.2.28); Word refuses
+    # documents where they don't. Anything not listed, like w:rPrChange, comes last.
+    RPR_ORDER = { name: i for i, name in enumerate((
+        'rStyle rFonts b bCs i iCs caps smallCaps strike dstrike outline shadow emboss imprint noProof snapToGrid '
+        'vanish webHidden color spacing w kern position sz szCs highlight u effect bdr shd fitText vertAlign rtl '
+        'cs em lang eastAsianLayout specVanish oMath').split()) }
+
+    def __init__(self, element, location, range, properties=()):
+        super().__init__(element, location, range, None)
+        self.properties = list(properties)
+
+        namespace = ET.QName(element).namespace
+        parent = element.getparent()
+        if location != Location.TEXT or parent is None or parent.tag != '{{{}}}r'.format(namespace):
+            raise ValueError('Can only wrap the text of an element in a run.')
+        if len(range) == 0:
+            raise ValueError('Nothing to wrap.')
+
+    def __repr__(self):
+        return 'RunWrap({!r}, {!r}, {!r}, {!r})'.format(self.element, self.location, self.range, self.properties)
+
+    def _output(self, text):
+        return text[self.range.slice()]
+
+    def _tag(self, name):
+        return '{{{}}}{}'.format(ET.QName(self.element).namespace, name)
+
+    def _set_text(self, text_elem, text):
+        text_elem.text = text
+        if text != text.strip():
+            text_elem.set(RunWrap.XML_SPACE, 'preserve')
+
+    def _new_run(self, run, text, properties=()):
+        new_run = run.makeelement(self._tag('r'), {})
+        props = run.find(self._tag('rPr'))
+        if props is not None or properties:
+            new_props = copy.deepcopy(props) if props is not None else run.makeelement(self._tag('rPr'), {})
+            for tag in properties:
+                if new_props.find(tag) is None:
+                    self._add_property(new_props, run.makeelement(tag, {}))
+            new_run.append(new_props)
+
+        if text:
+            text_elem = run.makeelement(self._tag('t'), {})
+            self._set_text(text_elem, text)
+            new_run.append(text_elem)
+
+        return new_run
+
+    def _add_property(self, props, prop):
+        """Add `prop` to `props`, a <w:rPr>, where CT_RPr has it."""
+
+        order = RunWrap.RPR_ORDER
+        position = order.get(ET.QName(prop).localname, len(order))
+        for child in props.iterchildren(ET.Element):
+            if order.get(ET.QName(child).localname, len(order)) > position:
+                child.addprevious(prop)
+                return
+
+        props.append(prop)
+
+    def _restructure(self, start, end):
+        text_elem = self.element
+        run = text_elem.getparent()
+        text = text_elem.text or ''
+
+        middle = self._new_run(run, text[start:end], self.properties)
+        after = self._new_run(run, text[end:])
+        for sibling in list(text_elem.itersiblings()):
+            after.append(sibling)
+
+        parent = run.getparent()
+        index = parent.index(run)
+        parent.insert(index + 1, middle)
+        if len(after) > (1 if after.find(self._tag('rPr')) is not None else 0):
+            parent.insert(index + 2, after)
+
+        if start > 0:
+            self._set_text(text_elem, text[:start])
+        else:
+            run.remove(text_elem)
+            if len(run) == (1 if run.find(self._tag('rPr')) is not None else 0):
+                parent.remove(run)
 
 class TextRef(object):
     """A slice of the text/tail (`location`) of `element`."""
@@ -144,3 +305,18 @@ class TextRef(object):
         """
         assert 0 <= offset and offset <= len(self)
         return Insertion(self.element, self.location, self.range.i + offset, s)
+
+    def _full_range(self, start, stop):
+        assert 0 <= start <= stop <= len(self)
+        return Range(self.range.i + start, self.range.i + stop)
+
+    def replace(self, start, stop, s):
+        """Make an Edit replacing [`start`, `stop`) of this ref with `s`."""
+        return Replacement(self.element, self.location, self._full_range(start, stop), s)
+
+    def delete(self, start, stop):
+        return Deletion(self.element, self.location, self._full_range(start, stop))
+
+    def wrap(self, start, stop, properties=()):
+        """Make an Edit giving [`start`, `stop`) of this ref a run of its own; see RunWrap."""
+        return RunWrap(self.element, self.location, self._full_range(start, stop), properties)
@@ -0,0 +1,162 @@
+"""
+Streaming uploads: a write-only file object that sends what's written to an object store in parts while it's
+still being written. A result (e.g. the sources zip) then never has to fit on local disk, and uploading it
+overlaps with producing it.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+from os.path import dirname, exists, join
+import shutil
+import tempfile
+
+class MultipartUpload(object):
+    """
+    Interface for the store's side of a MultipartWriter, shaped like an S3 multipart upload. `upload_part`
+    runs on background threads and returns whatever `complete` needs to know about the part.
+    """
+
+    def start(self):
+        raise NotImplementedError
+
+    def upload_part(self, number, data):
+        raise NotImplementedError
+
+    def complete(self, parts):
+        raise NotImplementedError
+
+    def abort(self):
+        raise NotImplementedError
+
+class LocalMultipartUpload(MultipartUpload):
+    """
+    Stands in for an S3 multipart upload to `path`: parts are kept in a temporary directory, and the file only
+    appears, whole, on complete(). Like S3, it refuses parts other than the last smaller than MIN_PART_SIZE.
+    """
+
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.directory = None
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(dir=dirname(self.path) or '.', suffix='.parts')
+
+    def upload_part(self, number, data):
+        part_path = join(self.directory, str(number))
+        with open(part_path, 'wb') as f:
+            f.write(data)
+
+        return number, len(data)
+
+    def complete(self, parts):
+        for _, size in parts[:-1]:
+            if size < LocalMultipartUpload.MIN_PART_SIZE:
+                raise ValueError('Part of {} bytes is too small.'.format(size))
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as out:
+            for number, _ in parts:
+                with open(join(self.directory, str(number)), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+
+        os.replace(temp_path, self.path)
+        shutil.rmtree(self.directory)
+
+    def abort(self):
+        if self.directory is not None and exists(self.directory):
+            shutil.rmtree(self.directory)
+
+class MultipartWriter(io.RawIOBase):
+    """
+    A write-only, unseekable file object (ZipFile copes by writing data descriptors) that feeds `upload`.
+    Writes are buffered into parts of `part_size` bytes, each uploaded on a background thread with at most
+    `max_pending` in flight, so writing only waits when uploads fall behind. Closing uploads the rest and
+    completes the upload. Leaving a `with` block by an exception aborts it instead, as does abort().
+    """
+
+    # S3 parts, other than the last, have to be at least 5 MB.
+    PART_SIZE = 8 * 1024 * 1024
+    MAX_PENDING = 4
+
+    def __init__(self, upload, part_size=PART_SIZE, max_pending=MAX_PENDING):
+        super().__init__()
+        self.upload = upload
+        self.part_size = part_size
+        self.max_pending = max_pending
+
+        self.buffer = bytearray()
+        self.position = 0
+        self.parts = []
+        self.aborted = False
+        self.executor = ThreadPoolExecutor(max_workers=max_pending)
+        upload.start()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError('Write to closed upload.')
+
+        data = memoryview(b).cast('B')
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._send(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+        return len(data)
+
+    def _send(self, data):
+        for part in self.parts:
+            if part.done() and part.exception() is not None:
+                raise part.exception()
+
+        in_flight = [part for part in self.parts if not part.done()]
+        if len(in_flight) >= self.max_pending:
+            in_flight[0].result()
+
+        self.parts.append(self.executor.submit(self.upload.upload_part, len(self.parts) + 1, data))
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if not self.aborted:
+                # There has to be at least one part, even if it's empty.
+                if self.buffer or not self.parts:
+                    self._send(bytes(self.buffer))
+                    self.buffer = bytearray()
+                self.upload.complete([part.result() for part in self.parts])
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+            super().close()
+
+    def abort(self):
+        if self.aborted:
+            return
+
+        self.aborted = True
+        self.executor.shutdown()
+        self.upload.abort()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        self.close()
+
+    def __del__(self):
+        # Never complete an upload that was abandoned halfway.
+        if not self.closed:
+            self.abort()
+            super().close()
@@ -1,41 +1,206 @@
 import asyncio
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 from io import BytesIO
 import json
 import os
-from os.path import join
+from os.path import exists, join, splitext
 import tempfile
 from urllib.parse import unquote
 import random
 
-from footnotes.footnotes import Docx
-from footnotes.perma import collect_urls, generate_insertions, make_permas_futures, PermaContext
-from footnotes.pull import add_pullers, pull as pull_sources, PullContext, write_spreadsheet
-from footnotes.text import Insertion
+# Only what every handler needs is imported up front; perma and bluebook import the rest themselves, so e.g.
+# handler.bluebook never loads aiohttp.
+from footnotes.cache import cache_from_config
+from footnotes.checkpoint import Checkpoint, ObjectStore
+from footnotes.fanout import run_shard, ShardPool
+from footnotes.progress import ProgressReporter
+from footnotes.pull import add_pullers, PullContext, run_pull, write_spreadsheet
+from footnotes.upload import MultipartUpload, MultipartWriter
 
-from bluebook.highlight_doc import highlight_doc
+RESULTS_BUCKET = os.getenv('RESULTS_BUCKET', 'autopull-results')
 
-async def track_tasks(job_context, futures, last_skip=0, check=lambda: True):
+# Fan pull downloads out over this many worker invocations. 0 or 1 downloads everything in one invocation.
+PULL_SHARDS = int(os.getenv('PULL_SHARDS', '0'))
+
+# Stream results to S3 as they're written instead of building them in /tmp and uploading them at the end.
+# Streamed pulls can't be checkpointed, so they always finish in one invocation.
+STREAM_RESULTS = os.getenv('STREAM_RESULTS', '') == 'true'
+
+# Perma links older than this many days are captured again instead of reused. 0 reuses them forever.
+PERMA_MAX_AGE_DAYS = float(os.getenv('PERMA_MAX_AGE_DAYS', '0'))
+
+# Write the perma'd document as soon as Perma hands out the links, and follow the captures afterwards.
+PERMA_ASYNC_CAPTURE = os.getenv('PERMA_ASYNC_CAPTURE', '') == 'true'
+
+class Runtime(object):
+    """
+    Clients kept between invocations in a warm container. AWS resources and clients last as long as the
+    container; HTTP clients are bound to an event loop, so they're re-created once theirs is gone.
+    """
+
+    AWS_CLIENT_CONFIGS = {
+        # Shard invocations block until the worker finishes, and must not be retried behind our back.
+        'lambda': Config(read_timeout=900, retries={ 'max_attempts': 0 }),
+    }
+
+    def __init__(self):
+        self.aws_resources = {}
+        self.aws_clients = {}
+        self.http_clients = {}
+
+    def aws_resource(self, name):
+        if name not in self.aws_resources:
+            self.aws_resources[name] = boto3.resource(name)
+
+        return self.aws_resources[name]
+
+    def aws_client(self, name):
+        if name not in self.aws_clients:
+            self.aws_clients[name] = boto3.client(name, config=Runtime.AWS_CLIENT_CONFIGS.get(name))
+
+        return self.aws_clients[name]
+
+    def http_client(self, name, make_client):
+        client = self.http_clients.get(name)
+        if client is None or not client.usable():
+            client = self.http_clients[name] = make_client()
+        else:
+            client.reset_stats()
+
+        return client
+
+RUNTIME = Runtime()
+
+async def track_tasks(reporter, futures, last_skip=0, check=lambda: True):
     total = len(futures)
     pending = futures
     while len(pending) > last_skip and check():
-        job_context.queue.send_message(MessageBody=json.dumps({
-            'message': 'progress',
-            'progress': total - len(pending),
-            'total': max(len(pending), total - last_skip),
-            'job_id': job_context.job_id,
-            'file_uuid': job_context.file_uuid,
-        }))
+        reporter.update(total - len(pending), max(len(pending), total - last_skip))
         done, pending = await asyncio.wait(pending, timeout=0.2)
 
     return pending
 
+class S3MultipartUpload(MultipartUpload):
+    def __init__(self, client, bucket_name, key, **upload_args):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.upload_args = upload_args
+        self.upload_id = None
+
+    def start(self):
+        response = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key, **self.upload_args)
+        self.upload_id = response['UploadId']
+
+    def upload_part(self, number, data):
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=number, Body=data)
+        return { 'PartNumber': number, 'ETag': response['ETag'] }
+
+    def complete(self, parts):
+        self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={ 'Parts': parts })
+
+    def abort(self):
+        self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+
+class S3ObjectStore(ObjectStore):
+    """
+    An ObjectStore under `prefix` in an S3 bucket. Goes through the bucket's client rather than the resource,
+    since stores are used from executor threads and only clients are thread-safe.
+    """
+
+    def __init__(self, bucket, prefix):
+        self.client = bucket.meta.client
+        self.bucket_name = bucket.name
+        self.prefix = prefix
+
+    def get_bytes(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket_name, Key=self.prefix + key)['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+                return None
+            raise
+
+    def put_bytes(self, key, data):
+        self.client.put_object(Bucket=self.bucket_name, Key=self.prefix + key, Body=data)
+
+    def download(self, key, path):
+        try:
+            self.client.download_file(self.bucket_name, self.prefix + key, path)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+                return False
+            raise
+
+    def upload(self, path, key):
+        self.client.upload_file(path, self.bucket_name, self.prefix + key)
+
+    def open_writer(self, key, **upload_args):
+        return MultipartWriter(S3MultipartUpload(self.client, self.bucket_name, self.prefix + key, **upload_args))
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket_name, Key=self.prefix + key)
+
+class LambdaShardPool(ShardPool):
+    """
+    Runs each shard in its own invocation of `function_name` (with a "shard" event, see pull_shard_co), passing
+    states and zips through `store`.
+    """
+
+    def __init__(self, shards, store, function_name):
+        super().__init__(shards)
+        self.store = store
+        self.function_name = function_name
+        # Invocations block until the worker finishes, so don't time out before it does.
+        self.lambda_client = RUNTIME.aws_client('lambda')
+        self.executor = ThreadPoolExecutor(max_workers=shards)
+
+    async def run_shard(self, index, state, zipfile_path, zipfile_prefix, time_budget, byte_budget):
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, self.invoke, index, state, zipfile_path, zipfile_prefix, time_budget, byte_budget)
+
+    def invoke(self, index, state, zipfile_path, zipfile_prefix, time_budget, byte_budget):
+        key = 'shard{}'.format(index)
+        self.store.put_bytes(key + '.json', json.dumps(state).encode('utf-8'))
+        try:
+            response = self.lambda_client.invoke(
+                FunctionName=self.function_name,
+                InvocationType='RequestResponse',
+                Payload=json.dumps({ 'shard': {
+                    'prefix': self.store.prefix,
+                    'key': key,
+                    'zipfile_prefix': zipfile_prefix,
+                    'time_budget': time_budget,
+                    'byte_budget': byte_budget,
+                } }).encode('utf-8'),
+            )
+            if 'FunctionError' in response:
+                raise RuntimeError(response['Payload'].read().decode('utf-8'))
+
+            result = json.loads(self.store.get_bytes(key + '.result.json').decode('utf-8'))
+            if not self.store.download(key + '.zip', zipfile_path):
+                raise RuntimeError('Shard {} has no zip.'.format(index))
+
+            return result
+        finally:
+            for suffix in ['.json', '.result.json', '.zip']:
+                self.store.delete(key + suffix)
+
 class JobContext(object):
     def __init__(self, event):
         self.event = event
+        # Set when we're a follow-up invocation picking up a job from its checkpoint.
+        self.resumed = event.get('resume', False)
 
-        self.s3 = boto3.resource('s3')
-        self.sqs = boto3.resource('sqs')
+        self.s3 = RUNTIME.aws_resource('s3')
+        self.sqs = RUNTIME.aws_resource('sqs')
 
         s3_info = self.event['Records'][0]['s3']
         bucket_name = s3_info['bucket']['name']
@@ -56,35 +221,97 @@ class JobContext(object):
 
         self.queue = self.sqs.Queue(self.queue_url)
 
-        self.queue.send_message(MessageBody=json.dumps({
-            'message': 'start',
-            'job_id': self.job_id,
-            'file_uuid': self.file_uuid,
-        }))
+        self.results_bucket = self.s3.Bucket(RESULTS_BUCKET)
+
+        # Every message about the job goes through the reporter, so none of them blocks on SQS.
+        self.reporter = ProgressReporter(self.queue, { 'job_id': self.job_id, 'file_uuid': self.file_uuid })
 
         self.stream = BytesIO(body.read())
 
+    async def __aenter__(self):
+        await self.reporter.__aenter__()
+        if not self.resumed:
+            self.reporter.post({ 'message': 'start' })
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # Waits for the messages still queued, e.g. 'complete'.
+        await self.reporter.close()
+
     def temp_path(self, extension):
         return join(tempfile.gettempdir(), self.file_uuid + extension)
 
+    def checkpoint_store(self, kind):
+        return S3ObjectStore(self.results_bucket, 'checkpoints/{}/{}/'.format(kind, self.file_uuid))
+
+    def resume(self, lambda_context):
+        """Invoke this function again on the same event, to resume from the job's checkpoint."""
+
+        print('Resuming in a new invocation.')
+        RUNTIME.aws_client('lambda').invoke(
+            FunctionName=lambda_context.function_name,
+            InvocationType='Event',
+            Payload=json.dumps(dict(self.event, resume=True)).encode('utf-8'),
+        )
+
+    def result_url(self, bucket_key):
+        return 'https://s3.amazonaws.com/{}/{}'.format(self.results_bucket.name, bucket_key)
+
     def upload_file(self, path, bucket_key, content_type):
-        out_bucket_name = os.getenv('RESULTS_BUCKET', 'autopull-results')
-        result_url = 'https://s3.amazonaws.com/{}/{}'.format(out_bucket_name, bucket_key)
+        result_url = self.result_url(bucket_key)
         print('Uploading file to {}...'.format(result_url))
 
-        out_bucket = self.s3.Bucket(out_bucket_name)
-        out_bucket.upload_file(path, bucket_key, ExtraArgs={
+        self.results_bucket.upload_file(path, bucket_key, ExtraArgs={
             'ACL': 'public-read',
             'ContentType': content_type,
         })
 
-        self.queue.send_message(MessageBody=json.dumps({
+        self.complete(result_url)
+
+    @contextmanager
+    def result_writer(self, bucket_key, content_type):
+        """
+        A file object that streams a result to the results bucket as it's written. The job is complete when
+        the block exits; if it raises, the upload is abandoned.
+        """
+
+        result_url = self.result_url(bucket_key)
+        print('Streaming file to {}...'.format(result_url))
+
+        store = S3ObjectStore(self.results_bucket, '')
+        with store.open_writer(bucket_key, ACL='public-read', ContentType=content_type) as f:
+            yield f
+
+        self.complete(result_url)
+
+    @contextmanager
+    def result_file(self, bucket_key, content_type):
+        """
+        A binary file object for the job's result: streamed with result_writer() if STREAM_RESULTS is set, and
+        otherwise a temporary file that's uploaded when the block exits.
+        """
+
+        if STREAM_RESULTS:
+            with self.result_writer(bucket_key, content_type) as f:
+                yield f
+            return
+
+        _, extension = splitext(bucket_key)
+        path = self.temp_path(extension)
+        try:
+            with open(path, 'wb') as f:
+                yield f
+            self.upload_file(path, bucket_key, content_type)
+        finally:
+            if exists(path):
+                os.remove(path)
+
+    def complete(self, result_url):
+        self.reporter.post({
             'message': 'complete',
             'result_url': result_url,
             'queue_url': self.queue_url,
-            'job_id': self.job_id,
-            'file_uuid': self.file_uuid,
-        }))
+        })
 
 # Upload from s3 triggers event.
 # Download s3 object into ram.
@@ -92,77 +319,140 @@ class JobContext(object):
 # Upload zipfile and xlsx to s3.
 async def pull_co(event, lambda_context):
     print(event)
-    job_context = JobContext(event)
-
-    pullers = None
-    if 'pullers' in job_context.metadata:
-        pullers_decoded = unquote(job_context.metadata['pullers']).splitlines()
-        pullers = [p for p in pullers_decoded if p]
-        random.shuffle(pullers)
-
-    zipfile_path = job_context.temp_path('.zip')
-    spreadsheet_path = job_context.temp_path('.xlsx')
-
-    zipfile_name = 'Bookpull.{}'.format(job_context.original_name)
-
-    async with PullContext(job_context.stream, zipfile_path, zipfile_prefix=zipfile_name) as context:
-        downloads, pull_infos = pull_sources(context)
-        def check():
-            return (lambda_context.get_remaining_time_in_millis() > 10 * 1000 and
-                    context.compressed_size() < 400 * 1024 * 1024)
-        await track_tasks(job_context, downloads, last_skip=5, check=check)
-
-        if pullers:
-            add_pullers(pull_infos, pullers)
-
-        write_spreadsheet(pull_infos, spreadsheet_path)
-        context.zipf.write(spreadsheet_path, '{}/0.Bookpull.{}.xlsx'.format(
-            context.zipfile_prefix,
-            job_context.original_name
-        ))
-        os.remove(spreadsheet_path)
-
-    bucket_key = 'pull/{}/{}.zip'.format(job_context.file_uuid, zipfile_name)
-    job_context.upload_file(zipfile_path, bucket_key, 'application/zip')
+    async with JobContext(event) as job_context:
+        pullers = None
+        if 'pullers' in job_context.metadata:
+            pullers_decoded = unquote(job_context.metadata['pullers']).splitlines()
+            pullers = [p for p in pullers_decoded if p]
+            random.shuffle(pullers)
+
+        zipfile_path = job_context.temp_path('.zip')
+        spreadsheet_path = job_context.temp_path('.xlsx')
+
+        zipfile_name = 'Bookpull.{}'.format(job_context.original_name)
+        bucket_key = 'pull/{}/{}.zip'.format(job_context.file_uuid, zipfile_name)
+
+        # A pull that runs out of time saves a checkpoint and continues in another invocation.
+        store = job_context.checkpoint_store('pull')
+        document = Checkpoint.document_key(job_context.file_uuid, job_context.stream)
+        checkpoint = Checkpoint.load(store, zipfile_path, document) if job_context.resumed else None
+
+        shards = None
+        if PULL_SHARDS > 1:
+            shards_store = S3ObjectStore(job_context.results_bucket, 'shards/pull/{}/'.format(job_context.file_uuid))
+            shards = LambdaShardPool(PULL_SHARDS, shards_store, lambda_context.function_name)
+
+        with ExitStack() as stack:
+            zip_out = zipfile_path
+            if STREAM_RESULTS:
+                zip_out = stack.enter_context(job_context.result_writer(bucket_key, 'application/zip'))
+
+            async with PullContext(job_context.stream, zip_out, zipfile_prefix=zipfile_name,
+                                   cache=cache_from_config(), append=checkpoint is not None,
+                                   client=RUNTIME.http_client('pull', PullContext.make_client)) as context:
+                def time_left():
+                    # Leave time to write and upload the results.
+                    return lambda_context.get_remaining_time_in_millis() / 1000 - 10
+                pull_infos, checkpoint = await run_pull(context, checkpoint, time_left=time_left,
+                                                        byte_budget=400 * 1024 * 1024,
+                                                        progress=job_context.reporter.update, shards=shards)
+                if STREAM_RESULTS:
+                    checkpoint = None
+
+                if checkpoint is None:
+                    if pullers:
+                        add_pullers(pull_infos, pullers)
+
+                    write_spreadsheet(pull_infos, spreadsheet_path)
+                    await context.write_zip('0.Bookpull.{}.xlsx'.format(job_context.original_name),
+                                            open(spreadsheet_path, 'rb'))
+                    os.remove(spreadsheet_path)
+
+        if checkpoint is not None:
+            checkpoint.save(store, zipfile_path, document)
+            os.remove(zipfile_path)
+            job_context.resume(lambda_context)
+            return
+
+        Checkpoint.clear(store, document)
+
+        if not STREAM_RESULTS:
+            job_context.upload_file(zipfile_path, bucket_key, 'application/zip')
+            os.remove(zipfile_path)
+
+# A worker for a fanned-out pull: downloads one shard and leaves its zip and results next to its state.
+async def pull_shard_co(event, lambda_context):
+    print(event)
+    shard = event['shard']
+    store = S3ObjectStore(RUNTIME.aws_resource('s3').Bucket(RESULTS_BUCKET), shard['prefix'])
+    key = shard['key']
+
+    state = json.loads(store.get_bytes(key + '.json').decode('utf-8'))
+    zipfile_path = join(tempfile.gettempdir(), key + '.zip')
+    # Leave time to upload the results.
+    time_budget = min(shard['time_budget'], lambda_context.get_remaining_time_in_millis() / 1000 - 10)
+
+    result = await run_shard(state, zipfile_path, shard['zipfile_prefix'], time_budget, shard['byte_budget'],
+                             cache_from_config(), RUNTIME.http_client('pull', PullContext.make_client))
+
+    store.upload(zipfile_path, key + '.zip')
+    store.put_bytes(key + '.result.json', json.dumps(result).encode('utf-8'))
     os.remove(zipfile_path)
 
 def pull(event, context):
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(pull_co(event, context))
+    if 'shard' in event:
+        loop.run_until_complete(pull_shard_co(event, context))
+    else:
+        loop.run_until_complete(pull_co(event, context))
 
 async def perma_co(event, lambda_context):
+    from footnotes.footnotes import Docx
+    from footnotes.perma import collect_urls, generate_insertions, make_permas_futures, PermaContext
+    from footnotes.permastore import SyncedPermaStore
+    from footnotes.text import Insertion
+
     print(event)
-    job_context = JobContext(event)
+    async with JobContext(event) as job_context:
+        perma_api_key = job_context.metadata.get('perma-api')
+        perma_folder = job_context.metadata.get('perma-folder')
 
-    perma_api_key = job_context.metadata.get('perma-api')
-    perma_folder = job_context.metadata.get('perma-folder')
+        # Links made by earlier jobs, shared through the results bucket.
+        store = SyncedPermaStore(S3ObjectStore(job_context.results_bucket, 'permas/'), 'permas.sqlite',
+                                 job_context.temp_path('.sqlite'),
+                                 PERMA_MAX_AGE_DAYS * 24 * 60 * 60 if PERMA_MAX_AGE_DAYS else None)
 
-    out_path = job_context.temp_path('.docx')
+        try:
+            with Docx(job_context.stream) as docx:
+                footnotes = docx.footnote_list
+                urls = list(collect_urls(footnotes))
 
-    with Docx(job_context.stream) as docx:
-        footnotes = docx.footnote_list
-        urls = list(collect_urls(footnotes))
+                client = RUNTIME.http_client('perma', PermaContext.make_client)
+                async with PermaContext(urls, api_key=perma_api_key, folder=perma_folder, client=client,
+                                        store=store, asynchronous=PERMA_ASYNC_CAPTURE) as perma_context:
+                    futures = make_permas_futures(perma_context)
+                    def check():
+                        return lambda_context.get_remaining_time_in_millis() > 10 * 1000
+                    await track_tasks(job_context.reporter, futures, check=check)
 
-        async with PermaContext(urls, api_key=perma_api_key, folder=perma_folder) as perma_context:
-            futures = make_permas_futures(perma_context)
-            def check():
-                return lambda_context.get_remaining_time_in_millis() > 10 * 1000
-            await track_tasks(job_context, futures, check=check)
+                    insertions = generate_insertions(urls, perma_context.permas)
 
-            insertions = generate_insertions(urls, perma_context.permas)
+                    print('Applying insertions.')
+                    Insertion.apply_all(insertions)
 
-        print('Applying insertions.')
-        Insertion.apply_all(insertions)
+                    print('Removing hyperlinks.')
+                    footnotes.remove_hyperlinks()
 
-        print('Removing hyperlinks.')
-        footnotes.remove_hyperlinks()
+                    bucket_key = 'perma/{}/{}_perma.docx'.format(job_context.file_uuid, job_context.original_name)
+                    with job_context.result_file(bucket_key, 'application/vnd.openxmlformats-officedocument.wordprocessingml.document') as f:
+                        docx.write(f)
 
-        docx.write(out_path)
+                    # The job is complete; use the time left to see captures through, so they get stored.
+                    await perma_context.wait_for_captures(lambda_context.get_remaining_time_in_millis() / 1000 - 10)
 
-    print('Uploading docx...')
-    bucket_key = 'perma/{}/{}_perma.docx'.format(job_context.file_uuid, job_context.original_name)
-    job_context.upload_file(out_path, bucket_key, 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
-    os.remove(out_path)
+                print(store.summary())
+        finally:
+            store.close()
 
 def perma(event, context):
     loop = asyncio.get_event_loop()
@@ -170,22 +460,16 @@ def perma(event, context):
 
 
 async def bluebook_co(event, lambda_context):
-    print(event)
-    job_context = JobContext(event)
-
-    out_path = job_context.temp_path('.json')
+    from bluebook.highlight_doc import highlight_doc
 
-    result = highlight_doc(job_context.stream)
-    result["file"] = job_context.original_name
-
-    f = open(out_path, 'w')
-    f.write(json.dumps(result))
-    f.close()
+    print(event)
+    async with JobContext(event) as job_context:
+        result = highlight_doc(job_context.stream)
+        result["file"] = job_context.original_name
 
-    print('Uploading json...')
-    bucket_key = 'bluebook/{}/{}_bluebook.json'.format(job_context.file_uuid, job_context.original_name)
-    job_context.upload_file(out_path, bucket_key, 'application/json')
-    os.remove(out_path)
+        bucket_key = 'bluebook/{}/{}_bluebook.json'.format(job_context.file_uuid, job_context.original_name)
+        with job_context.result_file(bucket_key, 'application/json') as f:
+            f.write(json.dumps(result).encode('utf-8'))
 
 def bluebook(event, context):
     loop = asyncio.get_event_loop()
@@ -1,16 +1,42 @@
 import argparse
+import multiprocessing
 
+from footnotes.cache import cache_from_config, LocalDownloadCache
+from footnotes.checkpoint import FileObjectStore
 from footnotes.config import CONFIG
+from footnotes.fanout import LocalShardPool
 from footnotes.pull import pull_local
 
-parser = argparse.ArgumentParser(description='Create pull spreadsheet.')
-parser.add_argument('docx', help='Input Word file.')
-parser.add_argument('--no-pull', action='store_true', help='Don\'t attempt to pull sources.')
-parser.add_argument('--debug', action='store_true', help='Print debug information.')
+def main():
+    parser = argparse.ArgumentParser(description='Create pull spreadsheet.')
+    parser.add_argument('docx', help='Input Word file.')
+    parser.add_argument('--no-pull', action='store_true', help='Don\'t attempt to pull sources.')
+    parser.add_argument('--debug', action='store_true', help='Print debug information.')
+    parser.add_argument('--workers', type=int, default=None, help='Parse footnotes in this many processes.')
+    parser.add_argument('--cache', metavar='DIR', default=None, help='Cache downloaded sources in this directory.')
+    parser.add_argument('--checkpoint', metavar='DIR', default=None,
+                        help='If downloads run out of time, save a checkpoint here; the next run resumes from it.')
+    parser.add_argument('--time-budget', type=float, default=None, help='Seconds to spend on downloads.')
+    parser.add_argument('--shards', type=int, default=None, help='Split downloads over this many processes.')
 
-cli_args = parser.parse_args()
+    cli_args = parser.parse_args()
 
-if cli_args.debug:
-    CONFIG['mode'] = 'development'
+    if cli_args.debug:
+        CONFIG['mode'] = 'development'
 
-pull_local(cli_args.docx, not cli_args.no_pull)
+    cache = LocalDownloadCache(cli_args.cache) if cli_args.cache else cache_from_config()
+    checkpoint_store = FileObjectStore(cli_args.checkpoint) if cli_args.checkpoint else None
+    shards = None
+    if cli_args.shards and cli_args.shards > 1:
+        # Each worker opens the cache directory itself.
+        cache_args = (cache.directory, cache.max_bytes) if cache is not None else ()
+        shards = LocalShardPool(cli_args.shards, *cache_args)
+
+    pull_local(cli_args.docx, not cli_args.no_pull, workers=cli_args.workers, cache=cache,
+               checkpoint_store=checkpoint_store, time_budget=cli_args.time_budget, shards=shards)
+
+if __name__ == '__main__':
+    # --workers and --shards start worker processes. Under spawn (Windows, macOS, the frozen build), each
+    # of them imports this script again, so it must not start a pull when imported.
+    multiprocessing.freeze_support()
+    main()
@@ -1,5 +1,6 @@
 '''
 Usage:
+    python build_reference.py
     python setup.py build
 '''
 
@@ -7,7 +8,7 @@ from cx_Freeze import setup, Executable
 from os.path import join
 import sys
 
-PACKAGE_FILES = [join('footnotes', 'config.json'), join('footnotes', 'abbreviations.txt')]
+PACKAGE_FILES = [join('footnotes', 'config.json'), join('footnotes', 'abbreviations.txt'), join('footnotes', 'reference.pickle')]
 BATCH_FILES = [
     ('run_apply_perma.bat', 'Add Perma Links.bat'),
     ('run_pull_spreadsheet.bat', 'Make Pull Spreadsheet.bat')
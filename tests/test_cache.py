@@ -0,0 +1,128 @@
+import io
+import os
+from os.path import exists
+import random
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from footnotes import cache as cache_module
+from footnotes.cache import LocalDownloadCache
+
+class LocalDownloadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def cache(self, max_bytes=1024 * 1024):
+        return LocalDownloadCache(self.directory.name, max_bytes)
+
+    def objects(self, cache):
+        return sorted(os.listdir(cache.objects_directory))
+
+    def test_put_and_get(self):
+        cache = self.cache()
+        cache.put('HTTP://Example.com:80/a#top', io.BytesIO(b'body'), 'application/pdf', '"etag"')
+        cache.close()
+
+        cache = self.cache()
+        entry = cache.get('http://example.com/a')
+        self.assertEqual((entry.size, entry.content_type, entry.etag), (4, 'application/pdf', '"etag"'))
+        with cache.open(entry) as f:
+            self.assertEqual(f.read(), b'body')
+
+    def test_identical_bodies_share_an_object(self):
+        cache = self.cache()
+        cache.put('http://example.com/a', io.BytesIO(b'same'), 'text/html')
+        cache.put('http://example.com/b', io.BytesIO(b'same'), 'text/html')
+        self.assertEqual(len(self.objects(cache)), 1)
+
+    def test_eviction_keeps_shared_bodies(self):
+        cache = self.cache(max_bytes=10)
+        cache.put('http://example.com/a', io.BytesIO(b'shared'), 'text/html')
+        cache.put('http://example.com/b', io.BytesIO(b'shared'), 'text/html')
+        cache.put('http://example.com/c', io.BytesIO(b'other'), 'text/html')
+
+        # a goes first, but b still needs the shared body, so b goes too.
+        self.assertIsNone(cache.get('http://example.com/a'))
+        self.assertIsNone(cache.get('http://example.com/b'))
+        self.assertIsNotNone(cache.get('http://example.com/c'))
+        self.assertEqual(len(self.objects(cache)), 1)
+
+    def test_eviction_during_deduplicated_put(self):
+        # Another thread's put evicts the only entry using a body just as this put finds it's a duplicate.
+        cache = self.cache(max_bytes=10)
+        cache.put('http://example.com/x', io.BytesIO(b'shared'), 'text/html')
+        shared_path = cache._object_path(cache.get('http://example.com/x').digest)
+
+        other = threading.Thread(target=cache.put, args=('http://example.com/b', io.BytesIO(b'bbbbbb'), 'text/html'))
+        def exists_then_evict(path):
+            result = exists(path)
+            if path == shared_path and other.ident is None:
+                other.start()
+                # Let it evict, unless it has to wait for us.
+                other.join(0.5)
+            return result
+
+        with mock.patch.object(cache_module, 'exists', exists_then_evict):
+            cache.put('http://example.com/a', io.BytesIO(b'shared'), 'text/html')
+        other.join()
+
+        for key, entry in cache.entries.items():
+            self.assertTrue(exists(cache._object_path(entry.digest)), key)
+
+    def test_closes_merge(self):
+        # Two processes' caches on one directory, like shard workers.
+        first, second = self.cache(), self.cache()
+        first.put('http://example.com/a', io.BytesIO(b'a'), 'text/html')
+        first.put_verdict('http://example.com/x', True)
+        second.put('http://example.com/b', io.BytesIO(b'b'), 'text/html')
+        second.put_verdict('http://example.com/y', False)
+        first.close()
+        second.close()
+
+        cache = self.cache()
+        self.assertIsNotNone(cache.get('http://example.com/a'))
+        self.assertIsNotNone(cache.get('http://example.com/b'))
+        self.assertEqual((cache.get_verdict('http://example.com/x'), cache.get_verdict('http://example.com/y')),
+                         (True, False))
+
+    def test_close_keeps_evictions(self):
+        cache = self.cache()
+        cache.put('http://example.com/a', io.BytesIO(b'aaaaaa'), 'text/html')
+        cache.close()
+
+        # a was on disk when this one started, and it evicts a; merging mustn't bring a back.
+        cache = self.cache(max_bytes=10)
+        cache.put('http://example.com/b', io.BytesIO(b'bbbbbb'), 'text/html')
+        cache.close()
+
+        self.assertEqual(sorted(self.cache().entries), ['http://example.com/b'])
+
+    def test_concurrent_puts_leave_no_dangling_entries(self):
+        # Bodies are deduplicated and evicted from several threads at once (as from run_in_executor); every
+        # entry left behind must still have its body.
+        cache = self.cache(max_bytes=300)
+        bodies = [bytes([i]) * 100 for i in range(5)]
+
+        def work(seed):
+            rng = random.Random(seed)
+            for i in range(200):
+                cache.put('http://example.com/{}'.format(rng.randrange(20)), io.BytesIO(rng.choice(bodies)),
+                          'application/pdf')
+
+        threads = [threading.Thread(target=work, args=(seed,)) for seed in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for key, entry in cache.entries.items():
+            self.assertTrue(exists(cache._object_path(entry.digest)), key)
+        self.assertFalse([name for name in self.objects(cache) if name.endswith('.part')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import io
+import os
+from os.path import exists, join
+import tempfile
+import unittest
+import zipfile
+
+from footnotes.checkpoint import Checkpoint, FileObjectStore
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = FileObjectStore(join(self.directory.name, 'checkpoints'))
+        self.zipfile_path = join(self.directory.name, 'sources.zip')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def document(self, name, contents):
+        return Checkpoint.document_key(name, io.BytesIO(contents))
+
+    def save(self, document, state, members):
+        with zipfile.ZipFile(self.zipfile_path, 'w') as zipf:
+            for member in members:
+                zipf.writestr(member, member)
+        Checkpoint(state).save(self.store, self.zipfile_path, document)
+        os.remove(self.zipfile_path)
+
+    def test_round_trip(self):
+        document = self.document('/a.docx', b'a')
+        self.save(document, { 'runs': 1 }, ['1.pdf'])
+
+        checkpoint = Checkpoint.load(self.store, self.zipfile_path, document)
+        self.assertEqual(checkpoint.state, { 'runs': 1 })
+        self.assertEqual(checkpoint.members, ['1.pdf'])
+        with zipfile.ZipFile(self.zipfile_path) as zipf:
+            self.assertEqual(zipf.namelist(), ['1.pdf'])
+
+        Checkpoint.clear(self.store, document)
+        self.assertIsNone(Checkpoint.load(self.store, self.zipfile_path, document))
+
+    def test_document_key_rewinds(self):
+        f = io.BytesIO(b'contents')
+        f.read(3)
+        key = Checkpoint.document_key('a', f)
+        self.assertEqual(f.tell(), 0)
+        self.assertEqual(key, Checkpoint.document_key('a', io.BytesIO(b'contents')))
+
+    def test_other_documents_are_ignored(self):
+        self.save(self.document('/a.docx', b'a'), { 'runs': 1 }, ['1.pdf'])
+
+        # Same path with different contents, or different path with the same contents.
+        for document in [self.document('/a.docx', b'edited'), self.document('/b.docx', b'a')]:
+            with open(self.zipfile_path, 'wb') as f:
+                f.write(b'untouched')
+            self.assertIsNone(Checkpoint.load(self.store, self.zipfile_path, document))
+            with open(self.zipfile_path, 'rb') as f:
+                self.assertEqual(f.read(), b'untouched')
+
+    def test_mismatched_record_is_refused(self):
+        # Even if a checkpoint ends up under another document's keys, its record keeps it from loading.
+        a, b = self.document('/a.docx', b'a'), self.document('/b.docx', b'b')
+        self.save(a, { 'runs': 1 }, ['1.pdf'])
+        for a_key, b_key in zip(Checkpoint.keys(a), Checkpoint.keys(b)):
+            os.replace(self.store._path(a_key), self.store._path(b_key))
+
+        self.assertIsNone(Checkpoint.load(self.store, self.zipfile_path, b))
+        self.assertFalse(exists(self.zipfile_path))
+
+    def test_documents_share_a_store(self):
+        a, b = self.document('/a.docx', b'a'), self.document('/b.docx', b'b')
+        self.save(a, { 'document': 'a' }, ['a.pdf'])
+        self.save(b, { 'document': 'b' }, ['b.pdf'])
+        Checkpoint.clear(self.store, b)
+
+        checkpoint = Checkpoint.load(self.store, self.zipfile_path, a)
+        self.assertEqual(checkpoint.state, { 'document': 'a' })
+        self.assertEqual(checkpoint.members, ['a.pdf'])
+        self.assertIsNone(Checkpoint.load(self.store, self.zipfile_path, b))
+
+if __name__ == '__main__':
+    unittest.main()
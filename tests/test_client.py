@@ -0,0 +1,80 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+
+from footnotes.client import CircuitOpenError, HttpClient
+
+class HttpClientTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = None
+        self.hits = 0
+        self.on_busy = None
+
+        async def busy(request):
+            self.hits += 1
+            if self.on_busy is not None:
+                self.on_busy()
+            return web.Response(status=503)
+
+        async def fine(request):
+            self.hits += 1
+            return web.Response(text='ok')
+
+        app = web.Application()
+        app.router.add_get('/busy', busy)
+        app.router.add_get('/fine', fine)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        self.loop.run_until_complete(web.TCPSite(self.runner, '127.0.0.1', 0).start())
+        self.base = 'http://127.0.0.1:{}'.format(self.runner.addresses[0][1])
+
+    def tearDown(self):
+        if self.client is not None:
+            self.loop.run_until_complete(self.client.close())
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def make_client(self, **kwargs):
+        async def go():
+            return HttpClient(**kwargs)
+
+        self.client = self.loop.run_until_complete(go())
+
+    def get_status(self, path):
+        async def go():
+            async with self.client.get(self.base + path) as response:
+                return response.status
+
+        return self.loop.run_until_complete(go())
+
+    def test_retries(self):
+        self.make_client(retries=2, backoff=0.01)
+        self.assertEqual(self.get_status('/busy'), 503)
+        self.assertEqual(self.hits, 3)
+        self.assertEqual(self.client.stats['127.0.0.1'].retries, 2)
+
+    def test_open_circuit_refuses_requests(self):
+        self.make_client(retries=0, failure_threshold=2)
+        for _ in range(2):
+            self.get_status('/busy')
+        with self.assertRaises(CircuitOpenError):
+            self.get_status('/fine')
+        self.assertEqual(self.hits, 2)
+
+    def test_circuit_opening_stops_retries(self):
+        self.make_client(retries=5, backoff=0.05, failure_threshold=1)
+        # Another request to the host fails for good before ours gets to retry.
+        self.client.host_stats('127.0.0.1')
+        self.on_busy = lambda: self.client.breakers['127.0.0.1'].record(False)
+
+        with self.assertRaises(CircuitOpenError):
+            self.get_status('/busy')
+        self.assertEqual(self.hits, 1)
+        self.assertEqual(self.client.stats['127.0.0.1'].refused, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import io
+from os.path import join
+import tempfile
+import unittest
+from unittest import mock
+import zipfile
+
+from footnotes import footnotes
+from footnotes.footnotes import copy_compressed, Docx, NS
+
+FOOTNOTES_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:footnotes xmlns:w="{w}"><w:footnote w:id="1"><w:p><w:r><w:t>See http://example.com/a.</w:t></w:r></w:p>
+</w:footnote></w:footnotes>'''.format(w=NS['w'])
+
+def make_zip(f):
+    """A zip with the kinds of members copy_compressed has to handle."""
+
+    with zipfile.ZipFile(f, 'w') as zipf:
+        zipf.writestr('[Content_Types].xml', '<Types/>', zipfile.ZIP_DEFLATED)
+        zipf.writestr('word/media/image1.png', bytes(range(256)) * 64, zipfile.ZIP_STORED)
+        # Streamed without knowing the size up front, so it gets a data descriptor when unseekable.
+        with zipf.open('word/document.xml', 'w') as out:
+            out.write(b'<w:document/>' * 1000)
+        info = zipfile.ZipInfo('word/with_extra.xml', (2020, 1, 2, 3, 4, 6))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.extra = b'\xfe\xca\x04\x00abcd'
+        zipf.writestr(info, '<extra/>' * 100)
+        zipf.writestr('word/footnotes.xml', FOOTNOTES_XML, zipfile.ZIP_DEFLATED)
+
+class Unseekable(io.RawIOBase):
+    """A write-only stream, like the multipart upload writer."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.buffer.write(b)
+
+def raw_member(zipf, info):
+    with zipf.open(info) as f:
+        data = f.read()
+    zipf.fp.seek(info.header_offset + 26)
+    name_length, extra_length = int.from_bytes(zipf.fp.read(2), 'little'), int.from_bytes(zipf.fp.read(2), 'little')
+    zipf.fp.seek(name_length + extra_length, io.SEEK_CUR)
+    return data, zipf.fp.read(info.compress_size)
+
+class CopyCompressedTest(unittest.TestCase):
+    def setUp(self):
+        self.source = io.BytesIO()
+        make_zip(self.source)
+
+    def copy_all(self, dest_f):
+        with zipfile.ZipFile(self.source) as source, zipfile.ZipFile(dest_f, 'w') as dest:
+            for info in source.infolist():
+                copy_compressed(source, dest, info)
+
+    def check_copy(self, dest_bytes, verbatim):
+        with zipfile.ZipFile(self.source) as source, zipfile.ZipFile(io.BytesIO(dest_bytes)) as dest:
+            self.assertIsNone(dest.testzip())
+            self.assertEqual(dest.namelist(), source.namelist())
+            for info in source.infolist():
+                copied = dest.getinfo(info.filename)
+                self.assertEqual(copied.CRC, info.CRC)
+                self.assertEqual(copied.date_time, info.date_time)
+                self.assertEqual(copied.compress_type, info.compress_type)
+
+                data, raw = raw_member(source, info)
+                copied_data, copied_raw = raw_member(dest, copied)
+                self.assertEqual(copied_data, data)
+                if verbatim:
+                    self.assertEqual(copied_raw, raw)
+
+    def test_copies_compressed_bytes(self):
+        self.assertTrue(footnotes.can_copy_compressed())
+        dest = io.BytesIO()
+        self.copy_all(dest)
+        self.check_copy(dest.getvalue(), verbatim=True)
+
+    def test_unseekable_dest(self):
+        dest = Unseekable()
+        self.copy_all(dest)
+        self.check_copy(dest.buffer.getvalue(), verbatim=True)
+
+    def test_recompresses_on_untested_versions(self):
+        dest = io.BytesIO()
+        with mock.patch.object(footnotes, 'RAW_COPY_VERSIONS', ((3, 0), (3, 0))):
+            self.assertFalse(footnotes.can_copy_compressed())
+            self.copy_all(dest)
+        self.check_copy(dest.getvalue(), verbatim=False)
+
+    def test_refuses_while_writing(self):
+        with zipfile.ZipFile(self.source) as source, zipfile.ZipFile(io.BytesIO(), 'w') as dest:
+            with dest.open('open.txt', 'w'):
+                with self.assertRaises(ValueError):
+                    copy_compressed(source, dest, source.infolist()[0])
+
+class DocxWriteTest(unittest.TestCase):
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, new_path = join(directory, 'in.docx'), join(directory, 'out.docx')
+            make_zip(path)
+
+            with Docx(path) as docx:
+                refs = docx.footnote_list.footnotes[0].text_refs()
+                refs[0].insert(len(refs[0]), ' [https://perma.cc/ABCD-1234]').apply()
+                docx.write(new_path, compresslevel=9)
+
+            with zipfile.ZipFile(path) as old, zipfile.ZipFile(new_path) as new:
+                self.assertIsNone(new.testzip())
+                self.assertEqual(new.namelist(), old.namelist())
+                for name in old.namelist():
+                    if name != 'word/footnotes.xml':
+                        self.assertEqual(new.read(name), old.read(name))
+
+                self.assertIn(b'http://example.com/a. [https://perma.cc/ABCD-1234]', new.read('word/footnotes.xml'))
+                self.assertEqual(new.getinfo('word/footnotes.xml').compress_type, zipfile.ZIP_DEFLATED)
+
+if __name__ == '__main__':
+    unittest.main()
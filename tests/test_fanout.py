@@ -0,0 +1,82 @@
+import asyncio
+import io
+import tempfile
+import unittest
+import zipfile
+
+from aiohttp import web
+
+from footnotes.cache import LocalDownloadCache
+from footnotes.fanout import LocalShardPool, ShardPool
+from footnotes.pull import Fetch, PullInfo
+
+class FakeContext(object):
+    zipfile_prefix = 'sources'
+
+    def __init__(self):
+        self.zipf = zipfile.ZipFile(io.BytesIO(), 'w')
+
+    def compressed_size(self):
+        return 0
+
+class PartialShardPool(ShardPool):
+    """Shards that only get through the first `done` of their fetches, as if they ran out of time."""
+
+    def __init__(self, shards, done):
+        super().__init__(shards)
+        self.done = done
+
+    async def run_shard(self, index, state, zipfile_path, zipfile_prefix, time_budget, byte_budget):
+        with zipfile.ZipFile(zipfile_path, 'w'):
+            pass
+
+        for i, record in enumerate(state['fetches']):
+            record['done'] = i < self.done
+        return state
+
+class ShardPoolTest(unittest.TestCase):
+    def test_progress_counts_settled_fetches(self):
+        context = FakeContext()
+        pull_infos = [PullInfo('{}.1'.format(i), None, 'Citation.') for i in range(8)]
+        fetches = [Fetch(context, Fetch.CHECK, 'http://example.com/{}'.format(i), pull_info)
+                   for i, pull_info in enumerate(pull_infos)]
+
+        updates = []
+        pool = PartialShardPool(2, done=3)
+        asyncio.run(pool.run(context, fetches, pull_infos, time_left=lambda: 60,
+                             progress=lambda done, total: updates.append((done, total))))
+
+        self.assertEqual(sorted(updates), [(3, 8), (6, 8)])
+        self.assertEqual(sum(1 for fetch in fetches if fetch.finished()), 6)
+
+class LocalShardPoolTest(unittest.TestCase):
+    def test_workers_use_the_cache_directory(self):
+        async def missing(request):
+            return web.Response(status=404)
+
+        async def go(directory):
+            app = web.Application()
+            app.router.add_route('*', '/{name}', missing)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, '127.0.0.1', 0).start()
+            base = 'http://127.0.0.1:{}'.format(runner.addresses[0][1])
+
+            context = FakeContext()
+            pull_infos = [PullInfo('{}.1'.format(i), None, 'Citation.') for i in range(4)]
+            urls = ['{}/{}'.format(base, i) for i in range(4)]
+            fetches = [Fetch(context, Fetch.CHECK, url, pull_info) for url, pull_info in zip(urls, pull_infos)]
+            try:
+                await LocalShardPool(2, directory).run(context, fetches, pull_infos, time_left=lambda: 60)
+            finally:
+                await runner.cleanup()
+            return urls
+
+        with tempfile.TemporaryDirectory() as directory:
+            urls = asyncio.run(go(directory))
+            # Both workers' verdicts made it into the shared directory.
+            cache = LocalDownloadCache(directory)
+            self.assertEqual([cache.get_verdict(url) for url in urls], [False] * 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import json
+from os.path import dirname, join
+import unittest
+
+import lxml.etree as ET
+
+from footnotes.parsing import Parseable
+from footnotes.text import TextRef
+
+DATA_DIR = join(dirname(__file__), 'data')
+
+def parseable(*texts):
+    """A Parseable over one element per string in `texts`, like a footnote made of several runs."""
+
+    refs = []
+    for text in texts:
+        element = ET.Element('t')
+        element.text = text
+        refs.append(TextRef.from_text(element))
+    return Parseable(refs)
+
+class SentenceRangesTest(unittest.TestCase):
+    """
+    sentence_ranges against data/sentence_ranges.json: footnotes from synthetic documents, random strings of
+    abbreviations, signals, parens, brackets and quotes, and a few edge cases, each with the ranges the splitter
+    produced before it became a single pass. The abbreviations are the ones from abbreviations.txt and
+    reporters-db that occur in the corpus, so the results don't depend on the installed reporters-db.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        with open(join(DATA_DIR, 'sentence_ranges.json'), encoding='utf-8') as f:
+            corpus = json.load(f)
+
+        cls.abbreviations = frozenset(corpus['abbreviations'])
+        cls.cases = corpus['cases']
+
+    def test_matches_previous_splitter(self):
+        for case in self.cases:
+            with self.subTest(text=case['text']):
+                ranges = [[r.i, r.j] for r in Parseable.sentence_ranges(case['text'], self.abbreviations)]
+                self.assertEqual(ranges, case['ranges'])
+
+    def test_corpus_covers_merges(self):
+        # Make sure the corpus exercises merging across periods, not just the trivial splits.
+        merged = [case for case in self.cases
+                  if any(case['text'].find('. ', i, j) >= 0 for i, j in case['ranges'])]
+        self.assertGreater(len(merged), 100)
+
+class LinksTest(unittest.TestCase):
+    def links(self, *texts):
+        parsed = parseable(*texts)
+        text = str(parsed)
+        result = []
+        for span, url in parsed.links():
+            self.assertEqual(text[span.slice()], str(url))
+            result.append(str(url))
+        return result
+
+    def test_trailing_punctuation(self):
+        self.assertEqual(self.links('See http://example.com/a. Also https://example.org/b;'),
+                         ['http://example.com/a', 'https://example.org/b'])
+
+    def test_parentheses(self):
+        self.assertEqual(self.links('Report (available at http://example.com/a_(b)).'), ['http://example.com/a_(b)'])
+        self.assertEqual(self.links('(http://example.com/a) (http://example.com/b)'),
+                         ['http://example.com/a', 'http://example.com/b'])
+
+    def test_matches_original_text(self):
+        # Links are found in the text as written, so characters normalization would change stay part of them.
+        self.assertEqual(self.links('See http://example.com/a\u00A0b, and http://example.com/\u201Cq\u201D.'),
+                         ['http://example.com/a\u00A0b', 'http://example.com/\u201Cq\u201D'])
+        self.assertEqual(self.links('\u200Bhttp://example.com/a\u200B b'), ['http://example.com/a\u200B'])
+
+    def test_across_runs(self):
+        self.assertEqual(self.links('See http://exam', 'ple.com/a', '. Next.'), ['http://example.com/a'])
+
+if __name__ == '__main__':
+    unittest.main()
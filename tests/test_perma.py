@@ -0,0 +1,219 @@
+import asyncio
+from types import SimpleNamespace
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from footnotes import perma
+from footnotes.client import HttpClient
+from footnotes.fakeperma import FakePerma
+from footnotes.perma import CapturePoller, make_permas_co, make_permas_futures, PermaBatcher, PermaContext
+from footnotes.permastore import SqlitePermaStore
+
+class Url(str):
+    def normalized(self):
+        return self
+
+class CountingBucket(object):
+    def __init__(self):
+        self.acquired = 0
+
+    async def acquire(self):
+        self.acquired += 1
+        await asyncio.sleep(0)
+
+class PermaBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_batcher(self, urls, fail_first=0, batch_size=8, workers=5):
+        context = SimpleNamespace(batch_size=batch_size, max_batch_size=50, target_latency=8, bucket=CountingBucket(),
+                                  poller=None, store=None, permas={})
+        context.add_permas = lambda guids: context.permas.update(guids)
+        sent = []
+
+        async def make_permas_batch(context, batch):
+            await asyncio.sleep(0.01)
+            sent.append(batch)
+            if len(sent) <= fail_first:
+                return None
+            return len(sent), { url: 'GUID-{}'.format(url) for url in batch }
+
+        with mock.patch.object(perma, 'make_permas_batch', make_permas_batch):
+            batcher = PermaBatcher(context, urls, workers=workers)
+            self.loop.run_until_complete(batcher.run())
+
+        self.assertTrue(all(future.done() for future in batcher.futures.values()))
+        return context, batcher, sent
+
+    def test_idle_workers_take_no_tokens(self):
+        context, batcher, sent = self.run_batcher(['a', 'b', 'c'])
+        self.assertEqual(sent, [['a', 'b', 'c']])
+        self.assertEqual(context.bucket.acquired, 1)
+        self.assertEqual(set(context.permas), {'a', 'b', 'c'})
+
+    def test_one_token_per_batch(self):
+        urls = [str(i) for i in range(40)]
+        context, batcher, sent = self.run_batcher(urls, fail_first=2, batch_size=4)
+        self.assertEqual(context.bucket.acquired, len(sent))
+        self.assertEqual(batcher.failures, 2)
+        self.assertEqual(set(context.permas), set(urls))
+
+class CapturePollerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # Batch id -> (status, capture jobs) the server answers polls with.
+        self.batches = {}
+
+        async def get_batch(request):
+            status, jobs = self.batches[int(request.match_info['id'])]
+            return web.json_response({ 'capture_jobs': jobs }, status=status)
+
+        app = web.Application()
+        app.router.add_get('/batches/{id}', get_batch)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        self.loop.run_until_complete(web.TCPSite(self.runner, '127.0.0.1', 0).start())
+
+        async def make_client():
+            return HttpClient(retries=0, failure_threshold=100)
+
+        self.client = self.loop.run_until_complete(make_client())
+        self.store = SqlitePermaStore(':memory:')
+        self.context = SimpleNamespace(client=self.client, bucket=CountingBucket(), api_key='', store=self.store,
+                                       endpoint='http://127.0.0.1:{}/batches'.format(self.runner.addresses[0][1]),
+                                       permas={})
+        self.poller = CapturePoller(self.context)
+
+    def tearDown(self):
+        self.store.close()
+        self.loop.run_until_complete(self.client.close())
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def watch(self, batch_id, urls):
+        guids = { url: url.upper() for url in urls }
+        self.context.permas.update(guids)
+        self.poller.watch(batch_id, guids)
+
+    def poll(self, batch_id):
+        self.loop.run_until_complete(self.poller.poll(batch_id))
+
+    def test_statuses(self):
+        self.watch(1, ['a', 'b', 'c', 'd', 'e'])
+        self.batches[1] = 200, [{ 'submitted_url': url, 'status': status } for url, status in
+                                [('a', 'completed'), ('b', 'failed'), ('c', 'invalid'), ('d', 'pending'),
+                                 ('e', 'in_progress')]]
+        self.poll(1)
+
+        self.assertEqual(self.store.get_many(list('abcde')), { 'a': 'A' })
+        self.assertEqual(self.poller.failed, ['b', 'c'])
+        self.assertEqual(set(self.context.permas), {'a', 'd', 'e'})
+        self.assertEqual(set(self.poller.pending[1]), {'d', 'e'})
+
+    def test_gives_up_on_failing_polls(self):
+        self.watch(1, ['a', 'b'])
+        self.watch(2, ['c'])
+        self.batches[1] = 404, []
+        self.batches[2] = 200, [{ 'submitted_url': 'c', 'status': 'pending' }]
+
+        for _ in range(CapturePoller.MAX_POLL_FAILURES - 1):
+            self.poll(1)
+            self.poll(2)
+        self.assertEqual(set(self.poller.pending), {1, 2})
+        self.assertFalse(self.poller.idle.is_set())
+
+        self.poll(1)
+        self.assertEqual(sorted(self.poller.failed), ['a', 'b'])
+        self.assertEqual(set(self.context.permas), {'c'})
+        self.assertEqual(set(self.poller.pending), {2})
+
+        self.poller.give_up()
+        self.assertEqual(self.poller.failed[-1], 'c')
+        self.assertEqual(self.context.permas, {})
+        self.assertTrue(self.poller.idle.is_set())
+
+    def test_successful_poll_resets_failures(self):
+        self.watch(1, ['a'])
+        for _ in range(3):
+            for status in [503, 200]:
+                self.batches[1] = status, [{ 'submitted_url': 'a', 'status': 'pending' }]
+                self.poll(1)
+        self.assertEqual(self.poller.failed, [])
+        self.assertEqual(set(self.poller.pending), {1})
+
+class MakePermasTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_asynchronous_capture(self):
+        fake = FakePerma(latency=0.05, per_url=0.01, background=True, capture_failure_rate=0.3, seed=3)
+        urls = [Url('https://example.com/{}'.format(i)) for i in range(30)]
+        store = SqlitePermaStore(':memory:')
+
+        async def archive():
+            async with PermaContext(urls, api_key='', folder=0, endpoint=fake.endpoint, store=store, rate=50,
+                                    asynchronous=True) as context:
+                await asyncio.gather(*make_permas_futures(context))
+                self.assertTrue(await context.wait_for_captures(30))
+                return context
+
+        async def go():
+            await fake.start()
+            try:
+                return await archive()
+            finally:
+                await fake.stop()
+
+        context = self.loop.run_until_complete(go())
+        jobs = [job for batch in fake.batches.values() for job in batch]
+        captured = { url: guid for url, guid, _, works in jobs if works }
+        failed = [url for url, _, _, works in jobs if not works]
+        self.assertEqual(len(jobs), len(urls))
+        self.assertTrue(captured and failed)
+        self.assertGreater(fake.polls, 0)
+
+        self.assertEqual(context.permas, { url: 'https://perma.cc/{}'.format(guid) for url, guid in captured.items() })
+        self.assertEqual(sorted(context.poller.failed), sorted(failed))
+        self.assertEqual(context.poller.completed, len(captured))
+        self.assertEqual(context.poller.pending, {})
+        self.assertEqual(store.get_many(urls), captured)
+
+        # A second run only asks for the captures that failed.
+        requests = fake.requests
+        context = self.loop.run_until_complete(go())
+        self.assertEqual(sorted(url for batch in list(fake.batches.values())[requests:] for url, _, _, _ in batch),
+                         sorted(failed))
+        self.assertEqual(set(store.get_many(urls)), set(context.permas))
+        store.close()
+
+    def test_captures_time_out(self):
+        fake = FakePerma(latency=0.05, per_url=60, background=True)
+
+        async def go():
+            await fake.start()
+            try:
+                return await make_permas_co([Url('https://example.com/a')], '', 0, capture_timeout=0.5,
+                                            endpoint=fake.endpoint, asynchronous=True)
+            finally:
+                await fake.stop()
+
+        start = self.loop.time()
+        self.assertEqual(self.loop.run_until_complete(go()), {})
+        self.assertLess(self.loop.time() - start, 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import asyncio
+import time
+import unittest
+
+from footnotes.progress import FakeQueue, ProgressReporter
+
+FIELDS = { 'job_id': 'job', 'file_uuid': 'uuid' }
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+class ProgressReporterTest(unittest.TestCase):
+    def progress_messages(self, queue):
+        return [(at, (message['progress'], message['total'])) for at, message in queue.messages
+                if message['message'] == 'progress']
+
+    def test_coalesces_bursts(self):
+        queue = FakeQueue()
+
+        async def go():
+            async with ProgressReporter(queue, FIELDS) as reporter:
+                for i in range(1, 1001):
+                    reporter.update(i, 1000)
+
+        run(go())
+        sent = [progress for _, progress in self.progress_messages(queue)]
+        # Nothing ran between the updates, so only the last one goes out.
+        self.assertEqual(sent, [(1000, 1000)])
+        self.assertEqual(queue.messages[0][1]['job_id'], 'job')
+
+    def test_interval(self):
+        queue = FakeQueue()
+
+        async def go():
+            async with ProgressReporter(queue, FIELDS, interval=0.2, min_step=1) as reporter:
+                for i in range(1, 50):
+                    reporter.update(i, 100)
+                    await asyncio.sleep(0.02)
+
+        run(go())
+        messages = self.progress_messages(queue)
+        self.assertLess(len(messages), 10)
+        self.assertEqual(messages[-1][1], (49, 100))
+        # Every update but the one sent on close waits out the interval.
+        for (previous, _), (at, _) in zip(messages, messages[1:-1]):
+            self.assertGreaterEqual(at - previous, 0.15)
+
+    def test_big_steps_and_completion_skip_the_interval(self):
+        queue = FakeQueue()
+
+        async def go():
+            async with ProgressReporter(queue, FIELDS, interval=60, min_step=0.25) as reporter:
+                for progress in [1, 2, 30, 31, 100]:
+                    reporter.update(progress, 100)
+                    await asyncio.sleep(0.05)
+                # Nothing changed, so nothing more to send.
+                reporter.update(100, 100)
+                await asyncio.sleep(0.05)
+
+        run(go())
+        self.assertEqual([progress for _, progress in self.progress_messages(queue)], [(1, 100), (30, 100), (100, 100)])
+
+    def test_batches_waiting_messages(self):
+        queue = FakeQueue(latency=0.1)
+
+        async def go():
+            async with ProgressReporter(queue, FIELDS) as reporter:
+                reporter.post({ 'message': 'first' })
+                await asyncio.sleep(0.02)
+                # These pile up while the first send is in flight.
+                for i in range(15):
+                    reporter.post({ 'message': 'note', 'i': i })
+                reporter.update(5, 10)
+
+        run(go())
+        bodies = [message for _, message in queue.messages]
+        self.assertEqual([b['i'] for b in bodies if b['message'] == 'note'], list(range(15)))
+        self.assertEqual(bodies[-1]['message'], 'progress')
+        self.assertTrue(all(b['file_uuid'] == 'uuid' for b in bodies))
+        # One send for the first message, then batches of at most BATCH_SIZE.
+        self.assertEqual(queue.calls, 3)
+
+    def test_posts_follow_earlier_progress(self):
+        queue = FakeQueue(latency=0.1)
+
+        async def go():
+            async with ProgressReporter(queue, FIELDS, interval=60, min_step=1) as reporter:
+                reporter.post({ 'message': 'start' })
+                await asyncio.sleep(0.02)
+                for i in range(1, 11):
+                    reporter.update(i, 10)
+                reporter.post({ 'message': 'complete', 'result_url': 'url' })
+
+        run(go())
+        bodies = [message for _, message in queue.messages]
+        self.assertEqual([b['message'] for b in bodies], ['start', 'progress', 'complete'])
+        self.assertEqual((bodies[1]['progress'], bodies[1]['total']), (10, 10))
+        self.assertEqual(bodies[2]['result_url'], 'url')
+        # The last two piled up behind 'start' and went out together.
+        self.assertEqual(queue.calls, 2)
+
+    def test_slow_sends_dont_block_the_loop(self):
+        queue = FakeQueue(latency=0.3)
+
+        async def go():
+            async with ProgressReporter(queue, FIELDS) as reporter:
+                reporter.update(1, 10)
+                await asyncio.sleep(0.01)
+                start = time.monotonic()
+                for i in range(2, 10):
+                    reporter.update(i, 10)
+                    await asyncio.sleep(0.01)
+                return time.monotonic() - start
+
+        self.assertLess(run(go()), 0.25)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import asyncio
+import os
+from types import SimpleNamespace
+import tempfile
+import unittest
+
+from aiohttp import web
+
+from footnotes.cache import LocalDownloadCache
+from footnotes.client import HttpClient
+from footnotes.pull import download_file_check, download_file_zip, PullInfo
+
+PDF = b'%PDF-1.4\n' + b'x' * 4096
+
+def respond(status, content_type='text/html', body=b''):
+    async def handler(request):
+        return web.Response(status=status, content_type=content_type, body=None if request.method == 'HEAD' else body)
+    return handler
+
+ROUTES = {
+    '/pdf': respond(200, 'application/pdf', PDF),
+    '/html': respond(200, 'text/html', b'<html></html>'),
+    '/octet-pdf': respond(200, 'application/octet-stream', PDF),
+    '/missing': respond(404),
+    '/gone': respond(410),
+    '/busy': respond(503),
+    '/rate-limited': respond(429),
+    '/bot-wall': respond(403),
+}
+
+class DownloadFileCheckTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = LocalDownloadCache(self.directory.name)
+
+        app = web.Application()
+        for path, handler in ROUTES.items():
+            app.router.add_route('*', path, handler)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        self.loop.run_until_complete(web.TCPSite(self.runner, '127.0.0.1', 0).start())
+        self.base = 'http://127.0.0.1:{}'.format(self.runner.addresses[0][1])
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.directory.cleanup()
+
+    def check(self, path):
+        async def go():
+            async with HttpClient(retries=0) as client:
+                context = SimpleNamespace(client=client, cache=self.cache)
+                pull_info = PullInfo('1.1', None, 'Citation.')
+                await download_file_check(context, self.base + path, pull_info)
+                return pull_info.pulled
+
+        return self.loop.run_until_complete(go())
+
+    def verdict(self, path):
+        return self.cache.verdicts.get(self.base + path, [None])[0]
+
+    def test_working_links(self):
+        for path in ['/pdf', '/octet-pdf']:
+            with self.subTest(path=path):
+                self.assertEqual(self.check(path), 'Link works')
+                self.assertIs(self.verdict(path), True)
+
+    def test_definite_failures_are_cached(self):
+        for path in ['/html', '/missing', '/gone']:
+            with self.subTest(path=path):
+                self.assertEqual(self.check(path), '')
+                self.assertIs(self.verdict(path), False)
+
+    def test_transient_failures_are_not_cached(self):
+        for path in ['/busy', '/rate-limited', '/bot-wall']:
+            with self.subTest(path=path):
+                self.assertEqual(self.check(path), '')
+                self.assertIsNone(self.verdict(path))
+
+    def test_errors_are_not_cached(self):
+        # Nothing listens on the discard port.
+        pull_info = PullInfo('1.1', None, 'Citation.')
+        async def go():
+            async with HttpClient(retries=0) as client:
+                await download_file_check(SimpleNamespace(client=client, cache=self.cache), 'http://127.0.0.1:9/a',
+                                          pull_info)
+        self.loop.run_until_complete(go())
+        self.assertEqual(pull_info.pulled, '')
+        self.assertEqual(self.cache.verdicts, {})
+
+class EvictingCache(LocalDownloadCache):
+    """Loses each body right after get() finds it, as if another download had evicted it."""
+
+    def get(self, url):
+        entry = super().get(url)
+        if entry is not None:
+            os.remove(self._object_path(entry.digest))
+        return entry
+
+class DownloadFileZipTest(unittest.TestCase):
+    ETAG = '"v1"'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.directory = tempfile.TemporaryDirectory()
+        self.requests = []
+
+        async def handler(request):
+            self.requests.append(request.headers.get('If-None-Match'))
+            if request.headers.get('If-None-Match') == DownloadFileZipTest.ETAG:
+                return web.Response(status=304)
+            return web.Response(content_type='application/pdf', body=PDF, headers={ 'ETag': DownloadFileZipTest.ETAG })
+
+        app = web.Application()
+        app.router.add_get('/pdf', handler)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        self.loop.run_until_complete(web.TCPSite(self.runner, '127.0.0.1', 0).start())
+        self.url = 'http://127.0.0.1:{}/pdf'.format(self.runner.addresses[0][1])
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.directory.cleanup()
+
+    def download(self, cache):
+        written = {}
+
+        async def write_zip(name, f, done=None):
+            with f:
+                f.seek(0)
+                written[name] = f.read()
+            if done is not None:
+                done()
+
+        async def go():
+            async with HttpClient(retries=0) as client:
+                context = SimpleNamespace(client=client, cache=cache, write_zip=write_zip)
+                pull_info = PullInfo('1.1', None, 'Citation.')
+                await download_file_zip(context, self.url, '1.1', pull_info)
+                return pull_info.pulled
+
+        return self.loop.run_until_complete(go()), written
+
+    def test_revalidated_from_cache(self):
+        cache = LocalDownloadCache(self.directory.name)
+        self.assertEqual(self.download(cache), ('Y', { '1.1.pdf': PDF }))
+        self.assertEqual(self.download(cache), ('Y', { '1.1.pdf': PDF }))
+        self.assertEqual(self.requests, [None, DownloadFileZipTest.ETAG])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_body_evicted_before_304(self):
+        cache = LocalDownloadCache(self.directory.name)
+        self.download(cache)
+        cache.close()
+
+        cache = EvictingCache(self.directory.name)
+        self.assertEqual(self.download(cache), ('Y', { '1.1.pdf': PDF }))
+        # The 304 was no use without the body, so it was fetched again without validators.
+        self.assertEqual(self.requests, [None, DownloadFileZipTest.ETAG, None])
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+from os.path import join
+import pickle
+import tempfile
+import unittest
+from unittest import mock
+
+from footnotes import reference
+
+class LoadCompiledTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = join(self.directory.name, 'abbreviations.txt')
+        self.index_path = join(self.directory.name, 'reference.pickle')
+        with open(self.source, 'w') as f:
+            f.write('Abbr.\n')
+
+        self.paths = mock.patch.object(reference, '_source_paths', lambda: { 'abbreviations': self.source })
+        self.paths.start()
+        with open(self.index_path, 'wb') as f:
+            pickle.dump({ 'version': reference.FORMAT_VERSION, 'sources': reference._source_stamps() }, f)
+
+    def tearDown(self):
+        self.paths.stop()
+        self.directory.cleanup()
+
+    def load(self):
+        with mock.patch.object(reference, '_digest', wraps=reference._digest) as digest:
+            return reference._load_compiled(self.index_path), digest.call_count
+
+    def test_unchanged_source_is_not_hashed(self):
+        index, hashed = self.load()
+        self.assertIsNotNone(index)
+        self.assertEqual(hashed, 0)
+
+    def test_touched_source_is_hashed(self):
+        stat = os.stat(self.source)
+        os.utime(self.source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        index, hashed = self.load()
+        self.assertIsNotNone(index)
+        self.assertEqual(hashed, 1)
+
+    def test_changed_source_is_stale(self):
+        stat = os.stat(self.source)
+        with open(self.source, 'w') as f:
+            f.write('Abbx.\n')
+        os.utime(self.source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNone(self.load()[0])
+
+    def test_missing_source_is_ignored(self):
+        os.remove(self.source)
+        with mock.patch.object(reference, '_source_paths', lambda: { 'abbreviations': None }):
+            self.assertIsNotNone(reference._load_compiled(self.index_path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+
+import lxml.etree as ET
+
+from footnotes.text import Deletion, Edit, Insertion, Location, Range, Replacement, RunWrap, TextRef
+
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+
+def w(name):
+    return '{{{}}}{}'.format(W, name)
+
+def paragraph(runs):
+    return ET.fromstring('<w:p xmlns:w="{}">{}</w:p>'.format(W, runs))
+
+def runs(p):
+    """Each run's property names and text."""
+
+    return [([ET.QName(prop).localname for prop in r.iterfind(w('rPr') + '/*')], ''.join(r.itertext()))
+            for r in p.iter(w('r'))]
+
+class EditTest(unittest.TestCase):
+    def setUp(self):
+        self.element = ET.Element('t')
+        self.element.text = 'See Smith v. Jones, 1 U.S. 1 (1990).'
+        self.element.tail = 'tail text'
+
+    def test_batch(self):
+        Edit.apply_all([
+            Replacement(self.element, Location.TEXT, Range(4, 9), 'Smyth'),
+            Deletion(self.element, Location.TEXT, Range(0, 4)),
+            Insertion(self.element, Location.TEXT, 35, ' [https://perma.cc/ABCD-1234]'),
+            Insertion(self.element, Location.TAIL, 4, '!'),
+        ])
+        self.assertEqual(self.element.text, 'Smyth v. Jones, 1 U.S. 1 (1990) [https://perma.cc/ABCD-1234].')
+        self.assertEqual(self.element.tail, 'tail! text')
+
+    def test_insertions_at_one_offset_keep_their_order(self):
+        Edit.apply_all([
+            Insertion(self.element, Location.TEXT, 0, 'a'),
+            Replacement(self.element, Location.TEXT, Range(0, 3), 'c'),
+            Insertion(self.element, Location.TEXT, 0, 'b'),
+        ])
+        self.assertEqual(self.element.text, 'abc Smith v. Jones, 1 U.S. 1 (1990).')
+
+    def test_ranges_can_share_an_end_point(self):
+        Edit.apply_all([
+            Deletion(self.element, Location.TEXT, Range(0, 4)),
+            Replacement(self.element, Location.TEXT, Range(4, 9), 'Smyth'),
+            Insertion(self.element, Location.TEXT, 9, ','),
+        ])
+        self.assertEqual(self.element.text, 'Smyth, v. Jones, 1 U.S. 1 (1990).')
+
+    def test_overlap(self):
+        with self.assertRaises(ValueError):
+            Edit.apply_all([
+                Replacement(self.element, Location.TEXT, Range(4, 9), 'Smyth'),
+                Deletion(self.element, Location.TEXT, Range(8, 12)),
+            ])
+        self.assertEqual(self.element.text, 'See Smith v. Jones, 1 U.S. 1 (1990).')
+
+    def test_insertion_inside_a_range(self):
+        with self.assertRaises(ValueError):
+            Edit.apply_all([
+                Deletion(self.element, Location.TEXT, Range(4, 9)),
+                Insertion(self.element, Location.TEXT, 6, 'x'),
+            ])
+        self.assertEqual(self.element.text, 'See Smith v. Jones, 1 U.S. 1 (1990).')
+
+    def test_out_of_range(self):
+        for range in [Range(30, 40), Range(-1, 2), Range(5, 4)]:
+            with self.subTest(range=range):
+                with self.assertRaises(ValueError):
+                    Deletion(self.element, Location.TAIL, range).apply()
+                self.assertEqual(self.element.tail, 'tail text')
+
+    def test_text_ref(self):
+        ref = TextRef.from_text(self.element)[4:18]
+        self.assertEqual(str(ref), 'Smith v. Jones')
+        Edit.apply_all([ref.replace(0, 5, 'Smyth'), ref.delete(5, 8), ref.insert(14, ' Co.')])
+        self.assertEqual(self.element.text, 'See Smyth Jones Co., 1 U.S. 1 (1990).')
+
+class RunWrapTest(unittest.TestCase):
+    def wrap(self, p, start, stop, properties=(w('i'),)):
+        ref = TextRef.from_text(p.find('.//' + w('t')))
+        ref.wrap(start, stop, properties).apply()
+
+    def test_middle(self):
+        p = paragraph('<w:r><w:rPr><w:b/></w:rPr><w:t>See Smith v. Jones for more.</w:t></w:r>')
+        self.wrap(p, 4, 18)
+        self.assertEqual(runs(p), [(['b'], 'See '), (['b', 'i'], 'Smith v. Jones'), (['b'], ' for more.')])
+        self.assertEqual([t.get(RunWrap.XML_SPACE) for t in p.iter(w('t'))], ['preserve', None, 'preserve'])
+
+    def test_whole_run(self):
+        p = paragraph('<w:r><w:t>Id.</w:t></w:r><w:r><w:t> at 5.</w:t></w:r>')
+        self.wrap(p, 0, 3)
+        self.assertEqual(runs(p), [(['i'], 'Id.'), ([], ' at 5.')])
+
+    def test_ends(self):
+        p = paragraph('<w:r><w:t>Id. at 5.</w:t><w:tab/></w:r>')
+        self.wrap(p, 0, 3)
+        self.assertEqual(runs(p), [(['i'], 'Id.'), ([], ' at 5.')])
+        # Whatever followed the text stays after it.
+        self.assertEqual(ET.QName(p[-1][-1]).localname, 'tab')
+
+        p = paragraph('<w:r><w:t>Id. at 5.</w:t></w:r>')
+        self.wrap(p, 4, 9)
+        self.assertEqual(runs(p), [([], 'Id. '), (['i'], 'at 5.')])
+
+    def test_properties_in_schema_order(self):
+        p = paragraph('<w:r><w:rPr><w:rStyle w:val="FootnoteText"/><w:rFonts w:ascii="Times"/><w:sz w:val="20"/>'
+                      '<w:rPrChange/></w:rPr><w:t>Smith v. Jones</w:t></w:r>')
+        self.wrap(p, 0, 5, [w('vertAlign'), w('i'), w('b'), w('sz'), w('u')])
+        self.assertEqual(runs(p), [
+            (['rStyle', 'rFonts', 'b', 'i', 'sz', 'u', 'vertAlign', 'rPrChange'], 'Smith'),
+            (['rStyle', 'rFonts', 'sz', 'rPrChange'], ' v. Jones'),
+        ])
+        self.assertEqual(p.find('.//' + w('sz')).get(w('val')), '20')
+
+    def test_with_other_edits(self):
+        p = paragraph('<w:r><w:t>See Smith v. Jones.</w:t></w:r>')
+        t = p.find('.//' + w('t'))
+        ref = TextRef.from_text(t)
+        Edit.apply_all([ref.insert(19, ' [https://perma.cc/ABCD-1234]'), ref.wrap(4, 18, [w('i')]),
+                        ref.replace(0, 3, 'Cf.')])
+        self.assertEqual(runs(p), [([], 'Cf. '), (['i'], 'Smith v. Jones'), ([], '. [https://perma.cc/ABCD-1234]')])
+
+    def test_invalid(self):
+        p = paragraph('<w:r><w:t>Id.</w:t></w:r>')
+        t = p.find('.//' + w('t'))
+        with self.assertRaises(ValueError):
+            RunWrap(t, Location.TAIL, Range(0, 0))
+        with self.assertRaises(ValueError):
+            RunWrap(t, Location.TEXT, Range(1, 1))
+        with self.assertRaises(ValueError):
+            RunWrap(p, Location.TEXT, Range(0, 1))
+        with self.assertRaises(ValueError):
+            RunWrap(t, Location.TEXT, Range(2, 5)).apply()
+        self.assertEqual(runs(p), [([], 'Id.')])
+
+if __name__ == '__main__':
+    unittest.main()
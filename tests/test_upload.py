@@ -0,0 +1,136 @@
+import os
+from os.path import exists, join
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import zipfile
+
+from footnotes.upload import LocalMultipartUpload, MultipartWriter
+
+class RecordingUpload(LocalMultipartUpload):
+    """Remembers part sizes and how many uploads overlapped; fails on part `fail_on`."""
+
+    def __init__(self, path, fail_on=None, delay=0):
+        super().__init__(path)
+        self.fail_on = fail_on
+        self.delay = delay
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.aborted = False
+
+    def upload_part(self, number, data):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            if number == self.fail_on:
+                raise IOError('Part {} failed.'.format(number))
+            self.sizes[number] = len(data)
+            return super().upload_part(number, data)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def abort(self):
+        self.aborted = True
+        super().abort()
+
+@mock.patch.object(LocalMultipartUpload, 'MIN_PART_SIZE', 10)
+class MultipartWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = join(self.directory.name, 'out.bin')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def leftovers(self):
+        return [name for name in os.listdir(self.directory.name) if name != 'out.bin']
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_splits_into_parts(self):
+        upload = RecordingUpload(self.path)
+        data = bytes(range(256)) * 2
+        with MultipartWriter(upload, part_size=100) as writer:
+            for start in range(0, len(data), 37):
+                writer.write(data[start:start + 37])
+                self.assertEqual(writer.tell(), min(start + 37, len(data)))
+
+        self.assertEqual(self.read(), data)
+        self.assertEqual([upload.sizes[n] for n in sorted(upload.sizes)], [100, 100, 100, 100, 100, 12])
+        self.assertFalse(upload.aborted)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_empty(self):
+        with MultipartWriter(RecordingUpload(self.path), part_size=100):
+            pass
+        self.assertEqual(self.read(), b'')
+
+    def test_limits_uploads_in_flight(self):
+        upload = RecordingUpload(self.path, delay=0.02)
+        with MultipartWriter(upload, part_size=10, max_pending=2) as writer:
+            writer.write(b'x' * 200)
+        self.assertEqual(self.read(), b'x' * 200)
+        self.assertLessEqual(upload.max_in_flight, 2)
+
+    def test_zip(self):
+        with MultipartWriter(RecordingUpload(self.path), part_size=64) as writer:
+            with zipfile.ZipFile(writer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                zipf.writestr('a.txt', 'a' * 1000)
+                zipf.writestr('b.txt', os.urandom(500))
+
+        with zipfile.ZipFile(self.path) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(zipf.read('a.txt'), b'a' * 1000)
+
+    def test_aborts_on_exception(self):
+        upload = RecordingUpload(self.path)
+        with self.assertRaises(KeyError):
+            with MultipartWriter(upload, part_size=10) as writer:
+                writer.write(b'x' * 25)
+                raise KeyError('stop')
+
+        self.assertTrue(upload.aborted)
+        self.assertFalse(exists(self.path))
+        self.assertEqual(self.leftovers(), [])
+
+    def test_aborts_on_failed_part(self):
+        upload = RecordingUpload(self.path, fail_on=2)
+        writer = MultipartWriter(upload, part_size=10)
+        with self.assertRaises(IOError):
+            with writer:
+                for _ in range(10):
+                    writer.write(b'x' * 10)
+
+        self.assertTrue(upload.aborted)
+        self.assertTrue(writer.closed)
+        self.assertFalse(exists(self.path))
+        self.assertEqual(self.leftovers(), [])
+
+    def test_aborts_on_failed_completion(self):
+        upload = RecordingUpload(self.path)
+        with self.assertRaises(ValueError):
+            # Parts below the store's minimum size only fail when the upload completes.
+            with MultipartWriter(upload, part_size=5) as writer:
+                writer.write(b'x' * 12)
+
+        self.assertTrue(upload.aborted)
+        self.assertFalse(exists(self.path))
+        self.assertEqual(self.leftovers(), [])
+
+    def test_write_after_close(self):
+        writer = MultipartWriter(RecordingUpload(self.path), part_size=10)
+        writer.close()
+        with self.assertRaises(ValueError):
+            writer.write(b'x')
+
+if __name__ == '__main__':
+    unittest.main()